@@ -176,24 +176,25 @@ def run_maaslin(read_config_file, maaslin_outfile, pcl_file):
     }
 
 
-def sparsity_filter(pcl_fname_from, pcl_fname_to):
-    from_, to_ = pcl_fname_from, pcl_fname_to
+def sparsity_filter(pcl_fname_from, pcl_fname_to, min_abundance=0.001,
+                    min_prevalence=0.1):
+    """Keep the features of a pcl file that have at least
+    ``min_abundance`` in at least ``min_prevalence`` of the samples
+
+    :param pcl_fname_from: String; input pcl file
+    :param pcl_fname_to: String; output pcl file
+    :keyword min_abundance: Float; abundance at which a feature counts
+                            as present in a sample (default: 0.1%)
+    :keyword min_prevalence: Float; fraction of samples a feature must
+                             be present in (default: 10%)
 
-    def _should_print(key, values):
-        "Keep the bugs that have >= 0.1% abundance in >= 10% of samples "
-        total_present = sum([ val >= 0.001 for val in values ])
-        return total_present >= len(values)/10
+    """
+    from_, to_ = pcl_fname_from, pcl_fname_to
 
     def _mangle():
-        with open(from_) as in_f, open(to_, 'w') as out_f:
-            out_f.write( in_f.readline() ) # bump off metadata line
-            for line in in_f:
-                fields = line.strip().split('\t')
-                key, values = fields[0], map(float, fields[1:])
-                if _should_print(key, values):
-                    to_print = [key] + map(str, values)
-                    print >> out_f, "\t".join(to_print)
-            
+        from .utility_scripts import sparsity
+        sparsity.filter_pcl(from_, to_, min_abundance=min_abundance,
+                            min_prevalence=min_prevalence)
 
     return {
         "name"     : "sparsity_filter:" + from_,
@@ -204,7 +205,8 @@ def sparsity_filter(pcl_fname_from, pcl_fname_to):
 
 
 
-def maaslin(otu_table, metadata_file):
+def maaslin(otu_table, metadata_file, min_abundance=0.001,
+            min_prevalence=0.1):
     """Workflow to compute the significance of association in microbial
     community using a transform abundance or relative function table
     obtained from Qiime, HUMAnN or MetaPhlAn plus study metadata
@@ -213,6 +215,12 @@ def maaslin(otu_table, metadata_file):
 
     :param metadata_file: String; file of metadata in tsv format
 
+    :keyword min_abundance: Float; drop features that don't reach this
+                            abundance in ``min_prevalence`` of the samples
+
+    :keyword min_prevalence: Float; fraction of samples in which a
+                             feature must reach ``min_abundance``
+
     External dependencies
       - Maaslin: https://bitbucket.org/biobakery/maaslin
 
@@ -248,11 +256,13 @@ def maaslin(otu_table, metadata_file):
         yield biom_to_tsv(otu_table,otu_table_tsv_format)
         otu_table_maaslin_format=new_file_basename + "_format_maaslin.tsv"
         yield qiime_to_maaslin(otu_table_tsv_format, otu_table_maaslin_format)
-        yield sparsity_filter(otu_table_maaslin_format, filtered_target)
+        yield sparsity_filter(otu_table_maaslin_format, filtered_target,
+                              min_abundance, min_prevalence)
         yield merge_otu_metadata(filtered_target,
                                  metadata_file, initial_targets[0])
     else:
-        yield sparsity_filter(otu_table, filtered_target)
+        yield sparsity_filter(otu_table, filtered_target,
+                              min_abundance, min_prevalence)
         yield merge_otu_metadata(filtered_target, 
                                  metadata_file, initial_targets[0])
     
@@ -7,18 +7,20 @@ from . import (
 
 
 
-@requires(binaries=['biom'],
-          version_methods=["pip freeze | grep biom-format"])
-def to_tsv(infile, outfile):
-    """Convert a biom file to a tsv (also known as pcl) file using the
-    biom package
+def to_tsv(infile, outfile, native=True):
+    """Convert a biom file to a tsv (also known as pcl) file, with the
+    taxonomy of each OTU in a ``Consensus Lineage`` column
 
     :param infile: file of the biom format
 
     :param outfile: file of the tsv format
 
+    :keyword native: Boolean; convert in-process. Set to False to use
+                     the biom package's ``biom convert`` instead.
+
     External dependencies
-      - biom-format: http://biom-format.org/
+      - biom-format: http://biom-format.org/ (only if ``native`` is
+        False)
     """
 
     verbose = settings.workflows.verbose 
@@ -29,7 +31,10 @@ def to_tsv(infile, outfile):
         "--table-type 'otu table'"
 
     def run():
-        if os.stat(infile).st_size > 1:
+        if native:
+            from .utility_scripts import biomtable
+            biomtable.convert_files(biomtable.to_tsv, [infile], [outfile])
+        elif os.stat(infile).st_size > 1:
             return CmdAction(cmd.format(infile=infile, outfile=outfile),
                              verbose=verbose).execute()
         else:
@@ -41,6 +46,31 @@ def to_tsv(infile, outfile):
         "file_dep": [infile],
         "targets": [outfile]
     }
+
+
+def to_tsv_batch(infiles, outfiles, jobs=1):
+    """Convert many biom files to tsv files in one task, the same way
+    as :py:func:`to_tsv`
+
+    :param infiles: List of strings; files of the biom format
+
+    :param outfiles: List of strings; tsv file for each of ``infiles``
+
+    :keyword jobs: Int; convert this many files at a time
+
+    """
+
+    def run():
+        from .utility_scripts import biomtable
+        biomtable.convert_files(biomtable.to_tsv, infiles, outfiles,
+                                jobs=jobs)
+
+    return {
+        "name": "biom_to_tsv_batch: " + outfiles[0],
+        "actions": [run],
+        "file_dep": infiles,
+        "targets": outfiles
+    }
 biom_to_tsv = to_tsv
 
 
@@ -75,16 +105,19 @@ def add_metadata(infile, outfile, sample_metadata):
     }
 
 
-@requires(binaries=['biom'],
-          version_methods=["pip freeze | grep biom-format"])
-def from_pcl(infile, outfile):
-    """Convert a pcl file to biom format using the biom package
+def from_pcl(infile, outfile, native=True):
+    """Convert a pcl file to biom format. A taxonomy column is kept as
+    one string per OTU, as ``biom convert`` keeps it without
+    ``--process-obs-metadata``.
 
     :param infile: String; name of the input tsv or pcl file
     :param outfile: String; name of the resulting converted biom file
+    :keyword native: Boolean; convert in-process. Set to False to use
+                     the biom package's ``biom convert`` instead.
 
     External dependencies
-      - biom-format: http://biom-format.org/
+      - biom-format: http://biom-format.org/ (only if ``native`` is
+        False)
 
     """
 
@@ -92,9 +125,13 @@ def from_pcl(infile, outfile):
         outfile + \
         " --table-type 'otu table'"
 
+    def run():
+        from .utility_scripts import biomtable
+        biomtable.from_tsv(infile, outfile, process_taxonomy=False)
+
     return {
         "name": "biom_from_pcl: " + infile,
-        "actions": [cmd],
+        "actions": [run if native else cmd],
         "file_dep": [infile],
         "targets": [outfile]
     }
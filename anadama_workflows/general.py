@@ -1,6 +1,7 @@
 """General purpose workflows"""
 
 import os
+import sys
 import mimetypes
 
 from anadama.util import addext, guess_seq_filetype, new_file
@@ -99,7 +100,7 @@ def fastq_split(files_list, fasta_fname, qual_fname,
 def sequence_convert(files_list, output_file=None,
                      reverse_complement=False, from_format=None,
                      format_to="fastq", lenfilters_list=list(),
-                     mangle=None):
+                     mangle=None, jobs=1):
     """ Workflow for converting between sequence file formats.
 
     :param files_list: List; List of input files
@@ -117,6 +118,8 @@ def sequence_convert(files_list, output_file=None,
                               sequences by length.  To keep all sequences 
                               longer than 60 chars, for example, use >60.
     :keyword mangle: String; Rename all sequences according to this base string.
+    :keyword jobs: Integer; convert chunks of sequences in parallel with this
+                   many processes.
 
     External dependencies:
       - sequence_convert: python script that should come pre-installed with
@@ -142,6 +145,8 @@ def sequence_convert(files_list, output_file=None,
         cmd += " --reverse_complement"
     if mangle:
         cmd += " -m "+mangle
+    if jobs > 1:
+        cmd += " --jobs="+str(jobs)
 
     cmd += ( " "+" ".join(files_list)
              + " > "+output_file)
@@ -161,7 +166,11 @@ def fastq_join(forward_fname, reverse_fname, output_file,
     """Workflow function for joining (aka stitching) paired-end fastq
     files with ea-utils' ``fastq-join``. If the ``drop_unpaired``
     option is set to True, unpaired forward reads are concatenated to
-    the joined fastq file.
+    the joined fastq file. Compressed input files are decompressed as
+    they're read. When reordering, reads are matched to ``reorder_to``
+    by ID, holding up to ``reorder_window`` reads in memory (default
+    100000); reads further out of order are set aside on disk, and
+    reads not found within twice that many more reads are skipped.
 
     :param forward_fname: String; file name for the forward reads.
 
@@ -184,6 +193,7 @@ def fastq_join(forward_fname, reverse_fname, output_file,
 
 
     drop_unpaired = options.pop('drop_unpaired', False)
+    reorder_window = options.pop('reorder_window', 100000)
 
     default_opts = {
         "o": output_file
@@ -191,7 +201,10 @@ def fastq_join(forward_fname, reverse_fname, output_file,
     default_opts.update(options)
     opts = dict_to_cmd_opts(default_opts)
 
-    cmd = "fastq-join "+opts+ " "+forward_fname+" "+reverse_fname
+    inputs = [ starters.stream(f) for f in (forward_fname, reverse_fname) ]
+    cmd = "fastq-join "+opts+ " "+" ".join(inputs)
+    if inputs != [forward_fname, reverse_fname]:
+        cmd = starters.bash(cmd)
 
     if '%' in output_file:
         renamed_output = output_file.replace("%", "join")
@@ -201,8 +214,10 @@ def fastq_join(forward_fname, reverse_fname, output_file,
     actions = [cmd]
     unpaired_forward = renamed_output.replace("join", "un1")
     if not drop_unpaired and reorder_to:
-        actions.append( "sequence_re-pair -f fastq -t fastq -b %s %s %s > %s"%(
-            reorder_to, renamed_output, unpaired_forward, output_file) )
+        actions.append(
+            "sequence_re-pair -f fastq -t fastq -w %i -b %s %s %s > %s"%(
+                reorder_window, reorder_to, renamed_output,
+                unpaired_forward, output_file) )
     elif not drop_unpaired and not reorder_to:
         actions.append("cat {} {} > {}".format(
             unpaired_forward, renamed_output, output_file))
@@ -258,7 +273,22 @@ def cat(input_files, output_file):
         "targets": [output_file]
     }
 
-def group_by_sampleid(large_fastas, output_dir, sample_ids):
+def group_by_sampleid(large_fastas, output_dir, sample_ids, jobs=1,
+                      max_open=256, buffer_size=64*1024*1024):
+    """Workflow for splitting demultiplexed fasta files into one fasta
+    file per sample. The sample ID is the part of each sequence ID
+    before the last two underscores.
+
+    :param large_fastas: String or list of strings; input fasta files
+    :param output_dir: String; directory to put per-sample files
+    :param sample_ids: List of strings; the samples to split out
+
+    :keyword jobs: Int; split the input in this many processes
+    :keyword max_open: Int; keep at most this many output files open
+    :keyword buffer_size: Int; hold this many bytes of sequences in
+                          memory between writes
+
+    """
     output_fnames = [ new_file(s+"_demuxed.fa", basedir=output_dir)
                       for s in sample_ids ]
 
@@ -266,18 +296,14 @@ def group_by_sampleid(large_fastas, output_dir, sample_ids):
         large_fastas = [large_fastas]
 
     def _run():
-        import contextlib
-        from Bio import SeqIO
-        from itertools import chain
-        records = chain.from_iterable( iter(SeqIO.parse(fname, "fasta")
-                                            for fname in large_fastas) )
-        
-        files = dict([ (s_id, open(f, 'w'))
-                       for f, s_id in zip(output_fnames, sample_ids)])
-        with contextlib.nested(*list(files.values())):
-            for rec in records:
-                sample_id = "_".join(rec.id.split("_")[:-2])
-                SeqIO.write(rec, files[sample_id], "fasta")
+        from .utility_scripts import demux
+        counts, unknown = demux.demultiplex(
+            large_fastas, dict(zip(sample_ids, output_fnames)),
+            jobs=jobs, max_open=max_open, buffer_size=buffer_size)
+        for s_id in sample_ids:
+            print >> sys.stderr, "%s\t%i" %(s_id, counts[s_id])
+        if unknown:
+            print >> sys.stderr, "unknown\t%i" %(unknown)
 
     return { "name": "group_by_sampleid: "+large_fastas[0],
              "actions": [_run],
@@ -142,8 +142,14 @@ def _regex_filter(list_fnames):
 
 
 
-def maybe_decompress(raw_seq_files, products_dir):
-    if not raw_seq_files:
+def maybe_decompress(raw_seq_files, products_dir, stream=False):
+    """Make a task to decompress each compressed file in
+    ``raw_seq_files``. With ``stream`` set, leave compressed files as
+    they are and make no tasks; downstream workflows then decompress
+    them as they're read.
+
+    """
+    if stream or not raw_seq_files:
         idxs, compressed_files = list(), list()
     elif isinstance(raw_seq_files[0], tuple):
         idxs = list(util.which_compressed_idxs(raw_seq_files))
@@ -184,7 +190,7 @@ def _to_merged(fname_str, tag="merged", strip_ext=True):
     fname_str = os.path.join(path, base)
 
     if strip_ext and util.is_compressed(fname_str):
-        fname_str = rmext(fname_str)
+        fname_str = util.rmext(fname_str)
 
     return fname_str
 
@@ -201,11 +207,11 @@ def split_pairs(maybe_pairs):
     return pairs, notpairs
 
 
-def maybe_convert_to_fastq(fnames, products_dir):
+def maybe_convert_to_fastq(fnames, products_dir, stream=False):
     new_fnames, tasks = list(), list()
     for f in fnames:
         guess = util.guess_seq_filetype(f)
-        if guess != "fastq" or util.is_compressed(f):
+        if guess != "fastq" or (util.is_compressed(f) and not stream):
             fastq_file = util.new_file(f+".fastq", basedir=products_dir)
             new_fnames.append(fastq_file)
             tasks.append(
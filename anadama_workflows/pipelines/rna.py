@@ -22,7 +22,12 @@ class RNAPipeline(Pipeline, SampleMetadataMixin):
 
     * For each sequence set:
 
-      - Convert sequences into paired and single fastq files
+      - Convert sequences into paired and single fastq files. Bam
+        files have their mates matched up by name without sorting;
+        set the ``to_paired_fastq`` option ``collate`` to False to
+        sort them with samtools first, along with any ``samtools
+        sort`` options. Sort options without ``collate`` set to False
+        are an error.
       - Align sequences to a genome (default GRCh38/hg38)
       - Combine with annotations and calculate read-counts
 
@@ -31,6 +36,7 @@ class RNAPipeline(Pipeline, SampleMetadataMixin):
 
       - :py:func:`anadama_workflows.general.sequence_convert`
       - :py:func:`anadama_workflows.general.pe_split`
+      - :py:func:`anadama_workflows.samtools.to_paired_fastq`
       - :py:func:`anadama_workflows.subread.align`
       - :py:func:`anadama_workflows.subread.featureCounts`
 
@@ -115,7 +121,8 @@ class RNAPipeline(Pipeline, SampleMetadataMixin):
             elif util.guess_seq_filetype(maybe_pair) == 'bam':
                 prefix = util.new_file( util.rmext(basename(maybe_pair)),
                                         basedir=self.products_dir )
-                t = samtools.to_paired_fastq(maybe_pair, prefix)
+                t = samtools.to_paired_fastq(
+                    maybe_pair, prefix, **self.options['to_paired_fastq'])
                 paired, single = t['targets'][:2], t['targets'][2]
                 self.paired_fastq_files.append(paired)
                 self.unpaired_fastq_files.append(single)
@@ -2,7 +2,7 @@ import os
 import re
 from os.path import join, basename
 from operator import itemgetter
-from collections import Counter, namedtuple
+from collections import namedtuple
 from itertools import groupby, izip_longest
 
 from anadama import util
@@ -10,6 +10,7 @@ from anadama.pipelines import Pipeline
 
 from .. import settings
 from .. import general, sixteen, biom, usearch
+from ..sixteen import _determine_barcode_type
 
 from . import (
     SampleFilterMixin, 
@@ -35,6 +36,9 @@ class DemultiplexMixin(object):
                 self.sample_metadata)
 
         do_groupby = options.pop("group_by_sampleid", False)
+        native = options.pop("native", False)
+        native_opts = native if type(native) is dict else {}
+        map_fnames, sample_ids = list(), list()
         for seqfile, bcode_file in bcode_pairs:
             sample_dir = join(self.products_dir, basename(seqfile)+"_split")
 
@@ -46,22 +50,45 @@ class DemultiplexMixin(object):
                 sample_group, sample_dir, 
                 **self.options.get('write_map', dict())
             ) )
+            map_fnames.append(map_fname)
+            sample_ids.extend( s[0] for s in sample_group )
 
             outfile = util.new_file(
                 util.rmext(basename(seqfile))+"_demuxed.fna",
                 basedir=sample_dir
             ) 
-            tasks.append( sixteen.demultiplex_illumina(
-                [seqfile], [bcode_file], map_fname, outfile,
-                qiime_opts=options
-            ) )
+            if native and do_groupby:
+                continue
+            elif native:
+                tasks.append( sixteen.demultiplex_illumina_native(
+                    [seqfile], [bcode_file], map_fname, outfile,
+                    qiime_opts=options, **native_opts
+                ) )
+            else:
+                tasks.append( sixteen.demultiplex_illumina(
+                    [seqfile], [bcode_file], map_fname, outfile,
+                    qiime_opts=options
+                ) )
             demuxed.append(outfile)
 
-        if do_groupby:
+        if native and do_groupby:
+            # split straight into files by sample
+            output_dir = join(self.products_dir, "demuxed_by-sampleid")
+            output_fnames = dict(
+                (s, util.new_file(s+"_demuxed.fa", basedir=output_dir))
+                for s in sample_ids )
+            task_dict = sixteen.demultiplex_illumina_native(
+                seqfiles_to_split, barcode_seqfiles, map_fnames,
+                output_fnames, qiime_opts=options, **native_opts
+            )
+            demuxed = task_dict['targets']
+            tasks.append(task_dict)
+        elif do_groupby:
             output_dir = join(self.products_dir, "demuxed_by-sampleid")
             sample_ids = [ s[0] for s in sample_group ]
+            groupby_opts = do_groupby if type(do_groupby) is dict else {}
             task_dict = general.group_by_sampleid(
-                demuxed, output_dir, sample_ids
+                demuxed, output_dir, sample_ids, **groupby_opts
                 )
             demuxed = task_dict['targets']
             tasks.append(task_dict)
@@ -116,7 +143,8 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
 
     Steps:
 
-      * Decompress any compressed sequences
+      * Decompress any compressed sequences, or with the ``decompress``
+        option ``stream`` set, decompress them as they're read
       * Paired end reads are stitched.
       * Aggregate samples by SampleID.
       * For each sample:
@@ -125,7 +153,9 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
         * Convert all sequence files for that SampleID into fasta and qual
         * Demultiplex and quality filter
         * Perform closed reference OTU picking against greengenes
-        * Infer genes, pathways with picrust
+        * Infer genes, pathways with picrust, or with the ``picrust``
+          option ``batch`` set, infer them for all samples in one run
+          of picrust
 
     Workflows used:
 
@@ -137,7 +167,9 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
       * :py:func:`anadama_workflows.usearch.filter`
       * :py:func:`anadama_workflows.sixteen.demultiplex`
       * :py:func:`anadama_workflows.sixteen.pick_otus_closed_ref`
+      * :py:func:`anadama_workflows.biom.to_tsv_batch`
       * :py:func:`anadama_workflows.sixteen.picrust`
+      * :py:func:`anadama_workflows.sixteen.picrust_batch`
     """
 
     name = "16S"
@@ -154,6 +186,9 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
         'infer_pairs':         {
             'infer': True
         },
+        'decompress':          {
+            'stream': False
+        },
         'write_map':            { },
         'fastq_split':          { },
         'demultiplex':          {
@@ -169,17 +204,20 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
         },
         'demultiplex_illumina': { },
         'pick_otus_closed_ref': { },
+        'biom_to_tsv':          { },
         'picrust':              { },
     }
 
     workflows = {
         'infer_pairs':          None,
+        'decompress':           None,
         'write_map':            None,
         'fastq_split':          general.fastq_split,
         'fastq_filter':         usearch.filter,
         'demultiplex':          sixteen.demultiplex,
         'demultiplex_illumina': sixteen.demultiplex_illumina,
         'pick_otus_closed_ref': sixteen.pick_otus_closed_ref,
+        'biom_to_tsv':          biom.to_tsv_batch,
         'picrust':              sixteen.picrust
     }
 
@@ -267,9 +305,11 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
     def _handle_raw_seqs(self):
         attrs = ("raw_seq_files", "barcode_seq_files",
                  "raw_demuxed_fastq_files")
+        stream = self.options.get('decompress', {}).get('stream', False)
         for attr in attrs:
             seqs, maybe_tasks = maybe_decompress(getattr(self, attr),
-                                                 self.products_dir)
+                                                 self.products_dir,
+                                                 stream=stream)
             setattr(self, attr, seqs)
             yield maybe_tasks
 
@@ -283,7 +323,8 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
         packed = maybe_stitch(
             self.raw_seq_files,
             self.products_dir,
-            barcode_files=self.barcode_seq_files
+            barcode_files=self.barcode_seq_files,
+            stream=stream
         )
         self.raw_seq_files, self.barcode_seq_files, maybe_tasks = packed
         yield maybe_tasks
@@ -291,7 +332,8 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
         self.raw_demuxed_fastq_files = []
         if paired_demuxed:
             singles, _, maybe_tasks = maybe_stitch(paired_demuxed,
-                                                   self.products_dir)
+                                                   self.products_dir,
+                                                   stream=stream)
             yield maybe_tasks
             self.raw_demuxed_fastq_files = singles
         self.raw_demuxed_fastq_files += single_demuxed
@@ -302,7 +344,10 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
 
     def _process_raw_demuxed_fastq_files(self):
         for fname in self.raw_demuxed_fastq_files:
-            filtered_fname = util.addtag(fname, "filtered")
+            if util.is_compressed(fname):
+                filtered_fname = util.addtag(util.rmext(fname), "filtered")
+            else:
+                filtered_fname = util.addtag(fname, "filtered")
             opts = self.options.get('fastq_filter', {})
             opts['mangle_to'] = self._filter_samples_for_file(
                 self.sample_metadata, fname)[0][0]
@@ -344,41 +389,36 @@ class SixteenSPipeline(Pipeline, DemultiplexMixin, SampleFilterMixin,
             )
             self.otu_tables.append(join(otu_dir, "otu_table.biom"))
 
-        # convert biom file to tsv
-        for otu_table in self.otu_tables:
-            tsv_filename = otu_table+".tsv"
-            yield biom.biom_to_tsv(
-                otu_table, 
-                tsv_filename)
+        # convert biom files to tsv
+        if self.otu_tables:
+            yield biom.to_tsv_batch(
+                self.otu_tables,
+                [ otu_table+".tsv" for otu_table in self.otu_tables ],
+                **self.options.get('biom_to_tsv', dict())
+            )
 
         # infer genes and pathways with picrust
-        for otu_table in self.otu_tables:
-            yield sixteen.picrust(
-                otu_table, 
-                **self.options.get('picrust', dict())
+        for task in self._picrust():
+            yield task
+
+    def _picrust(self):
+        options = self.options.get('picrust', dict()).copy()
+        if options.pop("batch", False):
+            # one PICRUSt run over all OTU tables merged together
+            yield sixteen.picrust_batch(
+                self.otu_tables,
+                util.new_file("picrust_otu_tables.biom",
+                              basedir=self.products_dir),
+                **options
             )
-
-            
-
-def _determine_barcode_type(sample_group, use_most_common=False):
-    lengths = ( len(s.BarcodeSequence) for s in sample_group )
-    length_histogram = Counter(lengths)
-
-    if len(length_histogram) == 1 or use_most_common:
-        bcode_len = length_histogram.most_common(1)[0][0]
-        bcode_len = str(bcode_len)
-    else:
-        return "variable_length"
-
-    if bcode_len == "12":
-        bcode_len = "golay_12"
-
-    return bcode_len
+            return
+        for otu_table in self.otu_tables:
+            yield sixteen.picrust(otu_table, **options)
 
 
 
 def maybe_stitch(maybe_pairs, products_dir, 
-                 barcode_files=list(), drop_unpaired=False):
+                 barcode_files=list(), drop_unpaired=False, stream=False):
     pairs, singles = split_pairs(maybe_pairs)
     tasks = list()
     barcodes = list()
@@ -390,7 +430,7 @@ def maybe_stitch(maybe_pairs, products_dir,
     barcode_files = sorted(barcode_files)
     for pair, maybe_barcode in izip_longest(pairs, barcode_files):
         (forward, reverse), maybe_tasks = maybe_convert_to_fastq(
-            pair, products_dir)
+            pair, products_dir, stream=stream)
         tasks.extend(maybe_tasks)
         output = util.new_file( 
             _to_merged(forward),
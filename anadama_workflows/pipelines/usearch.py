@@ -20,6 +20,9 @@ class Usearch16SPipeline(SixteenSPipeline):
         'infer_pairs':         {
             'infer': True
         },
+        'decompress':          {
+            'stream': False
+        },
         'write_map':            { },
         'fastq_split':          { },
         'fastq_filter':         {
@@ -47,6 +50,7 @@ class Usearch16SPipeline(SixteenSPipeline):
 
     workflows = {
         'infer_pairs': None,
+        'decompress':  None,
         'write_map':   None,
         'truncate':  truncate,
         'fastq_split': general.fastq_split,
@@ -83,11 +87,8 @@ class Usearch32_16SPipeline(Usearch16SPipeline):
             self.otu_tables.append(otu_table)
 
         # infer genes and pathways with picrust
-        for otu_table in self.otu_tables:
-            yield sixteen.picrust(
-                otu_table, 
-                **self.options.get('picrust', dict())
-            )
+        for task in self._picrust():
+            yield task
 
 class Usearch64_16SPipeline(Usearch16SPipeline):
     """USEARCH64bit-based 16S pipeline"""
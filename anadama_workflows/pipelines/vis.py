@@ -45,6 +45,7 @@ class VisualizationPipeline(Pipeline, SampleMetadataMixin):
     }
 
     default_options = {
+        'merge_otu_tables':      { },
         'stacked_bar_chart':     { },
         'breadcrumbs_pcoa_plot': {
             "meta"       : True,
@@ -54,6 +55,7 @@ class VisualizationPipeline(Pipeline, SampleMetadataMixin):
     }
 
     workflows = {
+        'merge_otu_tables':      sixteen.merge_otu_tables,
         'stacked_bar_chart':     visualization.stacked_bar_chart,
         'breadcrumbs_pcoa_plot': visualization.breadcrumbs_pcoa_plot
     }
@@ -112,7 +114,8 @@ class VisualizationPipeline(Pipeline, SampleMetadataMixin):
             merged_file = util.new_file(merged_name, basedir=self.products_dir)
             yield sixteen.merge_otu_tables(
                 self.otu_tables,
-                name=merged_file
+                name=merged_file,
+                **self.options.get('merge_otu_tables', {})
             )
             meta_biom_name = util.addtag(merged_file, "meta")
             yield biom.add_metadata(
@@ -41,17 +41,32 @@ def sort(input_bam, output_prefix,
              "targets": [output_file] }
 
 
-def to_paired_fastq(input_bam, output_prefix, **kwargs):
-    """Sort a bam file by name, then split into three fastq files based on
-    ``output_prefix``: forward reads, reverse reads, and singleton reads
+def to_paired_fastq(input_bam, output_prefix, collate=True, num_threads=1,
+                    buffer_size=None, **kwargs):
+    """Split a bam file into three fastq files based on
+    ``output_prefix``: forward reads, reverse reads, and singleton
+    reads. By default, mates are matched up by read name straight from
+    the bam file, whatever order it's in, using ``bam_pe_split
+    --collate``. Otherwise, the bam file is sorted by name first.
 
     :param input_bam: String; file name of input bam file.
 
     :param output_prefix: String; file name of output fastq files
     without the ``.r1.fastq`` etc. suffix.
 
-    :keyword **kwargs: All extra keyword arguments are passed to
-    :py:func:`anadama_workflows.samtools.sort`
+    :keyword collate: Boolean; match mates by name instead of sorting.
+
+    :keyword num_threads: Int; number of threads to use decompressing
+    or sorting the bam file.
+
+    :keyword buffer_size: Int; when collating, the most reads to keep
+    in memory waiting for their mate before setting them aside on
+    disk. Defaults to bam_pe_split's default.
+
+    :keyword **kwargs: When not collating, all extra keyword arguments
+    are passed to :py:func:`anadama_workflows.samtools.sort`. They're
+    refused with a ``TypeError`` when collating, since nothing is
+    sorted.
 
     """
 
@@ -59,12 +74,24 @@ def to_paired_fastq(input_bam, output_prefix, **kwargs):
     output_r2 = output_prefix+".r2.fastq"
     output_se = output_prefix+".single.fastq"
 
-    opts = { 'o': "" }
-    opts.update(kwargs)
-
-    sort_cmd = sort(input_bam, output_prefix, **opts).next()['actions'][0]
-    pe_split_cmd = "bam_pe_split "+output_prefix
-    cmd = (sort_cmd+" | "+pe_split_cmd)
+    if collate and kwargs:
+        raise TypeError(
+            "to_paired_fastq got samtools sort options %s, which are only"
+            " used with collate=False"%(", ".join(sorted(kwargs))))
+
+    if collate:
+        opts = { 'collate': "", '@': str(num_threads) }
+        if buffer_size:
+            opts['buffer'] = str(buffer_size)
+        cmd = ("bam_pe_split "+dict_to_cmd_opts(opts)
+               +" "+output_prefix+" "+input_bam)
+    else:
+        opts = { 'o': "" }
+        opts.update(kwargs)
+        sort_cmd = sort(input_bam, output_prefix, num_threads=num_threads,
+                        **opts).next()['actions'][0]
+        pe_split_cmd = "bam_pe_split "+output_prefix
+        cmd = (sort_cmd+" | "+pe_split_cmd)
 
     return { "name": "samtools.to_paired_fastq %s..."%(output_r1),
              "file_dep": [input_bam],
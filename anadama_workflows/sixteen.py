@@ -2,10 +2,12 @@ from __future__ import absolute_import
 """16S workflows"""
 
 import os
+import sys
 import glob
 import operator
 import itertools
 from os.path import join
+from collections import Counter
 
 
 from anadama.action import CmdAction, PythonAction
@@ -25,6 +27,9 @@ from . import (
     settings
 )
 
+# warn when fewer barcode reads than this match the map either way
+MIN_BARCODE_MATCH_PCT = 50
+
 def _reduce_to_glob(fnames):
     pref = os.path.commonprefix(fnames)
     suf = "".join(reversed(
@@ -129,6 +134,60 @@ def demultiplex(map_fname, fasta_fname, qual_fname, output_fname,
     }
 
 
+def _barcode_orientation(barcode_fnames, barcodes, map_fname):
+    """Match the first barcode reads against the map's barcodes both
+    ways round, printing how many match. Returns the orientation that
+    matches best, or None if it can't be told."""
+    from .utility_scripts import orient
+
+    total, forward, reverse = orient.barcode_matches(barcode_fnames,
+                                                     barcodes)
+    pct = lambda n: 100.*n/total if total else 0.
+    print >> sys.stderr, (
+        "Barcode reads matching %s: %d of %d (%.1f%%) forward,"
+        " %d (%.1f%%) reverse complemented"%(
+            map_fname, forward, total, pct(forward),
+            reverse, pct(reverse)))
+    if max(pct(forward), pct(reverse)) < MIN_BARCODE_MATCH_PCT:
+        print >> sys.stderr, (
+            "Warning: few barcode reads match %s; check that the"
+            " barcode files go with this map"%(map_fname))
+    return orient.decide(forward, reverse)
+
+
+def _determine_barcode_type(sample_group, use_most_common=False):
+    lengths = ( len(s.BarcodeSequence) for s in sample_group )
+    length_histogram = Counter(lengths)
+
+    if len(length_histogram) == 1 or use_most_common:
+        bcode_len = length_histogram.most_common(1)[0][0]
+        bcode_len = str(bcode_len)
+    else:
+        return "variable_length"
+
+    if bcode_len == "12":
+        bcode_len = "golay_12"
+
+    return bcode_len
+
+
+def _run_oriented(orientation, forward, reverse, **backup_kwargs):
+    """Run the ``forward`` action for ``"forward"`` reads, or the list
+    of ``reverse`` actions for ``"reverse"`` reads. If the orientation
+    is None, run ``forward``, falling back on ``reverse`` with
+    ``strategies.backup`` and ``backup_kwargs``."""
+    if orientation == "forward":
+        return forward.execute()
+    elif orientation == "reverse":
+        for action in reverse:
+            ret = action.execute()
+            if isinstance(ret, Exception):
+                return ret
+        return ret
+    return strategies.backup(
+        (forward, strategies.Group(*reverse)), **backup_kwargs)
+
+
 @requires(binaries=['split_libraries_fastq.py'],
           version_methods=["print_qiime_config.py "
                            "| awk '/QIIME library version/{print $NF;}'"])
@@ -143,15 +202,11 @@ def demultiplex_illumina(fastq_fnames, barcode_fnames, map_fname, output_fname,
         "o": output_dir
     }
     default_opts.update(qiime_opts)
-    opts = dict_to_cmd_opts(default_opts)
     
     cmd = "split_libraries_fastq.py "
 
     revcomp_map_fname = new_file(addtag(map_fname, "revcomp"),
                                  basedir=output_dir)
-    revcomp_opts = default_opts.copy()
-    revcomp_opts['m'] = revcomp_map_fname
-    revcomp_opts = dict_to_cmd_opts(revcomp_opts)
     def _revcomp():
         from anadama.util import deserialize_map_file, serialize_map_file
         from Bio.Seq import Seq
@@ -175,11 +230,22 @@ def demultiplex_illumina(fastq_fnames, barcode_fnames, map_fname, output_fname,
     )
 
     def run():
-        return strategies.backup(
-            (CmdAction(cmd+opts, verbose=verbose),
-             strategies.Group(
-                 PythonAction(_revcomp),
-                 CmdAction(cmd+revcomp_opts,verbose=verbose))),
+        from anadama.util import deserialize_map_file
+
+        with open(map_fname) as map_file:
+            samples = list(deserialize_map_file(map_file))
+        barcodes = [ s.BarcodeSequence for s in samples ]
+        run_opts = default_opts.copy()
+        if "barcode_type" not in qiime_opts:
+            run_opts["barcode_type"] = _determine_barcode_type(samples)
+        revcomp_opts = run_opts.copy()
+        revcomp_opts['m'] = revcomp_map_fname
+
+        return _run_oriented(
+            _barcode_orientation(barcode_fnames, barcodes, map_fname),
+            CmdAction(cmd+dict_to_cmd_opts(run_opts), verbose=verbose),
+            [PythonAction(_revcomp),
+             CmdAction(cmd+dict_to_cmd_opts(revcomp_opts), verbose=verbose)],
             extra_conditions=[output_exists]
         )
 
@@ -199,6 +265,153 @@ def demultiplex_illumina(fastq_fnames, barcode_fnames, map_fname, output_fname,
 
 
 
+# split_libraries_fastq.py options understood by
+# demultiplex_illumina_native, by short and long name
+native_demux_opts = {
+    "barcode_type": "barcode_type",
+    "max_barcode_errors": "max_barcode_errors",
+    "q": "phred_quality_threshold",
+    "phred_quality_threshold": "phred_quality_threshold",
+    "r": "max_bad_run_length",
+    "max_bad_run_length": "max_bad_run_length",
+    "p": "min_per_read_length_fraction",
+    "min_per_read_length_fraction": "min_per_read_length_fraction",
+    "n": "sequence_max_n",
+    "sequence_max_n": "sequence_max_n",
+    "s": "start_seq_id",
+    "start_seq_id": "start_seq_id",
+    "phred_offset": "phred_offset",
+    "rev_comp": "rev_comp",
+    "rev_comp_barcode": "rev_comp_barcode",
+    "rev_comp_mapping_barcodes": "rev_comp_mapping_barcodes",
+}
+
+_native_demux_types = dict(
+    max_barcode_errors=float, phred_quality_threshold=int,
+    max_bad_run_length=int, min_per_read_length_fraction=float,
+    sequence_max_n=int, start_seq_id=int, phred_offset=int,
+    rev_comp=bool, rev_comp_barcode=bool, rev_comp_mapping_barcodes=bool,
+    barcode_type=str
+)
+
+
+def demultiplex_illumina_native(fastq_fnames, barcode_fnames, map_fnames,
+                                output_fnames, jobs=1, qiime_opts={},
+                                correct_non_golay=False):
+    """Workflow to demultiplex Illumina reads without QIIME. Each
+    sequence fastq file is read alongside its barcode fastq file, and
+    reads are quality filtered and labelled the same way
+    split_libraries_fastq.py does it, but the work is split over
+    several processes, and reads can go straight to one file per
+    sample.
+
+    :param fastq_fnames: List of strings; sequence fastq files
+    :param barcode_fnames: List of strings; barcode fastq files, one
+                           for each sequence file
+    :param map_fnames: String or list of strings; qiime map.txt with
+                       the samples and barcodes in each sequence file
+    :param output_fnames: String or dict; fasta file for all reads,
+                          or fasta file name by sample ID
+    :keyword jobs: Int; match and filter reads in this many processes
+    :keyword qiime_opts: Dictionary; split_libraries_fastq.py options,
+                         by short or long name. Understood options are
+                         in ``native_demux_opts``. Unless
+                         ``rev_comp_mapping_barcodes`` is given, the
+                         barcode orientation is worked out from the
+                         first barcode reads.
+    :keyword correct_non_golay: Boolean; correct up to
+                                ``max_barcode_errors`` mismatches in
+                                barcodes that aren't golay_12. QIIME
+                                only matches those exactly, so this
+                                is off by default.
+
+    """
+    if type(map_fnames) is str:
+        map_fnames = [map_fnames] * len(fastq_fnames)
+    unknown_opts = set(qiime_opts) - set(native_demux_opts)
+    if unknown_opts:
+        raise ValueError("demultiplex_illumina_native doesn't understand"
+                         " these options: "+", ".join(sorted(unknown_opts)))
+    opts = dict()
+    for key, value in qiime_opts.iteritems():
+        name = native_demux_opts[key]
+        if _native_demux_types[name] is bool:
+            opts[name] = value in (True, "", "True", "true", 1)
+        else:
+            opts[name] = _native_demux_types[name](value)
+    if type(output_fnames) is str:
+        targets = [output_fnames]
+    else:
+        targets = sorted(set(output_fnames.itervalues()))
+
+    def _run():
+        from anadama.util import deserialize_map_file
+        from .utility_scripts import demux, records
+
+        run_opts = opts.copy()
+        flip = run_opts.pop("rev_comp_mapping_barcodes", None)
+        barcodes, samples, mapped = list(), list(), list()
+        for bcode_fname, map_fname in zip(barcode_fnames, map_fnames):
+            with open(map_fname) as map_file:
+                group = list(deserialize_map_file(map_file))
+            mapped.extend(group)
+            lane = dict( (s.BarcodeSequence, s[0]) for s in group )
+            orientation = "reverse" if flip else "forward"
+            if flip is None:
+                orientation = _barcode_orientation(
+                    [bcode_fname], lane.keys(), map_fname) or "forward"
+            if orientation == "reverse":
+                lane = dict( (records.reverse_complement(b), s)
+                             for b, s in lane.iteritems() )
+            barcodes.append(lane)
+            for sample in group:
+                if sample[0] not in samples:
+                    samples.append(sample[0])
+        if "barcode_type" not in run_opts:
+            run_opts["barcode_type"] = _determine_barcode_type(mapped)
+
+        outputs = output_fnames
+        if type(outputs) is str:
+            outputs = dict( (s, output_fnames) for s in samples )
+        counts = demux.demultiplex_illumina(
+            zip(fastq_fnames, barcode_fnames), barcodes, outputs,
+            jobs=jobs, correct_non_golay=correct_non_golay, **run_opts)
+        for s_id in sorted(counts['written']):
+            print >> sys.stderr, "%s\t%i" %(s_id, counts['written'][s_id])
+        print >> sys.stderr, (
+            "Read %(reads)i reads: %(no_barcode)i matched no barcode,"
+            " %(low_quality)i failed the quality filter and %(unknown)i"
+            " were from samples without an output file"%(counts))
+
+    return {
+        "name": "demultiplex_illumina_native:"+targets[0],
+        "actions": [_run],
+        "file_dep": (list(fastq_fnames) + list(barcode_fnames)
+                     + sorted(set(map_fnames))),
+        "targets": targets,
+        "title": lambda t: t.name+" Estimated time=%.2f"%(
+            sum(os.stat(f).st_size for f in t.file_dep)/1024./1024/20)
+    }
+
+
+def _pick_oriented(input_fname, reference_fname, forward, reverse,
+                   output_fname):
+    """Run the ``forward`` action on reads that run the same way as
+    the reference sequences, or the list of ``reverse`` actions on
+    reads that are reverse complemented. If the orientation can't be
+    told from a sample of the reads, run ``forward``, then ``reverse``
+    if that makes an empty ``output_fname``."""
+    from .utility_scripts import orient
+
+    return _run_oriented(
+        orient.orientation(input_fname, reference_fname), forward, reverse,
+        extra_conditions = [ 
+            lambda ret, output_fname: os.stat(output_fname).st_size == 0
+        ],
+        output_fname=output_fname,
+    )
+
+
 @requires(binaries=['pick_closed_reference_otus.py', 'sequence_convert'])
 def pick_otus_closed_ref(input_fname, output_dir, verbose=None, qiime_opts={}):
     """Workflow to perform OTU picking, generates a biom-formatted OTU
@@ -259,15 +472,12 @@ def pick_otus_closed_ref(input_fname, output_dir, verbose=None, qiime_opts={}):
                    " > "+revcomp_fname)
 
     def run(targets):
-        strategies.backup(
-            (CmdAction(cmd.format(input_fname),verbose=verbose),
-             strategies.Group(
-                 CmdAction(revcomp_cmd),
-                 CmdAction(cmd.format(revcomp_fname),verbose=verbose))),
-            extra_conditions = [ 
-                lambda ret, output_fname: os.stat(output_fname).st_size == 0
-            ],
-            output_fname=output_fname,
+        return _pick_oriented(
+            input_fname, default_opts["reference_fp"],
+            CmdAction(cmd.format(input_fname),verbose=verbose),
+            [CmdAction(revcomp_cmd),
+             CmdAction(cmd.format(revcomp_fname),verbose=verbose)],
+            output_fname
         )
              
     return {
@@ -359,15 +569,12 @@ def pick_otus_open_ref(input_fname, output_dir, verbose=None, qiime_opts={}):
                    " > "+revcomp_fname)
 
     def run(targets):
-        strategies.backup(
-            (CmdAction(cmd.format(input_fname),verbose=verbose),
-             strategies.Group(
-                 CmdAction(revcomp_cmd),
-                 CmdAction(cmd.format(revcomp_fname),verbose=verbose))),
-            extra_conditions = [ 
-                lambda ret, output_fname: os.stat(output_fname).st_size == 0
-            ],
-            output_fname=output_fname
+        return _pick_oriented(
+            input_fname, default_opts["reference_fp"],
+            CmdAction(cmd.format(input_fname),verbose=verbose),
+            [CmdAction(revcomp_cmd),
+             CmdAction(cmd.format(revcomp_fname),verbose=verbose)],
+            output_fname
         )
 
     return {
@@ -378,8 +585,7 @@ def pick_otus_open_ref(input_fname, output_dir, verbose=None, qiime_opts={}):
     }
 
 
-@requires(binaries=['merge_otu_tables.py'])
-def merge_otu_tables(files_list, name):
+def merge_otu_tables(files_list, name, jobs=1, native=True):
     """Workflow to merge OTU tables into a single OTU table. Also accepts
     biom-formatted OTU tables. This workflow will skip otu tables with
     a file size of zero at runtime.
@@ -387,15 +593,32 @@ def merge_otu_tables(files_list, name):
     :param files_list: List of strings; A list of file paths to the input 
                        OTU tables to be merged
     :param name: String; The file name of the merged OTU table
+    :keyword jobs: Int; read and merge batches of tables in this many
+                   processes
+    :keyword native: Boolean; merge the biom tables' nonzero entries
+                     in-process, keeping OTU and sample metadata. Set
+                     to False to use qiime's merge_otu_tables.py
+                     instead.
 
     External dependencies:
-      - Qiime 1.8.0: https://github.com/qiime/qiime-deploy
+      - Qiime 1.8.0: https://github.com/qiime/qiime-deploy (only if
+        ``native`` is False)
+      - h5py: http://www.h5py.org/ (only to merge hdf5 biom files
+        natively)
 
     """
     
     def merge_filter(deps,targets):
         files = [file for file in deps
                  if os.path.exists(file) and os.stat(file).st_size > 0]
+        if native:
+            from .utility_scripts import biomtable
+            n_otus, n_samples, nnz = biomtable.merge_files(
+                files, name, jobs=jobs)
+            print >> sys.stderr, (
+                "Merged %d tables: %d OTUs, %d samples, %d nonzero"%(
+                    len(files), n_otus, n_samples, nnz))
+            return
         pat = _reduce_to_glob(files)
         if list(sorted(glob.glob(pat))) == list(sorted(files)):
             inputs = pat
@@ -414,6 +637,31 @@ def merge_otu_tables(files_list, name):
     }
 
 
+def _picrust_cmds(all_opts, norm_out, predict_out):
+    cmd1 = ("normalize_by_copy_number.py "
+            + "-i %s"
+            + " -o " + norm_out)
+    if all_opts['gg_version']:
+        cmd1 += " -g " + all_opts['gg_version']
+    if all_opts['tab_in']:
+        cmd1 += " -f"
+
+    cmd2 = ("predict_metagenomes.py "
+            + "-i %s"
+            + " -o " + predict_out)
+    if all_opts['gg_version']:
+        cmd2 += " -g " + all_opts['gg_version']
+    if all_opts['tab_out']:
+        cmd2 += " -f"
+    if all_opts['t']:
+        cmd2 += " -t " + all_opts['t']
+    if all_opts['with_confidence']:
+        cmd2 += " --with_confidence"
+    if all_opts['custom']:
+        cmd2 += " -c " + all_opts['custom']
+    return cmd1, cmd2
+
+
 @requires(binaries=['normalize_by_copy_number.py', 'predict_metagenomes.py',
                     'biom'],
           version_methods=["print_picrust_config.py "
@@ -452,53 +700,16 @@ def picrust(file, output_dir=None, verbose=True, **opts):
 
     _copy_fname = settings.workflows.picrust.copy_number
     def _drop_unknown():
-        import os
-        import gzip
-        import json
-        from biom.table import DenseOTUTable
-        from biom.parse import (
-            OBS_META_TYPES,
-            parse_biom_table,
-            parse_classic_table_to_rich_table
-        )
-        idx = set([ row.strip().split('\t')[0]
-                    for row in gzip.open(_copy_fname) ])
-        filter_func = lambda a, otu_id, c: str(otu_id) in idx
+        from .utility_scripts import copynumber
+        if os.stat(file).st_size < 1:
+            return True
         tmpfile = file+"_tmp.biom"
-        with open(file) as f, open(tmpfile, 'w') as f_out:
-            try:
-                table = parse_biom_table(f)
-            except Exception as e:
-                table = parse_classic_table_to_rich_table(
-                    f, None, None, OBS_META_TYPES['taxonomy'], DenseOTUTable)
-            table = table.filterObservations(filter_func)
-            json.dump( table.getBiomFormatObject("AnADAMA"), f_out )
+        copynumber.drop_unknown(file, _copy_fname, tmpfile)
         os.rename(file, addtag(file, "unfiltered"))
         os.rename(tmpfile, file)
 
 
-    cmd1 = ("normalize_by_copy_number.py "
-            + "-i %s"
-            + " -o " + norm_out)
-    if all_opts['gg_version']:
-        cmd1 += " -g " + all_opts['gg_version']
-    if all_opts['tab_in']:
-        cmd1 += " -f"
-
-    cmd2 = ("predict_metagenomes.py "
-            + "-i %s"
-            + " -o " + predict_out)
-    if all_opts['gg_version']:
-        cmd2 += " -g " + all_opts['gg_version']
-    if all_opts['tab_out']:
-        cmd2 += " -f"
-    if all_opts['t']:
-        cmd2 += " -t " + all_opts['t']
-    if all_opts['with_confidence']:
-        cmd2 += " --with_confidence"
-    if all_opts['custom']:
-        cmd2 += " -c " + all_opts['custom']
-
+    cmd1, cmd2 = _picrust_cmds(all_opts, norm_out, predict_out)
 
     converted = addtag(file, "json")
     format_cmd = CmdAction('biom convert --table-type="OTU table"'
@@ -541,3 +752,145 @@ def picrust(file, output_dir=None, verbose=True, **opts):
         title = _rusage,
     )
 
+
+@requires(binaries=['normalize_by_copy_number.py', 'predict_metagenomes.py'],
+          version_methods=["print_picrust_config.py "
+                           "| awk '/PICRUSt version/{print $NF;}'"])
+def picrust_batch(files, merged_fname, output_dir=None, verbose=True,
+                  **opts):
+    """Workflow to predict metagenome functional content from many 16S
+    OTU tables with one run of PICRUSt. The tables are merged into
+    ``merged_fname``, normalized and predicted together, so PICRUSt
+    loads its precalculated trait tables only once; the normalized
+    tables and predictions are then split back into the same files
+    :py:func:`picrust` writes for each table.
+
+    Samples keep their own columns in the merged table even if two
+    tables use the same sample ID. Unlike :py:func:`picrust`, OTUs
+    without a copy number are dropped from the merged table, and the
+    input tables are left as they are.
+
+    :param files: List of strings; input OTU tables, biom or classic.
+    :param merged_fname: String; file name for the merged OTU table.
+                         PICRUSt's outputs for it are written next to it.
+    :keyword tab_out: Boolean; True if the predictions are to be
+                      tabulated (default:False)
+    :keyword gg_version: String; the greengenes version to be used
+                         (default:most recent version)
+    :keyword t: String; option to use a different type of prediction
+                   (default:KO)
+    :keyword custom: String; specify a file containing a custom trait to 
+                     predict metagenomes
+
+    External Dependencies:
+      - PICRUSt: Version 1.0.0, 
+        http://picrust.github.io/picrust/install.html#install
+
+    """
+    norm_outs = [ new_file(addtag(f, "normalized_otus"), basedir=output_dir)
+                  for f in files ]
+    predict_outs = [ new_file(addtag(f, "picrust"), basedir=output_dir)
+                     for f in files ]
+    merged_norm = addtag(merged_fname, "normalized_otus")
+    merged_predict = addtag(merged_fname, "picrust")
+
+    all_opts = { 'tab_in'          : 0,  'tab_out' : 0,
+                 'gg_version'      : '', 't'       : '', 
+                 'with_confidence' : 0,  'custom'  : '',
+                 'drop_unknown'    : True}
+    all_opts.update(opts)
+    drop_unknown = all_opts.pop("drop_unknown", True)
+    tab_out = all_opts['tab_out']
+    if all_opts['with_confidence']:
+        raise ValueError("picrust_batch can't split confidence intervals;"
+                         " use picrust for each table instead")
+    # PICRUSt reads and writes json biom; predictions are tabulated
+    # after they're split up
+    cmd1, cmd2 = _picrust_cmds(dict(all_opts, tab_in=0, tab_out=0),
+                               merged_norm, merged_predict)
+    _copy_fname = settings.workflows.picrust.copy_number
+
+    def _metadata_name(table):
+        keys = next(( m.keys() for m in table.otu_metadata if m ), [])
+        described = [ k for k in keys if "Description" in k ]
+        return (described or keys or [None])[0]
+
+    # merged sample ID -> index of its table and its own sample ID
+    origin = dict()
+    # OTU IDs in each table, or None for empty tables
+    otu_ids = list()
+
+    def _split(table, out_fnames, same_otus, tabulated):
+        from .utility_scripts import biomtable
+        columns = [ list() for _ in files ]
+        sample_ids = [ list() for _ in files ]
+        for j, merged_id in enumerate(table.sample_ids):
+            i, sample_id = origin[merged_id]
+            columns[i].append(j)
+            sample_ids[i].append(sample_id)
+        header_key = _metadata_name(table) if tabulated else None
+        for i, out_fname in enumerate(out_fnames):
+            if otu_ids[i] is None:
+                open(out_fname, 'w').close()
+                continue
+            rows = [ k for k, otu_id in enumerate(table.otu_ids)
+                     if not same_otus or str(otu_id) in otu_ids[i] ]
+            part = biomtable.subset(table, rows, columns[i])
+            part = part._replace(sample_ids=sample_ids[i])
+            with open(out_fname, 'w') as out_f:
+                if tabulated:
+                    biomtable.write_classic(part, out_f, header_key)
+                else:
+                    biomtable.write_table(part, out_f,
+                                          generated_by="AnADAMA")
+
+    def run():
+        from .utility_scripts import biomtable, copynumber
+        merger = biomtable.Merger()
+        origin.clear()
+        del otu_ids[:]
+        for i, fname in enumerate(files):
+            if os.stat(fname).st_size < 1:
+                otu_ids.append(None)
+                continue
+            table = biomtable.read(fname)
+            merged_ids = [ "%d_%s"%(i, s) for s in table.sample_ids ]
+            origin.update( (m, (i, s))
+                           for m, s in zip(merged_ids, table.sample_ids) )
+            otu_ids.append(set( str(o) for o in table.otu_ids ))
+            merger.add(table._replace(sample_ids=merged_ids))
+        merged = merger.table()
+        if drop_unknown:
+            merged = biomtable.filter_otus(merged,
+                                           copynumber.otu_ids(_copy_fname))
+        with open(merged_fname, 'w') as out_f:
+            biomtable.write_table(merged, out_f, generated_by="AnADAMA")
+        if not merged.sample_ids:
+            for fname in [merged_norm, merged_predict]+norm_outs+predict_outs:
+                open(fname, 'w').close()
+            return True
+
+        for cmd in (cmd1%(merged_fname), cmd2%(merged_norm)):
+            ret = CmdAction(cmd, verbose=verbose).execute()
+            if ret is not None and issubclass(type(ret), Exception):
+                return ret
+        _split(biomtable.read(merged_norm), norm_outs, True, False)
+        _split(biomtable.read(merged_predict), predict_outs, False, tab_out)
+
+    def _rusage(task):
+        msg = task.name+" Estimated mem={mem} time={time} threads=1"
+        s = sum( os.stat(f).st_size for f in task.file_dep )
+        return msg.format(
+            mem=100+(s/1024.),
+            time=100+(s*2.5e-4)
+        )
+
+    return dict(
+        name = "picrust_batch:"+merged_predict,
+        actions = [run],
+        file_dep = files,
+        targets = predict_outs + norm_outs + [merged_fname, merged_norm,
+                                              merged_predict],
+        title = _rusage,
+    )
+
@@ -1,3 +1,4 @@
+import pipes
 import mimetypes
 
 def cat(infiles_list, guess_from=None):
@@ -13,4 +14,20 @@ def cat(infiles_list, guess_from=None):
     # if it's completely unrecognized, just return cat
     return "cat " + " ".join(infiles_list)
 
-            
+
+def stream(fname):
+    """Return a bash process substitution that decompresses ``fname``
+    as it's read, or just ``fname`` if it's not compressed. Commands
+    that use it must be run with :py:func:`bash`."""
+    maj_file_type, min_file_type = mimetypes.guess_type(fname)
+    if min_file_type == 'gzip':
+        return "<(zcat " + fname + ")"
+    elif min_file_type == 'bzip2':
+        return "<(bzcat " + fname + ")"
+
+    return fname
+
+
+def bash(cmd):
+    """Wrap ``cmd`` so that it's run by bash instead of /bin/sh"""
+    return "bash -c " + pipes.quote(cmd)
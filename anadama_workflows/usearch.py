@@ -1,4 +1,6 @@
 import os
+import json
+import mmap
 from os.path import join
 from itertools import imap
 from collections import Counter
@@ -10,7 +12,12 @@ from anadama.decorators import requires
 from anadama.strategies import if_exists_run
 from anadama.util import addtag, rmext, dict_to_cmd_opts
 
-from . import settings
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import settings, starters
 from .sixteen import assign_taxonomy
 
 snd = itemgetter(1)
@@ -39,33 +46,131 @@ from operator import itemgetter
 
 snd = itemgetter(1)
 
+# bytes of a fasta file scanned at a time for sequence lengths
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
 
 class util:
     @staticmethod
     def fasta_sequences(seqs_f):
-        id = None
-        lines = iter(seqs_f)
-        line = next(lines).strip()
-        while True:
+        id, seq = None, list()
+        for line in seqs_f:
+            line = line.strip()
             if line.startswith(">"):
-                id = line.split(None, 1)[0]
-                id = id.replace(">", "")
-                line = next(lines).strip()
-            else:
-                seq = str()
-                while not line.startswith(">"):
-                    seq += line
-                    line = next(lines).strip()
-                yield (id, seq)
-                id, seq = str(), str()
+                if seq:
+                    yield (id, "".join(seq))
+                id = line.split(None, 1)[0].replace(">", "")
+                seq = list()
+            elif id is not None and line:
+                seq.append(line)
+        if seq:
+            yield (id, "".join(seq))
+
+
+    @staticmethod
+    def read_lengths(fname, block_size=SCAN_BLOCK_SIZE):
+        """Get the length of every sequence in fasta file ``fname`` as
+        a numpy array, scanning a memory map of the file
+        ``block_size`` bytes at a time"""
+        size = os.path.getsize(fname)
+        if not size:
+            return np.zeros(0, dtype=np.int64)
+        lengths, current = list(), None
+        with open(fname, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = 0
+                while start < size:
+                    end = min(start+block_size, size)
+                    if end < size:
+                        # end blocks on a whole line
+                        nl = mm.rfind(b"\n", start, end)
+                        if nl < 0:
+                            nl = mm.find(b"\n", end)
+                        end = nl+1 if nl >= 0 else size
+                    blk = np.frombuffer(mm[start:end], dtype=np.uint8)
+                    lens, current = util._block_lengths(blk, current)
+                    lengths.append(lens)
+                    start = end
+            finally:
+                mm.close()
+        if current is not None:
+            lengths.append(np.array([current], dtype=np.int64))
+        return np.concatenate(lengths)
+
+
+    @staticmethod
+    def _block_lengths(blk, current):
+        """Sequence lengths of the records that end in block ``blk``
+        of whole lines, and the length so far of the record still
+        going at the end of the block. ``current`` is the length so
+        far of the record going at the start of the block, or None
+        before the first record."""
+        newlines = np.flatnonzero(blk == ord("\n"))
+        starts = np.concatenate(([0], newlines+1))
+        ends = np.concatenate((newlines, [len(blk)]))
+        if starts[-1] == len(blk):
+            starts, ends = starts[:-1], ends[:-1]
+        # other whitespace is rare, so count it by where it is
+        space = np.flatnonzero((blk == ord(" ")) | (blk == ord("\r"))
+                               | (blk == ord("\t")) | (blk == ord("\v"))
+                               | (blk == ord("\f")))
+        line_lens = ends - starts
+        if len(space):
+            line_of = np.searchsorted(starts, space, side="right") - 1
+            line_lens -= np.bincount(line_of, minlength=len(starts))
+        is_header = blk[starts] == ord(">")
+        line_lens[is_header] = 0
+        # which record each line belongs to; 0 is the record going
+        # at the start of the block
+        rec_idx = np.cumsum(is_header)
+        rec_lens = np.bincount(rec_idx, weights=line_lens,
+                               minlength=rec_idx[-1]+1).astype(np.int64)
+        if current is not None:
+            rec_lens[0] += current
+            done = rec_lens[:-1]
+        else:
+            done = rec_lens[1:-1]
+        if rec_idx[-1] == 0 and current is None:
+            return done, None
+        return done, rec_lens[-1]
 
 
     @staticmethod
     def hist(fname):
-        with open(fname) as f:
-            seqs = util.fasta_sequences(f)
-            cnts = Counter( imap(len, imap(snd, seqs)) )
-        return sorted(cnts.iteritems(), reverse=True)
+        """Count sequences of each length in fasta file ``fname``.
+        Returns a list of (length, count) tuples, longest first. The
+        counts are kept in a ``.lengths.json`` file next to
+        ``fname``, and are reused until ``fname`` changes."""
+        cache_fname = fname+".lengths.json"
+        stat = os.stat(fname)
+        key = dict(path=os.path.abspath(fname), size=stat.st_size,
+                   mtime=stat.st_mtime)
+        try:
+            with open(cache_fname) as f:
+                cache = json.load(f)
+            if cache["key"] == key:
+                return [ tuple(item) for item in cache["hist"] ]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        if np is not None:
+            cnts = np.bincount(util.read_lengths(fname))
+            # empty sequences aren't counted
+            lens = np.flatnonzero(cnts[1:])[::-1] + 1
+            h = zip(lens.tolist(), cnts[lens].tolist())
+        else:
+            with open(fname) as f:
+                seqs = util.fasta_sequences(f)
+                cnts = Counter( imap(len, imap(snd, seqs)) )
+            h = sorted(cnts.iteritems(), reverse=True)
+
+        try:
+            with open(cache_fname, 'w') as f:
+                json.dump(dict(key=key, hist=h), f)
+        except IOError:
+            pass
+        return h
 
 
     @staticmethod
@@ -186,7 +291,8 @@ def filter(input_fastq, output_fasta, verbose=True, do_mangle=False,
            mangle_to=None, **opts):
     """Filter a fastq file, outputting sequences as fasta, using USEARCH
     version 7. The USEARCH binary should be named usearch7 in order
-    for this workflow to operate.
+    for this workflow to operate. A compressed ``input_fastq`` is
+    decompressed as it's read.
 
     :param input_fastq: String; file name of a single fastq file to be filtered.
     :param output_fasta: String; name of resulting filtered fasta file
@@ -226,8 +332,9 @@ def filter(input_fastq, output_fasta, verbose=True, do_mangle=False,
                   verbose=verbose).execute()
         
 
+    streamed_input = starters.stream(input_fastq)
     cmd = ("usearch7"+
-           " -fastq_filter "+input_fastq+
+           " -fastq_filter "+streamed_input+
            " -fastaout "+output_fasta)
 
     default_options = {
@@ -237,6 +344,8 @@ def filter(input_fastq, output_fasta, verbose=True, do_mangle=False,
     default_options.update(opts)
 
     cmd += usearch_dict_flags(default_options)
+    if streamed_input != input_fastq:
+        cmd = starters.bash(cmd)
 
     def run():
         if os.stat(input_fastq).st_size > 1:
@@ -285,11 +394,12 @@ def truncate(fastx_in, fasta_out=None, fastq_out=None, **opts):
                            "pip freeze | fgrep anadama_workflows"])
 def pick_denovo_otus(fasta_in, otutab_out, keep_tempfiles=False,
                      strand="plus", log_file=None, resume=False,
-                     quiet=False, chimera_standard=None,
+                     quiet=False, chimera_standard=None, jobs=1,
                      truncate_opts={}, derep_opts={}, sort_opts={},
                      cluster_opts={}, chimera_opts={}, map_opts={}):
 
-    opts = dict(input=fasta_in, output=otutab_out, print_cmd=True)
+    opts = dict(input=fasta_in, output=otutab_out, print_cmd=True,
+                jobs=jobs)
     if 'db' in chimera_opts:
         s = chimera_opts['db']
     elif bool(chimera_standard) is True:
@@ -335,7 +445,7 @@ def pick_denovo_otus(fasta_in, otutab_out, keep_tempfiles=False,
              "title"   : usearch_rusage([fasta_in]) }
 
 
-@requires(binaries=["usearch8", "biom"])
+@requires(binaries=["usearch8"])
 def pick_otus_closed_ref(in_fasta, out_biom, out_tsv=None,
                          non_chimeric_otu_seqs=None,
                          denovo_otu_txt=None,
@@ -344,7 +454,7 @@ def pick_otus_closed_ref(in_fasta, out_biom, out_tsv=None,
                          keep_tempfiles=False, strand='plus',
                          chimera_standard=None, log_file=None,
                          resume=False, quiet=False, tmp_folder=None,
-                         usearch_closed_opts={}, denovo_opts={}):
+                         jobs=1, usearch_closed_opts={}, denovo_opts={}):
     
     if not tmp_folder:
         tmp_folder = in_fasta+"_usearch"
@@ -372,7 +482,7 @@ def pick_otus_closed_ref(in_fasta, out_biom, out_tsv=None,
                 quiet=quiet, print_cmd=True, log_file=log_file,
                 denovo_otu_table=denovo_otu_txt, resume=resume,
                 keep_tempfiles=True, tmp_dir=tmp_folder,
-                otu_sequences=non_chimeric_otu_seqs)
+                otu_sequences=non_chimeric_otu_seqs, jobs=jobs)
 
     kvopts = list(denovo_opts.items())+[("closed_opts",usearch_closed_opts)]
     for name, value in kvopts:
@@ -382,17 +492,11 @@ def pick_otus_closed_ref(in_fasta, out_biom, out_tsv=None,
 
     usearch_cmd = "uclust_closed_otus "+dict_to_cmd_opts(opts)
 
-    biom_cmd = ("biom convert -i "+out_tsv+" -o "+out_biom+
-                " --table-type='OTU Table' --process-obs-metadata=taxonomy"+
-                " --output-metadata-id=taxonomy")
-
-    if sample_metadata_fname:
-        biom_cmd += " --sample-metadata-fp=" + sample_metadata_fname
-
     def _run():
         ret = CmdAction(usearch_cmd).execute()
         if ret is None or not issubclass(type(ret), Exception):
-            ret = CmdAction(biom_cmd).execute()
+            from .utility_scripts import biomtable
+            biomtable.from_tsv(out_tsv, out_biom, sample_metadata_fname)
             if not keep_tempfiles:
                 for f in os.listdir(opts['tmp_dir']):
                     if f != "nonchimeric.fa" and \
@@ -1,18 +1,27 @@
+import os
 import sys
+import shutil
+import zlib
 import optparse
 import logging
+import tempfile
+from collections import OrderedDict
 
 import pysam
-from Bio import SeqIO, Seq, SeqRecord
 
-HELP = """ %prog <output_prefix>
+from . import records
+
+HELP = """ %prog [options] <output_prefix> [<input.bam>]
 
 %prog - Split from a sorted-by-name bam file (via stdin) three fastq
-files: forward reads, reverse reads, and single-end reads.
+files: forward reads, reverse reads, and single-end reads. With
+--collate, the bam file can be in any order, e.g. sorted by
+coordinate.
 
 <output_prefix> - file name prefix of the three resulting fastq files.
                   Resultant files are named output_prefix.r1.fastq,
                   output_prefix.r2.fastq, and output_prefix.single.fastq 
+<input.bam>     - read from this bam file instead of stdin
 """
 
 opts_list = [
@@ -20,33 +29,55 @@ opts_list = [
                          dest="logging", default="INFO",
                          help="Logging verbosity, options are debug, info,"
                          " warning, and critical"),
+    optparse.make_option('-c', '--collate', action="store_true",
+                         dest="collate", default=False,
+                         help="Match mates by read name instead of relying"
+                         " on the bam file being sorted by name."
+                         " Secondary and supplementary alignments are"
+                         " skipped, and reads whose mate is missing are"
+                         " written to the single-end file"),
+    optparse.make_option('-b', '--buffer', action="store", type="int",
+                         dest="buffer", default=1000000,
+                         help="With --collate, hold at most this many reads"
+                         " waiting for their mate in memory. Reads that"
+                         " wait longer are set aside on disk."
+                         " Default 1000000"),
+    optparse.make_option('-n', '--buckets', action="store", type="int",
+                         dest="buckets", default=64,
+                         help="With --collate, split reads set aside on"
+                         " disk into this many files. Default 64"),
+    optparse.make_option('-T', '--temp_dir', action="store", type="string",
+                         dest="temp_dir", default=None,
+                         help="With --collate, set reads aside here."
+                         " Defaults to the system temp directory"),
+    optparse.make_option('-@', '--threads', action="store", type="int",
+                         dest="threads", default=1,
+                         help="Decompress the bam file with this many"
+                         " threads. Default 1"),
 ]
 
 def handle_cli():
     parser = optparse.OptionParser(option_list=opts_list, usage=HELP)
     opts, args = parser.parse_args()
-    if len(args) > 1:
+    if not args or len(args) > 2:
         parser.print_usage()
         sys.exit(1)
-    return opts, args[0]
+    return opts, args[0], (args[1:] or ["-"])[0]
 
 
 
-def _write(bam_seq, f):
-    seq = Seq.Seq(bam_seq.seq)
-    qual = [ ord(x)-33 for x in bam_seq.qual ]
+def _fields(bam_seq):
+    seq = bam_seq.seq
     if bam_seq.is_reverse:
-        seq = seq.reverse_complement()
+        seq = records.reverse_complement(seq)
+    return bam_seq.qname, seq, bam_seq.qual
 
-    record = SeqRecord.SeqRecord(
-        seq, bam_seq.qname, "", "",
-        letter_annotations={"phred_quality": qual}
-    )
-    SeqIO.write(record, f, "fastq")
 
+def _write(bam_seq, writer):
+    writer.write(records.Record(*_fields(bam_seq)))
 
-def output(sequences, r1_file, r2_file, se_file):
 
+def _logger():
     if logging.getLogger().isEnabledFor(logging.DEBUG):
         def log(i):
             if i % 1000 == 0 and i != 0:
@@ -54,28 +85,147 @@ def output(sequences, r1_file, r2_file, se_file):
     else:
         def log(i):
             pass
+    return log
+
 
-    for i, seq in enumerate(sequences):
-        if not seq.is_paired:
-            _write(seq, se_file)
-        elif seq.is_read1:
-            _write(seq, r1_file)
-        elif seq.is_read2:
-            _write(seq, r2_file)
-        log(i)
+def output(sequences, r1_file, r2_file, se_file):
+
+    log = _logger()
+
+    with records.Writer(r1_file, "fastq") as r1_writer, \
+         records.Writer(r2_file, "fastq") as r2_writer, \
+         records.Writer(se_file, "fastq") as se_writer:
+        for i, seq in enumerate(sequences):
+            if not seq.is_paired:
+                _write(seq, se_writer)
+            elif seq.is_read1:
+                _write(seq, r1_writer)
+            elif seq.is_read2:
+                _write(seq, r2_writer)
+            log(i)
+
+
+def _bucket_of(qname, n_buckets):
+    return (zlib.crc32(qname) & 0xffffffff) % n_buckets
+
+
+def _write_mates(fields, mate, r1_writer, r2_writer):
+    if fields[0]:
+        fields, mate = mate, fields
+    r1_writer.write(records.Record(*mate[1:]))
+    r2_writer.write(records.Record(*fields[1:]))
+
+
+def collate(sequences, r1_file, r2_file, se_file, buffer_size=1000000,
+            n_buckets=64, temp_dir=None):
+    """Split reads in any order into forward, reverse and single-end
+    fastq files, writing mates in the same order in the forward and
+    reverse files.
+
+    Reads wait for their mate in a buffer keyed by read name. Once
+    ``buffer_size`` reads are waiting, the read that's waited longest
+    is set aside in one of ``n_buckets`` files on disk, picked by
+    read name. At the end, reads still waiting are set aside too, and
+    mates are matched up one bucket at a time. Reads without a mate
+    go to the single-end file.
+
+    Returns a dict of counts of reads: ``pairs``, ``single``,
+    ``orphans``, ``set_aside``, and ``skipped`` secondary or
+    supplementary alignments.
+
+    """
+    log = _logger()
+    counts = dict(pairs=0, single=0, orphans=0, set_aside=0, skipped=0)
+    waiting = OrderedDict()
+    workdir = tempfile.mkdtemp(prefix="bam_pe_split", dir=temp_dir)
+    try:
+        buckets = records.Buckets([ os.path.join(workdir, str(i))
+                                    for i in range(n_buckets) ])
+        def _set_aside(qname, fields):
+            buckets.add(_bucket_of(qname, n_buckets), fields)
+            counts["set_aside"] += 1
+
+        with records.Writer(r1_file, "fastq") as r1_writer, \
+             records.Writer(r2_file, "fastq") as r2_writer, \
+             records.Writer(se_file, "fastq") as se_writer:
+            for i, seq in enumerate(sequences):
+                log(i)
+                if seq.is_secondary or seq.flag & 0x800:
+                    counts["skipped"] += 1
+                    continue
+                if not seq.is_paired:
+                    _write(seq, se_writer)
+                    counts["single"] += 1
+                    continue
+                fields = (seq.is_read1,) + _fields(seq)
+                mate = waiting.pop(seq.qname, None)
+                if mate is not None:
+                    _write_mates(fields, mate, r1_writer, r2_writer)
+                    counts["pairs"] += 1
+                    continue
+                waiting[seq.qname] = fields
+                if len(waiting) > buffer_size:
+                    _set_aside(*waiting.popitem(last=False))
+
+            for qname, fields in waiting.iteritems():
+                _set_aside(qname, fields)
+            waiting.clear()
+            buckets.close()
+
+            for fname in buckets.fnames:
+                mates = dict()
+                for fields in records.load_bucket(fname):
+                    mate = mates.pop(fields[1], None)
+                    if mate is None:
+                        mates[fields[1]] = fields
+                        continue
+                    _write_mates(fields, mate, r1_writer, r2_writer)
+                    counts["pairs"] += 1
+                for fields in mates.itervalues():
+                    se_writer.write(records.Record(*fields[1:]))
+                    counts["orphans"] += 1
+                os.remove(fname)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return counts
+
+
+def open_bam(fname, threads=1):
+    kwargs = dict(check_header=False, check_sq=False)
+    if threads > 1:
+        kwargs['threads'] = threads
+    try:
+        return pysam.Samfile(fname, 'rb', **kwargs)
+    except TypeError:
+        logging.warning("This version of pysam can't decompress with"
+                        " threads; decompressing with one thread")
+        del kwargs['threads']
+        return pysam.Samfile(fname, 'rb', **kwargs)
 
 
 def main():
-    opts, output_prefix = handle_cli()
+    opts, output_prefix, input_bam = handle_cli()
     logging.getLogger().setLevel(getattr(logging, opts.logging.upper()))
     logging.basicConfig(
         format="%(asctime)s %(levelname)s: %(message)s")
-    
-    sequences = pysam.Samfile("-", 'rb', check_header=False, check_sq=False)
+
+    sequences = open_bam(input_bam, opts.threads)
     with open(output_prefix+".r1.fastq", 'w') as r1_file, \
          open(output_prefix+".r2.fastq", 'w') as r2_file, \
          open(output_prefix+".single.fastq", 'w') as se_file:
-        output(sequences, r1_file, r2_file, se_file)
+        if opts.collate:
+            counts = collate(sequences, r1_file, r2_file, se_file,
+                             buffer_size=opts.buffer,
+                             n_buckets=opts.buckets,
+                             temp_dir=opts.temp_dir)
+            logging.info("Wrote %(pairs)i pairs and %(single)i single-end"
+                         " reads. %(orphans)i reads had no mate."
+                         " Set aside %(set_aside)i reads on disk and"
+                         " skipped %(skipped)i secondary or supplementary"
+                         " alignments.", counts)
+        else:
+            output(sequences, r1_file, r2_file, se_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,385 @@
+"""Vectorized operations on blocks of sequence records.
+
+A :py:class:`Batch` holds a block of records as NumPy byte buffers of
+sequence and quality letters, plus arrays of where each record starts
+and how long it is. Length filtering and slicing only touch those
+arrays, reverse complementing is one table lookup over the whole
+buffer, and writing fasta or fastq gathers all of the output bytes at
+once. FASTA and plain four line FASTQ files are read straight into
+batches without making a record object per sequence; anything the
+fast readers don't recognize is read by
+:py:mod:`anadama_workflows.utility_scripts.records` instead. Output is
+identical to reading and writing the same records with
+:py:mod:`anadama_workflows.utility_scripts.records`.
+
+Importing this module requires NumPy.
+
+"""
+
+from itertools import imap, compress
+
+import numpy as np
+
+from . import records
+
+FASTA_WRAP = 60
+BATCH_SIZE = 10000
+
+_dna_table = np.frombuffer(records._dna_complement, dtype=np.uint8)
+_rna_table = np.frombuffer(records._rna_complement, dtype=np.uint8)
+
+# constant bytes used between fields when formatting output
+_CONSTS = np.frombuffer(">@\n+\n", dtype=np.uint8)
+_GT, _AT, _NL, _SEP = 0, 1, 2, 2
+
+_NEWLINE, _SPACE = ord("\n"), ord(" ")
+_OTHER_WHITESPACE = ("\r", "\t", "\x0b", "\x0c")
+
+
+def _lengths(strs):
+    return np.fromiter(imap(len, strs), dtype=np.int64, count=len(strs))
+
+
+def _gather(src, starts, lengths):
+    """Concatenate ``src[starts[i]:starts[i]+lengths[i]]`` for every
+    ``i`` without looping in Python."""
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    if not len(lengths):
+        return np.empty(0, dtype=src.dtype)
+    ends = np.cumsum(lengths)
+    idx = np.ones(ends[-1], dtype=np.intp)
+    idx[0] = starts[0]
+    idx[ends[:-1]] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    np.cumsum(idx, out=idx)
+    return src.take(idx)
+
+
+def _bound(index, lengths):
+    """Resolve a python slice index against each of ``lengths`` like
+    ``slice.indices`` does."""
+    if index < 0:
+        return np.maximum(lengths + index, 0)
+    return np.minimum(lengths, index)
+
+
+def _segment_counts(mask, starts, lengths):
+    counts = np.zeros(len(mask)+1, dtype=np.int64)
+    np.cumsum(mask, out=counts[1:])
+    return counts[starts+lengths] - counts[starts]
+
+
+class Batch(object):
+    """A block of records.
+
+    :param descriptions: List of strings; the title lines
+    :param seq: uint8 ndarray; buffer holding the sequence letters
+    :param qual: uint8 ndarray; buffer holding the phred+33 quality
+                 letters, laid out the same as ``seq``, or None if the
+                 records have no qualities
+    :param starts: int64 ndarray; where each record starts in ``seq``
+    :param lengths: int64 ndarray; how long each record is
+    :keyword ids: List of strings; the sequence IDs. Defaults to the
+                  first word of each description.
+
+    """
+
+    def __init__(self, descriptions, seq, qual, starts, lengths, ids=None):
+        self.descriptions = descriptions
+        self.seq = seq
+        self.qual = qual
+        self.starts = starts
+        self.lengths = lengths
+        self.ids = ids
+
+    @classmethod
+    def from_records(cls, recs):
+        seqs = [ r.seq for r in recs ]
+        lengths = _lengths(seqs)
+        starts = np.cumsum(lengths) - lengths
+        seq = np.frombuffer("".join(seqs), dtype=np.uint8)
+        quals = [ r.qual for r in recs ]
+        qual = None
+        if not any( q is None for q in quals ):
+            if _lengths(quals).tolist() != lengths.tolist():
+                raise ValueError("Lengths of sequence and quality values"
+                                 " differ")
+            qual = np.frombuffer("".join(quals), dtype=np.uint8)
+        return cls([ r.description for r in recs ], seq, qual,
+                   starts, lengths, [ r.id for r in recs ])
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def select(self, mask):
+        """Keep only the records where ``mask`` is True"""
+        mask = np.asarray(mask, dtype=bool)
+        ids = None
+        if self.ids is not None:
+            ids = list(compress(self.ids, mask))
+        return Batch(list(compress(self.descriptions, mask)), self.seq,
+                     self.qual, self.starts[mask], self.lengths[mask], ids)
+
+    def slice(self, start, stop):
+        """Slice every record like ``record[start:stop]``"""
+        a = _bound(start, self.lengths)
+        b = _bound(stop, self.lengths)
+        return Batch(self.descriptions, self.seq, self.qual,
+                     self.starts+a, np.maximum(b-a, 0), self.ids)
+
+    def reverse_complement(self):
+        """Reverse complement every record. Records with U's and no T's
+        are complemented as RNA, same as
+        :py:func:`records.reverse_complement`"""
+        comp = _dna_table.take(self.seq)
+        is_u = (self.seq == ord("U")) | (self.seq == ord("u"))
+        if is_u.any():
+            is_t = (self.seq == ord("T")) | (self.seq == ord("t"))
+            rna = ( (_segment_counts(is_u, self.starts, self.lengths) > 0)
+                    & (_segment_counts(is_t, self.starts, self.lengths) == 0) )
+            for a, n in zip(self.starts[rna], self.lengths[rna]):
+                comp[a:a+n] = _rna_table.take(self.seq[a:a+n])
+
+        qual = self.qual[::-1] if self.qual is not None else None
+        starts = len(self.seq) - (self.starts + self.lengths)
+        return Batch(self.descriptions, comp[::-1], qual,
+                     starts, self.lengths, self.ids)
+
+    def mangle(self, basestr, start=0):
+        """Rename the records ``basestr_<start>``, ``basestr_<start+1>``
+        and so on"""
+        self.ids = [ basestr+"_"+str(i)
+                     for i in xrange(start, start+len(self)) ]
+        return self
+
+    def titles(self):
+        if self.ids is None:
+            return self.descriptions
+        return map(records.make_title, self.ids, self.descriptions)
+
+    def _title_buffer(self):
+        titles = self.titles()
+        lengths = _lengths(titles)
+        return (np.frombuffer("".join(titles), dtype=np.uint8),
+                np.cumsum(lengths) - lengths, lengths)
+
+    def format_fastq(self):
+        if not len(self):
+            return ""
+        if self.qual is None:
+            raise ValueError("No suitable quality scores found in "
+                             "letter_annotations of SeqRecord")
+        titles, title_starts, title_lens = self._title_buffer()
+        t0 = len(_CONSTS)
+        s0 = t0 + len(titles)
+        q0 = s0 + len(self.seq)
+        src = np.concatenate((_CONSTS, titles, self.seq, self.qual))
+
+        # @ title \n seq \n+\n qual \n
+        starts = np.empty((len(self), 7), dtype=np.int64)
+        lens = np.empty_like(starts)
+        starts[:, 0], lens[:, 0] = _AT, 1
+        starts[:, 1], lens[:, 1] = t0+title_starts, title_lens
+        starts[:, 2], lens[:, 2] = _NL, 1
+        starts[:, 3], lens[:, 3] = s0+self.starts, self.lengths
+        starts[:, 4], lens[:, 4] = _SEP, 3
+        starts[:, 5], lens[:, 5] = q0+self.starts, self.lengths
+        starts[:, 6], lens[:, 6] = _NL, 1
+        return _gather(src, starts.ravel(), lens.ravel()).tostring()
+
+    def format_fasta(self, wrap=FASTA_WRAP):
+        if not len(self):
+            return ""
+        titles, title_starts, title_lens = self._title_buffer()
+        t0 = len(_CONSTS)
+        s0 = t0 + len(titles)
+        src = np.concatenate((_CONSTS, titles, self.seq))
+
+        # > title \n, then a line of sequence and a \n per line
+        n_lines = (self.lengths + wrap - 1) // wrap
+        n_segs = 3 + 2*n_lines
+        rec_start = np.cumsum(n_segs) - n_segs
+        starts = np.empty(int(n_segs.sum()), dtype=np.int64)
+        lens = np.empty_like(starts)
+        starts[rec_start], lens[rec_start] = _GT, 1
+        starts[rec_start+1], lens[rec_start+1] = t0+title_starts, title_lens
+        starts[rec_start+2], lens[rec_start+2] = _NL, 1
+
+        total_lines = int(n_lines.sum())
+        if total_lines:
+            rec = np.repeat(np.arange(len(self)), n_lines)
+            line_start = np.arange(total_lines, dtype=np.int64)
+            line_start -= np.repeat(np.cumsum(n_lines) - n_lines, n_lines)
+            pos = rec_start[rec] + 3 + 2*line_start
+            line_start *= wrap
+            starts[pos] = s0 + self.starts[rec] + line_start
+            lens[pos] = np.minimum(wrap, self.lengths[rec] - line_start)
+            starts[pos+1], lens[pos+1] = _NL, 1
+        return _gather(src, starts, lens).tostring()
+
+
+formatters = {
+    "fasta":        Batch.format_fasta,
+    "fastq":        Batch.format_fastq,
+    "fastq-sanger": Batch.format_fastq,
+}
+
+
+def _line_starts(newlines):
+    return np.concatenate(([0], newlines[:-1]+1))
+
+
+def _fastq_batch(text):
+    """Read ``text``, whole four line fastq records ending in a
+    newline, into a :py:class:`Batch`. Returns None if the records
+    aren't laid out simply enough to read this way."""
+    if any( c in text for c in _OTHER_WHITESPACE ):
+        return None
+    buf = np.frombuffer(text, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == _NEWLINE)
+    if len(newlines) % 4:
+        return None
+    line_starts = _line_starts(newlines)
+    line_lens = newlines - line_starts
+    if (np.any(buf[line_starts[0::4]] != ord("@"))
+        or np.any(buf[line_starts[2::4]] != ord("+"))
+        or np.any(buf[line_starts[1::4]] == ord("+"))
+        or np.any(line_lens[1::4] != line_lens[3::4])):
+        return None
+    spaces = np.flatnonzero(buf == _SPACE)
+    if len(spaces):
+        if np.any(np.searchsorted(newlines, spaces) % 4):
+            return None
+        if np.any(buf[newlines[0::4]-1] == _SPACE):
+            return None
+
+    lines = text.split("\n")
+    descriptions = [ t[1:] for t in lines[0:-1:4] ]
+    plus = lines[2::4]
+    if (np.any(line_lens[2::4] != 1)
+        and plus != [ "+"+d for d in descriptions ]):
+        return None
+    seqs, quals = lines[1::4], lines[3::4]
+    lengths = line_lens[1::4]
+    return Batch(descriptions,
+                 np.frombuffer("".join(seqs), dtype=np.uint8),
+                 np.frombuffer("".join(quals), dtype=np.uint8),
+                 np.cumsum(lengths) - lengths, lengths)
+
+
+def _fasta_batch(text):
+    """Read ``text``, whole fasta records starting with a '>' line and
+    ending in a newline, into a :py:class:`Batch`. Returns None if the
+    records can't be read this way."""
+    if any( c in text for c in _OTHER_WHITESPACE ):
+        return None
+    buf = np.frombuffer(text, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == _NEWLINE)
+    line_starts = _line_starts(newlines)
+    is_header = buf[line_starts] == ord(">")
+    if not is_header[0]:
+        return None
+    header_lines = np.flatnonzero(is_header)
+    spaces = np.flatnonzero(buf == _SPACE)
+    if len(spaces):
+        if not np.all(is_header[np.searchsorted(newlines, spaces)]):
+            return None
+        if np.any(buf[newlines[header_lines]-1] == _SPACE):
+            return None
+
+    lines = text.split("\n")
+    lines.pop()
+    descriptions = [ lines[i][1:] for i in header_lines.tolist() ]
+    seq_line_lens = np.where(is_header, 0, newlines - line_starts)
+    seq_before = np.cumsum(seq_line_lens) - seq_line_lens
+    starts = seq_before[header_lines]
+    lengths = np.diff(np.append(starts, seq_line_lens.sum()))
+    seq = "".join(compress(lines, ~is_header))
+    return Batch(descriptions, np.frombuffer(seq, dtype=np.uint8), None,
+                 starts, lengths)
+
+
+def _cut_fastq(text):
+    newlines = np.flatnonzero(np.frombuffer(text, dtype=np.uint8)
+                              == _NEWLINE)
+    n = (len(newlines)//4)*4
+    return int(newlines[n-1])+1 if n else 0
+
+
+def _cut_fasta(text):
+    return text.rfind("\n>")+1
+
+
+def from_records(recs, size=BATCH_SIZE):
+    """Group ``recs`` into batches of ``size`` records"""
+    chunk = []
+    for rec in recs:
+        chunk.append(rec)
+        if len(chunk) >= size:
+            yield Batch.from_records(chunk)
+            chunk = []
+    if chunk:
+        yield Batch.from_records(chunk)
+
+
+def _parse_blocks(handle, format, bufsize, cut, read):
+    """Read ``handle`` in blocks of whole records. ``cut`` finds where
+    the last whole record in a block of text ends and ``read`` turns a
+    block into a :py:class:`Batch`. Once a block can't be read that
+    way, the rest of the file goes to the record parser."""
+    remainder, eof = "", False
+    while not eof:
+        chunk = handle.read(bufsize)
+        text = remainder + chunk
+        if not chunk:
+            eof = True
+            if not text:
+                break
+            if not text.endswith("\n"):
+                text += "\n"
+            i = len(text)
+        else:
+            i = cut(text)
+            if i <= 0:
+                remainder = text
+                continue
+        text, remainder = text[:i], text[i:]
+        b = read(text)
+        if b is None:
+            rest = _Rest(text+remainder, handle)
+            for b in from_records(records.parse(rest, format, bufsize)):
+                yield b
+            return
+        yield b
+
+
+class _Rest(object):
+    """Reads ``text``, then the rest of ``handle``"""
+    def __init__(self, text, handle):
+        self.text = text
+        self.handle = handle
+
+    def read(self, size=-1):
+        if self.text:
+            text, self.text = self.text, ""
+            return text
+        return self.handle.read(size)
+
+
+def parse(handle, format, bufsize=records.BUFSIZE):
+    """Iterate over ``handle`` as :py:class:`Batch` objects of about
+    ``bufsize`` bytes, or :py:data:`BATCH_SIZE` records for formats
+    without a fast reader. ``handle`` can be a file name or an open
+    file.
+
+    """
+    if isinstance(handle, basestring):
+        handle = records.open_file(handle)
+    if format in ("fastq", "fastq-sanger"):
+        return _parse_blocks(handle, format, bufsize, _cut_fastq,
+                             _fastq_batch)
+    elif format == "fasta":
+        return _parse_blocks(handle, format, bufsize, _cut_fasta,
+                             _fasta_batch)
+    else:
+        return from_records(records.parse(handle, format))
@@ -0,0 +1,513 @@
+"""Read, merge, convert and write biom OTU tables without the biom
+package.
+
+Tables are kept as the coordinates and values of their nonzero
+entries, so merging thousands of per-sample tables never builds a
+dense matrix. Reads biom 1.0 (json) files, classic tab-delimited
+tables, and biom 2.x (hdf5) files if h5py is installed; writes sparse
+biom 1.0 and classic tables.
+
+"""
+
+import os
+import json
+import logging
+import datetime
+import multiprocessing
+from itertools import izip
+from collections import namedtuple, Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# tables read and merged by each process at a time
+BATCH_SIZE = 64
+# header key and column name biom convert --to-tsv is given for OTU
+# tables; qiimeToMaaslin.py looks for the column by this name
+TSV_HEADER_KEY = "taxonomy"
+TSV_HEADER_VALUE = "Consensus Lineage"
+
+# last column names of classic tables that hold taxonomy, not counts
+CLASSIC_METADATA = ("taxonomy", "Consensus Lineage", "OTU Metadata")
+
+# an OTU table as the row, column and value of each nonzero entry;
+# metadata are lists with a dict or None per OTU or sample
+Table = namedtuple("Table", ["otu_ids", "sample_ids", "rows", "cols",
+                             "values", "otu_metadata", "sample_metadata"])
+
+
+def _read_json(fname):
+    with open(fname) as f:
+        doc = json.load(f)
+    rows, cols, values = list(), list(), list()
+    if doc.get("matrix_type") == "dense":
+        for i, counts in enumerate(doc["data"]):
+            for j, value in enumerate(counts):
+                if value:
+                    rows.append(i)
+                    cols.append(j)
+                    values.append(value)
+    else:
+        for i, j, value in doc["data"]:
+            if value:
+                rows.append(i)
+                cols.append(j)
+                values.append(value)
+    return Table([ r["id"] for r in doc["rows"] ],
+                 [ c["id"] for c in doc["columns"] ],
+                 rows, cols, values,
+                 [ r.get("metadata") for r in doc["rows"] ],
+                 [ c.get("metadata") for c in doc["columns"] ])
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _read_classic(fname, metadata_key="taxonomy", split_metadata=True):
+    """Read a classic table. The metadata column is kept under
+    ``metadata_key``, or the column's own name if that's None, and
+    split on semicolons if ``split_metadata`` is set."""
+    otu_ids, otu_metadata, sample_ids = list(), list(), None
+    rows, cols, values = list(), list(), list()
+    key = None
+    with open(fname) as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if sample_ids is None:
+                if line.startswith("#OTU ID") or not line.startswith("#"):
+                    sample_ids = fields[1:]
+                    if sample_ids and sample_ids[-1] in CLASSIC_METADATA:
+                        key = metadata_key or sample_ids[-1]
+                        sample_ids.pop()
+                continue
+            if not line.strip():
+                continue
+            i = len(otu_ids)
+            otu_ids.append(fields[0])
+            counts = fields[1:len(sample_ids)+1]
+            for j, value in enumerate(counts):
+                value = _number(value)
+                if value:
+                    rows.append(i)
+                    cols.append(j)
+                    values.append(value)
+            if key and len(fields) > len(sample_ids)+1:
+                lineage = fields[-1]
+                if split_metadata:
+                    lineage = [ e.strip() for e in lineage.split(";") ]
+                otu_metadata.append({key: lineage})
+            else:
+                otu_metadata.append(None)
+    sample_ids = sample_ids or list()
+    return Table(otu_ids, sample_ids, rows, cols, values, otu_metadata,
+                 [ None ] * len(sample_ids))
+
+
+def _hdf5_metadata(grp, n):
+    metadata = [ None ] * n
+    for key in grp:
+        for i, value in enumerate(grp[key][:]):
+            if metadata[i] is None:
+                metadata[i] = dict()
+            value = value.tolist() if hasattr(value, "tolist") else value
+            metadata[i][key] = value
+    return metadata
+
+
+def _read_hdf5(fname):
+    import h5py
+    with h5py.File(fname, 'r') as f:
+        otu_ids = f["observation/ids"][:].tolist()
+        sample_ids = f["sample/ids"][:].tolist()
+        mat = f["observation/matrix"]
+        indptr = mat["indptr"][:]
+        values = mat["data"][:]
+        if np.all(values == np.round(values)):
+            values = values.astype(np.int64)
+        rows = np.repeat(np.arange(len(otu_ids)), np.diff(indptr))
+        return Table(otu_ids, sample_ids, rows, mat["indices"][:], values,
+                     _hdf5_metadata(f["observation/metadata"], len(otu_ids)),
+                     _hdf5_metadata(f["sample/metadata"], len(sample_ids)))
+
+
+def read(fname):
+    """Read a biom file, either json or hdf5, or a classic
+    tab-delimited OTU table into a :py:class:`Table`"""
+    with open(fname, 'rb') as f:
+        magic = f.read(8)
+    if magic == "\x89HDF\r\n\x1a\n":
+        if np is None:
+            raise ValueError("Reading hdf5 biom file %s needs numpy and"
+                             " h5py"%(fname))
+        return _read_hdf5(fname)
+    if magic.lstrip().startswith("{"):
+        return _read_json(fname)
+    return _read_classic(fname)
+
+
+def subset(table, otus, samples=None):
+    """Get a :py:class:`Table` with only the OTUs at indexes ``otus``
+    and the samples at indexes ``samples`` of ``table``, in the order
+    given. All samples are kept if ``samples`` is None. The entries of
+    the new table are in order of OTU, then sample, as
+    :py:func:`write_table` needs."""
+    if samples is None:
+        samples = range(len(table.sample_ids))
+    otu_ids = [ table.otu_ids[i] for i in otus ]
+    otu_metadata = [ table.otu_metadata[i] for i in otus ]
+    sample_ids = [ table.sample_ids[i] for i in samples ]
+    sample_metadata = [ table.sample_metadata[i] for i in samples ]
+    if np is not None:
+        otu_codes = np.empty(len(table.otu_ids), dtype=np.int64)
+        otu_codes.fill(-1)
+        otu_codes[list(otus)] = np.arange(len(otus))
+        sample_codes = np.empty(len(table.sample_ids), dtype=np.int64)
+        sample_codes.fill(-1)
+        sample_codes[list(samples)] = np.arange(len(samples))
+        rows = otu_codes[np.asarray(table.rows, dtype=np.int64)]
+        cols = sample_codes[np.asarray(table.cols, dtype=np.int64)]
+        mask = (rows >= 0) & (cols >= 0)
+        rows, cols = rows[mask], cols[mask]
+        values = np.asarray(table.values)[mask]
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+    else:
+        otu_codes = dict( (old, new) for new, old in enumerate(otus) )
+        sample_codes = dict( (old, new) for new, old in enumerate(samples) )
+        entries = sorted( (otu_codes[r], sample_codes[c], v) for r, c, v
+                          in izip(table.rows, table.cols, table.values)
+                          if r in otu_codes and c in sample_codes )
+        rows = [ r for r, _, _ in entries ]
+        cols = [ c for _, c, _ in entries ]
+        values = [ v for _, _, v in entries ]
+    return Table(otu_ids, sample_ids, rows, cols, values,
+                 otu_metadata, sample_metadata)
+
+
+def filter_otus(table, keep):
+    """Get a :py:class:`Table` with only the OTUs of ``table`` whose
+    IDs are in ``keep``"""
+    return subset(table, [ i for i, otu_id in enumerate(table.otu_ids)
+                           if str(otu_id) in keep ])
+
+
+class Merger(object):
+    """Sum tables into one table with the union of their OTUs and
+    samples. IDs are kept in the order they're first seen, and so is
+    the first metadata found for each ID. Counts for the same OTU and
+    sample in different tables are added together."""
+
+    def __init__(self):
+        self.otu_ids, self.sample_ids = list(), list()
+        self.otu_metadata, self.sample_metadata = list(), list()
+        self._otu_codes, self._sample_codes = dict(), dict()
+        self._chunks = list()
+        self._counter = Counter()
+
+    @staticmethod
+    def _intern(codes, ids, all_metadata, id_, metadata):
+        code = codes.get(id_)
+        if code is None:
+            code = codes[id_] = len(ids)
+            ids.append(id_)
+            all_metadata.append(metadata)
+        elif all_metadata[code] is None:
+            all_metadata[code] = metadata
+        return code
+
+    def add(self, table):
+        otu_codes = [ self._intern(self._otu_codes, self.otu_ids,
+                                   self.otu_metadata, i, m)
+                      for i, m in izip(table.otu_ids, table.otu_metadata) ]
+        sample_codes = [ self._intern(self._sample_codes, self.sample_ids,
+                                      self.sample_metadata, i, m)
+                         for i, m in izip(table.sample_ids,
+                                          table.sample_metadata) ]
+        if np is not None:
+            otus = np.array(otu_codes, dtype=np.int64)
+            samples = np.array(sample_codes, dtype=np.int64)
+            rows = np.asarray(table.rows, dtype=np.int64)
+            cols = np.asarray(table.cols, dtype=np.int64)
+            self._chunks.append(( (otus[rows] << 32) | samples[cols],
+                                  np.asarray(table.values) ))
+        else:
+            for row, col, value in izip(table.rows, table.cols,
+                                        table.values):
+                self._counter[otu_codes[row], sample_codes[col]] += value
+
+    def table(self):
+        """Get the merged :py:class:`Table`, with its entries in order
+        of OTU, then sample"""
+        if np is not None:
+            if self._chunks:
+                keys = np.concatenate([ k for k, _ in self._chunks ])
+                values = np.concatenate([ v for _, v in self._chunks ])
+            else:
+                keys = np.zeros(0, dtype=np.int64)
+                values = np.zeros(0, dtype=np.int64)
+            keys, inverse = np.unique(keys, return_inverse=True)
+            sums = np.bincount(inverse, weights=values, minlength=len(keys))
+            if values.dtype.kind in "iub":
+                sums = sums.astype(np.int64)
+            self._chunks = [(keys, sums)]
+            rows, cols, values = keys >> 32, keys & 0xffffffff, sums
+        else:
+            keys = sorted(self._counter)
+            rows = [ otu for otu, _ in keys ]
+            cols = [ sample for _, sample in keys ]
+            values = [ self._counter[key] for key in keys ]
+        return Table(self.otu_ids, self.sample_ids, rows, cols, values,
+                     self.otu_metadata, self.sample_metadata)
+
+
+def _merge_batch(fnames):
+    merger = Merger()
+    for fname in fnames:
+        merger.add(read(fname))
+    return merger.table()
+
+
+def merge(fnames, jobs=1, batch_size=BATCH_SIZE):
+    """Merge biom files ``fnames`` into one :py:class:`Table`. Missing
+    and empty files are skipped. With ``jobs`` over 1, batches of
+    ``batch_size`` files are read and merged in that many processes,
+    then merged together in the order given."""
+    fnames = [ f for f in fnames
+               if os.path.exists(f) and os.stat(f).st_size > 0 ]
+    batches = [ fnames[i:i+batch_size]
+                for i in xrange(0, len(fnames), batch_size) ]
+    merger = Merger()
+    if jobs > 1 and len(batches) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for table in pool.imap(_merge_batch, batches):
+                merger.add(table)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        for batch in batches:
+            merger.add(_merge_batch(batch))
+    return merger.table()
+
+
+def write(out_f, otu_ids, sample_ids, data, indices, indptr,
+          otu_metadata=None, sample_metadata=None,
+          generated_by="anadama_workflows"):
+    """Write a table as a sparse biom 1.0 (json) file, given its counts
+    as compressed sparse rows: each count, the sample of each count,
+    and where each OTU's counts start.
+
+    :param out_f: File; write the table here
+    :param otu_ids: List of strings; the row IDs
+    :param sample_ids: List of strings; the column IDs
+    :param data: List or numpy array; the nonzero counts
+    :param indices: List or numpy array; column of each count
+    :param indptr: List or numpy array; where each row starts in
+                   ``data``, and where the last one ends
+    :keyword otu_metadata: List; dict or None for each row
+    :keyword sample_metadata: List; dict or None for each column
+    :keyword generated_by: String; what made the table
+
+    """
+    if np is not None:
+        data = np.asarray(data)
+        is_int = data.dtype.kind in "iu" or bool(
+            np.all(data == np.round(data)))
+        data, indices = data.tolist(), np.asarray(indices).tolist()
+    else:
+        is_int = all( float(v).is_integer() for v in data )
+    otu_metadata = otu_metadata or [None]*len(otu_ids)
+    sample_metadata = sample_metadata or [None]*len(sample_ids)
+    header = {
+        "id": None,
+        "format": "Biological Observation Matrix 1.0.0",
+        "format_url": "http://biom-format.org",
+        "type": "OTU table",
+        "generated_by": generated_by,
+        "date": datetime.datetime.now().isoformat(),
+        "matrix_type": "sparse",
+        "matrix_element_type": "int" if is_int else "float",
+        "shape": [len(otu_ids), len(sample_ids)],
+        "rows": [ {"id": i, "metadata": m}
+                  for i, m in izip(otu_ids, otu_metadata) ],
+        "columns": [ {"id": i, "metadata": m}
+                     for i, m in izip(sample_ids, sample_metadata) ],
+    }
+    fmt = "%s[%d, %d, %d]" if is_int else "%s[%d, %d, %r]"
+    out_f.write(json.dumps(header)[:-1]+', "data": [')
+    sep = ""
+    for i in xrange(len(otu_ids)):
+        start, end = int(indptr[i]), int(indptr[i+1])
+        for sample, cnt in izip(indices[start:end], data[start:end]):
+            out_f.write(fmt%(sep, i, sample, cnt))
+            sep = ", "
+    out_f.write("]}\n")
+
+
+def write_table(table, out_f, generated_by="anadama_workflows"):
+    """Write a merged :py:class:`Table` as a sparse biom 1.0 file"""
+    if np is not None:
+        indptr = np.searchsorted(np.asarray(table.rows, dtype=np.int64),
+                                 np.arange(len(table.otu_ids)+1))
+    else:
+        indptr = [0]*(len(table.otu_ids)+1)
+        for row in table.rows:
+            indptr[row+1] += 1
+        for i in xrange(len(table.otu_ids)):
+            indptr[i+1] += indptr[i]
+    write(out_f, table.otu_ids, table.sample_ids, table.values, table.cols,
+          indptr, table.otu_metadata, table.sample_metadata, generated_by)
+
+
+def _format_metadata(value):
+    if value is None:
+        return ""
+    if value and all( isinstance(v, (list, tuple)) for v in value ):
+        return "|".join( _format_metadata(v) for v in value )
+    if isinstance(value, (list, tuple)):
+        return "; ".join( unicode(v) for v in value ).encode("utf-8")
+    return unicode(value).encode("utf-8")
+
+
+def write_classic(table, out_f, header_key=None, header_value=None):
+    """Write a :py:class:`Table` as a classic tab-delimited table, the
+    way ``biom convert --to-tsv`` does: every count as a float, and
+    the ``header_key`` metadata of each OTU, joined with semicolons,
+    in a last column named ``header_value``. Like biom, the column is
+    named but left off every row if no OTU has any metadata. Unlike
+    biom, metadata that's a single string is written as it is, not
+    with a semicolon between each character. The table's entries
+    must be in order of OTU, then sample.
+
+    :param table: :py:class:`Table`; the table to write
+    :param out_f: File; write the table here
+    :keyword header_key: String; OTU metadata to write in the last
+                         column
+    :keyword header_value: String; name of the last column. Defaults
+                           to ``header_key``
+
+    """
+    header_value = header_value or header_key
+    has_metadata = any( m is not None for m in table.otu_metadata )
+    n_samples = len(table.sample_ids)
+    lines = [ "# Constructed from biom file",
+              "\t".join(["#OTU ID"] + map(str, table.sample_ids)) ]
+    if header_key:
+        lines[-1] += "\t" + header_value
+    out_f.write("\n".join(lines))
+    rows, cols, values = table.rows, table.cols, table.values
+    if np is not None:
+        rows, cols = np.asarray(rows).tolist(), np.asarray(cols).tolist()
+        values = np.asarray(values).tolist()
+    entry, n_entries = 0, len(values)
+    for i, otu_id in enumerate(table.otu_ids):
+        counts = [ 0.0 ] * n_samples
+        while entry < n_entries and rows[entry] == i:
+            counts[cols[entry]] = float(values[entry])
+            entry += 1
+        line = "\t".join([str(otu_id)] + map(repr, counts))
+        if header_key and has_metadata:
+            metadata = table.otu_metadata[i] or dict()
+            line += "\t" + _format_metadata(metadata.get(header_key))
+        out_f.write("\n"+line)
+
+
+def merge_files(fnames, output_fname, jobs=1, batch_size=BATCH_SIZE):
+    """Merge biom files ``fnames`` into one sparse biom 1.0 file,
+    ``output_fname``. Returns the number of OTUs, samples and nonzero
+    entries in the merged table."""
+    table = merge(fnames, jobs=jobs, batch_size=batch_size)
+    with open(output_fname, 'w') as out_f:
+        write_table(table, out_f, generated_by="merge_otu_tables")
+    logging.debug("Merged %d OTUs and %d samples", len(table.otu_ids),
+                  len(table.sample_ids))
+    return len(table.otu_ids), len(table.sample_ids), len(table.values)
+
+
+def read_sample_metadata(fname):
+    """Read a qiime mapping file into a dict of sample ID to a dict of
+    that sample's metadata, as ``biom convert --sample-metadata-fp``
+    does"""
+    metadata, header = dict(), None
+    with open(fname) as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                if header is None:
+                    header = [ h.strip() for h in line[1:].split("\t") ]
+                continue
+            fields = [ field.strip() for field in line.split("\t") ]
+            metadata[fields[0]] = dict(izip(header[1:], fields[1:]))
+    return metadata
+
+
+def to_tsv(in_fname, out_fname, header_key=TSV_HEADER_KEY,
+           header_value=TSV_HEADER_VALUE):
+    """Convert biom file ``in_fname`` to a classic tab-delimited table,
+    ``out_fname``, like ``biom convert --to-tsv --header-key taxonomy
+    --output-metadata-id "Consensus Lineage"``"""
+    table = read(in_fname)
+    table = subset(table, range(len(table.otu_ids)))
+    with open(out_fname, 'w') as out_f:
+        write_classic(table, out_f, header_key, header_value)
+
+
+def from_tsv(in_fname, out_fname, sample_metadata_fname=None,
+             process_taxonomy=True):
+    """Convert classic tab-delimited table ``in_fname`` to a sparse
+    biom 1.0 file, ``out_fname``, like ``biom convert``. The metadata
+    column keeps its name, and with ``process_taxonomy`` it's split on
+    semicolons, like ``--process-obs-metadata=taxonomy``; otherwise
+    it's kept as a string. Sample metadata are taken from qiime
+    mapping file ``sample_metadata_fname`` if given."""
+    table = _read_classic(in_fname, None, process_taxonomy)
+    table = subset(table, range(len(table.otu_ids)))
+    if sample_metadata_fname:
+        metadata = read_sample_metadata(sample_metadata_fname)
+        table = table._replace(sample_metadata=[
+            metadata.get(s) for s in table.sample_ids ])
+    with open(out_fname, 'w') as out_f:
+        write_table(table, out_f, generated_by="AnADAMA")
+
+
+def _convert(args):
+    func, in_fname, out_fname, kwargs = args
+    if os.stat(in_fname).st_size > 1:
+        func(in_fname, out_fname, **kwargs)
+    else:
+        open(out_fname, 'w').close()
+    return out_fname
+
+
+def convert_files(func, in_fnames, out_fnames, jobs=1, **kwargs):
+    """Convert each of ``in_fnames`` to the file of the same index in
+    ``out_fnames`` with ``func``, either :py:func:`to_tsv` or
+    :py:func:`from_tsv`, in ``jobs`` processes. Empty inputs give
+    empty outputs. Keyword arguments are passed to ``func``."""
+    args = [ (func, i, o, kwargs) for i, o in izip(in_fnames, out_fnames) ]
+    if jobs > 1 and len(args) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for _ in pool.imap_unordered(_convert, args):
+                pass
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        for arg in args:
+            _convert(arg)
@@ -3,9 +3,12 @@ import sys
 import logging
 import optparse
 import operator
+import multiprocessing
 from pprint import pformat
 from functools import partial
 from itertools import ifilter, imap
+from collections import deque
+from cStringIO import StringIO
 
 try:
     import bz2
@@ -14,7 +17,14 @@ except:
     pass
 
 import pysam
-from Bio import SeqIO, Seq, SeqRecord
+from Bio import SeqIO
+
+from . import records
+
+try:
+    from . import batch
+except ImportError:
+    batch = None
 
 HELP="""%prog [options] -f <format> [-t <format>] [<file> [<file> [ ...]]]
 
@@ -56,9 +66,15 @@ opts_list = [
                          help="Slice sequence from start:end"),
     optparse.make_option('-m', '--mangle_name', action="store", type="string", 
                          dest="mangle_name", default="",
-                         help="Rename sequences with this base string")
+                         help="Rename sequences with this base string"),
+    optparse.make_option('-j', '--jobs', action="store", type="int",
+                         dest="jobs", default=1,
+                         help="Convert chunks of sequences in parallel"
+                         " using this many processes. Default 1"),
 ]
 
+CHUNK_SIZE = 10000
+
 
 def parse_comparison(s):
     match = re.match(r'^([><=!]{1,2})(\d+)$', s)
@@ -92,17 +108,27 @@ def generate_filter(comparison_list):
     return lambda val: all( f(len(val)) for f in comparator_funcs )
 
 
+def generate_mask(comparison_list):
+    comparator_funcs = [ parse_comparison(str_) for str_ in comparison_list ]
+    return lambda lengths: reduce(operator.and_,
+                                  ( f(lengths) for f in comparator_funcs ))
+
+
+def parse_slice(slice_str):
+    return tuple(map(int, slice_str.split(":")))
+
+
 def generate_slicer(slice_str):
     if slice_str:
-        start, stop = map(int, slice_str.split(":"))
+        start, stop = parse_slice(slice_str)
         return lambda val: val[start:stop]
     else:
         return lambda val: val
 
 
-def generate_mangler(basestr):
+def generate_mangler(basestr, start=0):
     def mangler(seqs):
-        for i, seq in enumerate(seqs):
+        for i, seq in enumerate(seqs, start):
             seq.id = basestr+"_"+str(i)
             yield seq
     return mangler
@@ -123,26 +149,22 @@ def handle_samfile(file_str, filemode="r"):
     sam_file = pysam.Samfile(file_str, filemode, 
                              check_header=False, check_sq=False)
     for read in sam_file:
-        seq = Seq.Seq(read.seq)
-        qual = [ ord(x)-33 for x in read.qual ]
+        seq = read.seq
         if read.is_reverse:
-            seq = seq.reverse_complement()
-        yield SeqRecord.SeqRecord(
-            seq, read.qname, "", "",
-            letter_annotations={"phred_quality": qual}
-        )
+            seq = records.reverse_complement(seq)
+        yield records.Record(read.qname, seq, read.qual)
             
 
-def handle_biopython(file_str, format=None):
+def handle_seqfile(file_str, format=None):
     in_file = my_open(file_str)
-    return SeqIO.parse(in_file, format)
+    return records.parse(in_file, format)
 
 formats = {
-    None: handle_biopython,
+    None: handle_seqfile,
     "sam": handle_samfile,
     "bam": partial(handle_samfile, filemode="rb"),
 }
-formats.update( (key, partial(handle_biopython, format=key)) 
+formats.update( (key, partial(handle_seqfile, format=key)) 
                 for key in SeqIO._FormatToWriter.keys() )
 
 def handle_cli():
@@ -158,16 +180,14 @@ def maybe_reverse_complement(seqs, do_reverse):
             yield record
     else:
         for record in seqs:
-            revcomp = record.reverse_complement()
-            yield SeqIO.SeqRecord(
-                revcomp.seq,
-                letter_annotations=revcomp.letter_annotations,
-                id=record.id,
-                name=record.name,
-                description=record.description
-            )
+            yield record.reverse_complement()
 
 def convert(*input_files, **opts):
+    if opts.get("jobs", 1) > 1:
+        return convert_parallel(*input_files, **opts)
+    if _use_batches(opts):
+        return convert_batched(*input_files, **opts)
+
     from_format = opts["format"]
     to_format = opts["to"]
     revcomp = opts["revcomp"]
@@ -182,22 +202,158 @@ def convert(*input_files, **opts):
     else:
         log = lambda i: None
         
+    with records.Writer(sys.stdout, to_format) as writer:
+        for in_file in input_files:
+            logging.debug("Converting %s from %s to %s", 
+                          in_file, from_format, to_format)
+            sequences = formats[from_format](in_file)
+            if revcomp:
+                sequences = maybe_reverse_complement(sequences, revcomp)
+            if filters:
+                sequences = ifilter(generate_filter(filters), sequences)
+            if slicer:
+                sequences = imap(generate_slicer(slicer), sequences)
+            if mangler_base:
+                mangler = generate_mangler(mangler_base)
+                sequences = mangler(sequences)
+            for i, inseq in enumerate(sequences):
+                writer.write(inseq)
+                log(i)
+
+
+def _use_batches(opts):
+    return (batch is not None and opts.get("batch", True)
+            and opts["to"] in batch.formatters)
+
+
+def _convert_batch(b, offset, opts, filters=None):
+    """Filter, reverse complement, slice, mangle and format a
+    :py:class:`batch.Batch`. Returns the number of records kept and
+    the formatted string."""
+    if filters:
+        b = b.select(generate_mask(filters)(b.lengths))
+    if opts['revcomp']:
+        b = b.reverse_complement()
+    if opts['slicer']:
+        b = b.slice(*parse_slice(opts['slicer']))
+    if opts['mangler_base']:
+        b.mangle(opts['mangler_base'], start=offset)
+    return len(b), batch.formatters[opts['to']](b)
+
+
+def handle_batches(file_str, format, size=CHUNK_SIZE):
+    if format in ("sam", "bam"):
+        return batch.from_records(formats[format](file_str), size)
+    return batch.parse(my_open(file_str), format)
+
+
+def convert_batched(*input_files, **opts):
+    """Same as :py:func:`convert`, but the input is read in blocks of
+    records that are filtered, reverse complemented, sliced and
+    formatted with NumPy array operations. Requires NumPy."""
+    from_format = opts["format"]
+    to_format = opts["to"]
+    filters = opts['filters']
+    chunk_size = opts.get('chunk_size', CHUNK_SIZE)
+
     for in_file in input_files:
-        logging.debug("Converting %s from %s to %s", 
+        logging.debug("Converting %s from %s to %s in batches",
                       in_file, from_format, to_format)
-        sequences = formats[from_format](in_file)
-        if revcomp:
-            sequences = maybe_reverse_complement(sequences, revcomp)
-        if filters:
-            sequences = ifilter(generate_filter(filters), sequences)
-        if slicer:
-            sequences = imap(generate_slicer(slicer), sequences)
-        if mangler_base:
-            mangler = generate_mangler(mangler_base)
-            sequences = mangler(sequences)
-        for i, inseq in enumerate(sequences):
-            SeqIO.write(inseq, sys.stdout, to_format)
-            log(i)
+        offset = 0
+        for b in handle_batches(in_file, from_format, chunk_size):
+            n, data = _convert_batch(b, offset, opts, filters)
+            sys.stdout.write(data)
+            offset += n
+        logging.debug("Converted %d records from %s", offset, in_file)
+
+
+_worker_opts = dict()
+def _init_worker(opts):
+    _worker_opts.update(opts)
+
+
+def _convert_chunk(args):
+    offset, chunk = args
+    if _use_batches(_worker_opts):
+        recs = [ records.Record(*fields) for fields in chunk ]
+        b = batch.Batch.from_records(recs)
+        return _convert_batch(b, offset, _worker_opts)[1]
+
+    revcomp = _worker_opts['revcomp']
+    slicer = _worker_opts['slicer']
+    mangler_base = _worker_opts['mangler_base']
+
+    sequences = ( records.Record(*fields) for fields in chunk )
+    if revcomp:
+        sequences = maybe_reverse_complement(sequences, revcomp)
+    if slicer:
+        sequences = imap(generate_slicer(slicer), sequences)
+    if mangler_base:
+        mangler = generate_mangler(mangler_base, start=offset)
+        sequences = mangler(sequences)
+    out = StringIO()
+    records.write(sequences, out, _worker_opts['to'])
+    return out.getvalue()
+
+
+def _chunks(sequences, size):
+    chunk = list()
+    for rec in sequences:
+        chunk.append((rec.id, rec.seq, rec.qual, rec.description))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def convert_parallel(*input_files, **opts):
+    """Same as :py:func:`convert`, but reverse complementing, slicing,
+    mangling and formatting happen in a pool of ``opts['jobs']``
+    processes. This process reads and length-filters the input, hands
+    out chunks of ``opts['chunk_size']`` records and writes the
+    results back in input order. Since only filtered records are
+    handed out, each chunk knows where its mangled names start.
+
+    """
+    from_format = opts["format"]
+    to_format = opts["to"]
+    filters = opts['filters']
+    jobs = opts['jobs']
+    chunk_size = opts.get('chunk_size', CHUNK_SIZE)
+    worker_opts = dict([ (k, opts[k]) for k in 
+                         ("to", "revcomp", "slicer", "mangler_base") ])
+    worker_opts['batch'] = opts.get('batch', True)
+
+    pool = multiprocessing.Pool(jobs, _init_worker, (worker_opts,))
+    pending = deque()
+    def _write_next():
+        sys.stdout.write(pending.popleft().get())
+
+    try:
+        for in_file in input_files:
+            logging.debug("Converting %s from %s to %s with %d jobs", 
+                          in_file, from_format, to_format, jobs)
+            sequences = formats[from_format](in_file)
+            if filters:
+                sequences = ifilter(generate_filter(filters), sequences)
+            offset = 0
+            for chunk in _chunks(sequences, chunk_size):
+                pending.append(
+                    pool.apply_async(_convert_chunk, ((offset, chunk),)))
+                offset += len(chunk)
+                if len(pending) >= 2*jobs:
+                    _write_next()
+            logging.debug("Converted %d records from %s", offset, in_file)
+        while pending:
+            _write_next()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
 
 def main():
@@ -224,7 +380,8 @@ def main():
                  revcomp=opts.revcomp,
                  filters=lenfilters,
                  slicer=opts.slice,
-                 mangler_base=opts.mangle_name)
+                 mangler_base=opts.mangle_name,
+                 jobs=opts.jobs)
     except IOError as e:
         if e.errno == 32:
             # That's the error for a broken pipe this usually happens
@@ -0,0 +1,134 @@
+"""Drop OTUs that PICRUSt has no 16S copy number for from OTU tables.
+
+The OTU IDs in PICRUSt's precalculated copy number file are read once
+and kept in a compact index file: the sorted IDs, one per line, in a
+single marshal string. The index sits next to the copy number file,
+or in the system temp directory if that's not writable, and is rebuilt
+whenever the copy number file changes.
+
+"""
+
+import os
+import zlib
+import gzip
+import marshal
+import logging
+import tempfile
+
+from . import biomtable
+
+_indexes = dict()
+
+
+def _file_key(fname):
+    stat = os.stat(fname)
+    return dict(path=os.path.abspath(fname), size=stat.st_size,
+                mtime=stat.st_mtime)
+
+
+def _open(fname):
+    if fname.endswith(".gz"):
+        return gzip.open(fname)
+    return open(fname)
+
+
+def read_ids(copy_fname):
+    """Get the set of OTU IDs in the first column of tab-delimited
+    ``copy_fname``, which may be gzipped, skipping comment lines"""
+    ids = set()
+    f = _open(copy_fname)
+    try:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            otu_id = line.split("\t", 1)[0].strip()
+            if otu_id:
+                ids.add(otu_id)
+    finally:
+        f.close()
+    return ids
+
+
+def index_fnames(copy_fname):
+    """Places to keep the index for ``copy_fname``, in order of
+    preference"""
+    tag = "%08x" % (zlib.crc32(os.path.abspath(copy_fname)) & 0xffffffff)
+    return [ copy_fname+".ids",
+             os.path.join(tempfile.gettempdir(), "copy_number_%s.ids"%(tag)) ]
+
+
+def _load_index(index_fname, key):
+    try:
+        with open(index_fname, 'rb') as f:
+            index_key, ids = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if index_key != key:
+        return None
+    return frozenset(ids.split("\n")) if ids else frozenset()
+
+
+def _save_index(index_fnames, key, ids):
+    blob = (key, "\n".join(sorted(ids)))
+    for index_fname in index_fnames:
+        tmp_fname = index_fname+".tmp%d"%(os.getpid())
+        try:
+            with open(tmp_fname, 'wb') as f:
+                marshal.dump(blob, f)
+            os.rename(tmp_fname, index_fname)
+            return index_fname
+        except (IOError, OSError):
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+    return None
+
+
+def otu_ids(copy_fname):
+    """Get the frozenset of OTU IDs with a copy number in
+    ``copy_fname``. The IDs are read from the index file if it's up to
+    date, otherwise from ``copy_fname``, and then saved in the index.
+    They're also kept for the life of the process."""
+    key = _file_key(copy_fname)
+    cache_key = tuple(sorted(key.items()))
+    ids = _indexes.get(cache_key)
+    if ids is not None:
+        return ids
+    fnames = index_fnames(copy_fname)
+    for index_fname in fnames:
+        ids = _load_index(index_fname, key)
+        if ids is not None:
+            break
+    else:
+        ids = frozenset(read_ids(copy_fname))
+        if not _save_index(fnames, key, ids):
+            logging.warning("Unable to save OTU ID index for %s",
+                            copy_fname)
+    _indexes.clear()
+    _indexes[cache_key] = ids
+    return ids
+
+
+def drop_unknown(table_fname, copy_fname, output_fname,
+                 generated_by="AnADAMA"):
+    """Write the OTUs in ``table_fname`` that have a copy number in
+    ``copy_fname`` to ``output_fname`` as a sparse biom 1.0 file.
+
+    :param table_fname: String; biom or classic OTU table file name
+    :param copy_fname: String; PICRUSt precalculated copy number file
+    :param output_fname: String; write the filtered table here
+    :keyword generated_by: String; what made the table
+
+    Returns a tuple of the number of OTUs kept and the number of OTUs
+    in ``table_fname``. An empty ``table_fname`` gives an empty
+    ``output_fname``, so later steps can still tell there's nothing
+    to do.
+
+    """
+    if os.stat(table_fname).st_size < 1:
+        open(output_fname, 'w').close()
+        return 0, 0
+    table = biomtable.read(table_fname)
+    filtered = biomtable.filter_otus(table, otu_ids(copy_fname))
+    with open(output_fname, 'w') as out_f:
+        biomtable.write_table(filtered, out_f, generated_by=generated_by)
+    return len(filtered.otu_ids), len(table.otu_ids)
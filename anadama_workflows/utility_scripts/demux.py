@@ -0,0 +1,484 @@
+"""Split fasta records into one file per sample, using the sample ID
+at the front of each record's ID.
+
+Records are held in memory per sample and written out in large
+writes. Only so many output files are kept open at once, so there can
+be many more samples than the open files limit.
+
+Illumina reads can be split straight from the sequence and barcode
+fastq files, too, filtered and labelled the same way QIIME's
+split_libraries_fastq.py does it.
+
+"""
+
+import os
+import string
+import logging
+import multiprocessing
+from itertools import imap, islice, izip
+from cStringIO import StringIO
+from collections import OrderedDict
+
+from . import records
+
+# bytes of records held in memory before they're written out
+BUFFER_SIZE = 64 * 1024 * 1024
+# most output files open at once
+MAX_OPEN = 256
+# bytes of input handed to each process when working in parallel
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def sample_id(record_id):
+    """Get the sample ID from a record ID like
+    ``<sample_id>_<read number>_<barcode>``"""
+    return "_".join(record_id.split("_")[:-2])
+
+
+class HandlePool(object):
+    """Append to files, keeping at most ``max_open`` of them open. The
+    least recently written file is closed to make room for another.
+    All the files are emptied when the pool is created.
+
+    :param fnames: Dict; file name by key
+    :keyword max_open: Int; most files open at once
+
+    """
+
+    def __init__(self, fnames, max_open=MAX_OPEN):
+        self.fnames = fnames
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        for fname in fnames.itervalues():
+            open(fname, 'w').close()
+
+    def write(self, key, data):
+        handle = self.handles.pop(key, None)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            handle = open(self.fnames[key], 'a')
+        self.handles[key] = handle
+        handle.write(data)
+
+    def close(self):
+        for handle in self.handles.itervalues():
+            handle.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Demultiplexer(object):
+    """Collect formatted records by sample, writing them to each
+    sample's file once ``buffer_size`` bytes are held in memory.
+    Records for samples without a file are counted and dropped.
+
+    :param output_fnames: Dict; output file name by sample ID
+    :keyword max_open: Int; most output files open at once
+    :keyword buffer_size: Int; bytes of records held in memory
+
+    """
+
+    def __init__(self, output_fnames, max_open=MAX_OPEN,
+                 buffer_size=BUFFER_SIZE):
+        self.pool = HandlePool(output_fnames, max_open)
+        self.buffer_size = buffer_size
+        self.buffers = dict( (s, list()) for s in output_fnames )
+        self.counts = dict( (s, 0) for s in output_fnames )
+        self.unknown = 0
+        self._buffered = 0
+
+    def add(self, sample, data, n=1):
+        """Add ``n`` records' worth of formatted ``data`` for
+        ``sample``"""
+        buf = self.buffers.get(sample)
+        if buf is None:
+            self.unknown += n
+            return
+        buf.append(data)
+        self.counts[sample] += n
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for sample, buf in self.buffers.iteritems():
+            if buf:
+                self.pool.write(sample, "".join(buf))
+                del buf[:]
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.close()
+
+
+def _chunks(fnames, chunk_size):
+    for fname in fnames:
+        size = os.path.getsize(fname)
+        for start in xrange(0, size, chunk_size):
+            yield fname, start, min(start+chunk_size, size)
+
+
+def _read_chunk(f, start, end):
+    """Read the fasta records whose header line starts between
+    ``start`` and ``end``"""
+    if start > 0:
+        f.seek(start-1)
+        f.readline()
+    # skip the end of a record that started in an earlier chunk
+    pos, line = f.tell(), f.readline()
+    while line and not line.startswith(">"):
+        pos, line = f.tell(), f.readline()
+    if not line or pos >= end:
+        return ""
+    parts = [line]
+    if f.tell() < end:
+        parts.append(f.read(end - f.tell()))
+        if not parts[-1].endswith("\n"):
+            parts.append(f.readline())
+    # finish the last record
+    for line in iter(f.readline, ""):
+        if line.startswith(">"):
+            break
+        parts.append(line)
+    return "".join(parts)
+
+
+def _split_chunk(args):
+    fname, start, end = args
+    with open(fname, 'rb') as f:
+        text = _read_chunk(f, start, end)
+    by_sample = dict()
+    for rec in records.parse(StringIO(text), "fasta"):
+        by_sample.setdefault(sample_id(rec.id), []).append(
+            records.format_fasta(rec))
+    return [ (s, "".join(recs), len(recs))
+             for s, recs in by_sample.iteritems() ]
+
+
+def demultiplex(fnames, output_fnames, jobs=1, max_open=MAX_OPEN,
+                buffer_size=BUFFER_SIZE, chunk_size=CHUNK_SIZE):
+    """Split the records in fasta files ``fnames`` into one fasta file
+    per sample.
+
+    :param fnames: List of strings; input fasta file names
+    :param output_fnames: Dict; output file name by sample ID
+    :keyword jobs: Int; split uncompressed inputs in this many processes
+    :keyword max_open: Int; most output files open at once
+    :keyword buffer_size: Int; bytes of records held in memory
+    :keyword chunk_size: Int; bytes of input per process at a time
+
+    Records are written in the same order in either case. Returns a
+    tuple of a dict of the number of records per sample and the
+    number of records whose sample wasn't in ``output_fnames``.
+
+    """
+    compressed = any( f.endswith((".gz", ".bz2")) for f in fnames )
+    with Demultiplexer(output_fnames, max_open, buffer_size) as demuxer:
+        if jobs > 1 and not compressed:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                chunks = _chunks(fnames, chunk_size)
+                for split in pool.imap(_split_chunk, chunks):
+                    for sample, data, n in split:
+                        demuxer.add(sample, data, n)
+            except:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        else:
+            for fname in fnames:
+                for rec in records.parse(fname, "fasta"):
+                    demuxer.add(sample_id(rec.id), records.format_fasta(rec))
+
+    if demuxer.unknown:
+        logging.warning("Skipped %d records from unknown samples",
+                        demuxer.unknown)
+    return demuxer.counts, demuxer.unknown
+
+
+# bits each base stands for in QIIME's DNA golay barcodes
+GOLAY_NT_BITS = { "A": "11", "C": "00", "T": "10", "G": "01" }
+# most bit errors a golay_12 barcode can be corrected from
+GOLAY_MAX_BIT_ERRORS = 3
+# read pairs handed to each process at a time
+ILLUMINA_CHUNK_SIZE = 50000
+
+
+def _bit_errors(a, b):
+    return sum( x != y for x, y in izip(GOLAY_NT_BITS[a], GOLAY_NT_BITS[b]) )
+
+
+class BarcodeMatcher(object):
+    """Match barcode reads to the barcodes of known samples. Every
+    sequence within the allowed number of errors of a barcode is
+    worked out up front, so matching a read is one dict lookup.
+    Sequences close enough to more than one barcode aren't matched.
+
+    For ``golay_12`` barcodes, errors are counted like QIIME's golay
+    decoder counts them: half the bit errors, with two bits per base.
+    At most 3 bit errors can be corrected. Other barcode types are
+    matched exactly, as split_libraries_fastq.py matches them, unless
+    ``correct_non_golay`` is set; then errors are mismatched bases.
+
+    :param barcodes: Dict; sample ID by barcode sequence
+    :keyword barcode_type: String; ``golay_12``, or anything else for
+                           barcodes matched base by base
+    :keyword max_errors: Float; most errors corrected
+    :keyword correct_non_golay: Boolean; correct up to ``max_errors``
+                                mismatches in barcodes that aren't
+                                ``golay_12``
+
+    """
+
+    def __init__(self, barcodes, barcode_type="golay_12", max_errors=1.5,
+                 correct_non_golay=False):
+        self.barcodes = dict( (b.upper(), s) for b, s in barcodes.iteritems() )
+        self.lengths = sorted(set( len(b) for b in self.barcodes ),
+                              reverse=True)
+        self.golay = barcode_type == "golay_12"
+        if not self.golay and not correct_non_golay:
+            max_errors = 0
+        closest = dict()
+        for barcode in self.barcodes:
+            for seq, errors in self._neighbors(barcode, max_errors):
+                hit = closest.get(seq)
+                if hit is None or errors < hit[1]:
+                    closest[seq] = [barcode, errors]
+                elif errors == hit[1]:
+                    hit[0] = None
+        self.table = dict( (seq, tuple(hit))
+                           for seq, hit in closest.iteritems()
+                           if hit[0] is not None )
+
+    def _neighbors(self, barcode, max_errors):
+        """Yield each sequence within ``max_errors`` of ``barcode`` and
+        how many errors away it is"""
+        if self.golay:
+            budget = min(int(max_errors*2), GOLAY_MAX_BIT_ERRORS)
+            cost = lambda a, b: _bit_errors(a, b)
+            scale = 0.5
+        else:
+            budget = int(max_errors)
+            cost = lambda a, b: 1
+            scale = 1
+        def _walk(seq, start, spent):
+            yield "".join(seq), spent*scale
+            for i in xrange(start, len(seq)):
+                original = seq[i]
+                for base in "ACGT":
+                    c = cost(original, base) if base != original else 0
+                    if c and spent+c <= budget:
+                        seq[i] = base
+                        for item in _walk(seq, i+1, spent+c):
+                            yield item
+                seq[i] = original
+        return _walk(list(barcode), 0, 0)
+
+    def match(self, read):
+        """Get the sample ID, corrected barcode and number of errors
+        for a barcode read, or None if it matches no barcode. Longer
+        barcodes are tried first."""
+        read = read.upper()
+        for length in self.lengths:
+            hit = self.table.get(read[:length])
+            if hit is not None:
+                return self.barcodes[hit[0]], hit[0], hit[1]
+        return None
+
+
+class QualityFilter(object):
+    """Filter reads the way QIIME's split_libraries_fastq.py does. A
+    read is cut off where the first run of more than
+    ``max_bad_run_length`` bases at or below
+    ``phred_quality_threshold`` starts. It's dropped if what's left is
+    shorter than ``min_per_read_length_fraction`` of the read, or has
+    more than ``sequence_max_n`` N's.
+
+    """
+
+    def __init__(self, phred_quality_threshold=3, max_bad_run_length=3,
+                 min_per_read_length_fraction=0.75, sequence_max_n=0,
+                 phred_offset=33):
+        self.bad_run = "0" * (max_bad_run_length+1)
+        self.min_fraction = min_per_read_length_fraction
+        self.max_n = sequence_max_n
+        self._good = string.maketrans(
+            "".join(chr(i) for i in range(256)),
+            "".join("0" if i-phred_offset <= phred_quality_threshold
+                    else "1" for i in range(256)))
+
+    def __call__(self, seq, qual):
+        """Returns the filtered sequence, or None if the read's dropped"""
+        cut = qual.translate(self._good).find(self.bad_run)
+        length = len(seq)
+        if cut >= 0:
+            seq = seq[:cut]
+        # QIIME rounds the shortest length kept to the nearest base
+        if len(seq) < int(round(length * self.min_fraction)):
+            return None
+        if seq.count("N") > self.max_n:
+            return None
+        return seq
+
+
+_illumina = dict()
+
+
+def _init_illumina(matchers, quality_filter, rev_comp_barcode, rev_comp):
+    _illumina.update(matchers=matchers, quality_filter=quality_filter,
+                     rev_comp_barcode=rev_comp_barcode, rev_comp=rev_comp)
+
+
+def _split_illumina_chunk(args):
+    """Match and filter a chunk of read pairs. Returns a list of
+    tuples of sample ID and the rest of each kept record after its
+    sequence number, and counts of reads with no matching barcode and
+    reads that didn't pass the quality filter."""
+    lane, seq_lines, bc_lines = args
+    matcher = _illumina['matchers'][lane]
+    keep = _illumina['quality_filter']
+    kept, no_barcode, low_quality = list(), 0, 0
+    for i in xrange(0, len(seq_lines), 4):
+        header, seq, _, qual = seq_lines[i:i+4]
+        if not header.startswith("@"):
+            raise ValueError("Expected a fastq record, got `%s'"%(header))
+        barcode = bc_lines[i+1].strip()
+        if _illumina['rev_comp_barcode']:
+            barcode = records.reverse_complement(barcode)
+        hit = matcher.match(barcode)
+        if hit is None:
+            no_barcode += 1
+            continue
+        seq = keep(seq.strip(), qual.strip())
+        if seq is None:
+            low_quality += 1
+            continue
+        if _illumina['rev_comp']:
+            seq = records.reverse_complement(seq)
+        sample, corrected, errors = hit
+        kept.append((sample, " %s orig_bc=%s new_bc=%s bc_diffs=%d\n%s\n"%(
+            header[1:].strip(), barcode, corrected, errors, seq)))
+    return kept, no_barcode, low_quality
+
+
+def _illumina_chunks(lanes, chunk_size):
+    for lane, (seq_fname, bc_fname) in enumerate(lanes):
+        with records.open_file(seq_fname) as seq_f, \
+             records.open_file(bc_fname) as bc_f:
+            while True:
+                seq_lines = list(islice(seq_f, 4*chunk_size))
+                bc_lines = list(islice(bc_f, 4*chunk_size))
+                if len(seq_lines) != len(bc_lines):
+                    raise ValueError(
+                        "%s and %s have different numbers of reads"%(
+                            seq_fname, bc_fname))
+                if not seq_lines:
+                    break
+                yield lane, seq_lines, bc_lines
+
+
+def demultiplex_illumina(lanes, barcodes, output_fnames, jobs=1,
+                         barcode_type="golay_12", max_barcode_errors=1.5,
+                         correct_non_golay=False,
+                         rev_comp_barcode=False, rev_comp=False,
+                         start_seq_id=0, max_open=MAX_OPEN,
+                         buffer_size=BUFFER_SIZE,
+                         chunk_size=ILLUMINA_CHUNK_SIZE, **filter_opts):
+    """Split Illumina reads into fasta files by sample, reading each
+    sequence fastq file alongside its barcode fastq file. Records are
+    labelled like split_libraries_fastq.py labels them, e.g.
+    ``>S1_0 <read title> orig_bc=<barcode> new_bc=<barcode> bc_diffs=0``,
+    and numbered in input order across all lanes.
+
+    :param lanes: List of tuples; sequence fastq and barcode fastq
+                  file names for each lane
+    :param barcodes: List of dicts; sample ID by barcode sequence for
+                     each lane
+    :param output_fnames: Dict; output file name by sample ID. Several
+                          samples can share a file.
+    :keyword jobs: Int; match and filter reads in this many processes
+    :keyword barcode_type: String; ``golay_12``, the barcode length or
+                           ``variable_length``
+    :keyword max_barcode_errors: Float; most barcode errors corrected
+    :keyword correct_non_golay: Boolean; also correct errors in
+                                barcodes that aren't ``golay_12``,
+                                which split_libraries_fastq.py only
+                                matches exactly
+    :keyword rev_comp_barcode: Boolean; reverse complement barcode reads
+    :keyword rev_comp: Boolean; reverse complement sequences written
+    :keyword start_seq_id: Int; number the first record this
+    :keyword max_open: Int; most output files open at once
+    :keyword buffer_size: Int; bytes of records held in memory
+    :keyword chunk_size: Int; read pairs per process at a time
+
+    Other keywords are passed on to :py:class:`QualityFilter`.
+
+    Returns a dict of counts: ``reads`` read, ``written`` per sample
+    ID, reads with ``no_barcode`` match, ``low_quality`` reads
+    dropped, and ``unknown`` reads from samples without an output
+    file.
+
+    """
+    matchers = [ BarcodeMatcher(b, barcode_type, max_barcode_errors,
+                                correct_non_golay)
+                 for b in barcodes ]
+    init_args = (matchers, QualityFilter(**filter_opts),
+                 rev_comp_barcode, rev_comp)
+    counts = dict(reads=0, no_barcode=0, low_quality=0, unknown=0,
+                  written=dict( (s, 0) for s in output_fnames ))
+    seq_id = start_seq_id
+    outputs = dict( (f, f) for f in set(output_fnames.itervalues()) )
+
+    chunks = _illumina_chunks(lanes, chunk_size)
+    with Demultiplexer(outputs, max_open, buffer_size) as demuxer:
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, _init_illumina, init_args)
+            splits = pool.imap(_split_illumina_chunk, chunks)
+        else:
+            _init_illumina(*init_args)
+            splits = imap(_split_illumina_chunk, chunks)
+        try:
+            for kept, no_barcode, low_quality in splits:
+                counts['reads'] += len(kept) + no_barcode + low_quality
+                counts['no_barcode'] += no_barcode
+                counts['low_quality'] += low_quality
+                for sample, rest in kept:
+                    fname = output_fnames.get(sample)
+                    if fname is None:
+                        counts['unknown'] += 1
+                    else:
+                        demuxer.add(fname, ">%s_%d%s"%(sample, seq_id, rest))
+                        counts['written'][sample] += 1
+                    seq_id += 1
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.join()
+
+    return counts
@@ -0,0 +1,182 @@
+"""Collapse identical sequences in a fasta file into one record each,
+annotated with how many times the sequence was seen, like usearch
+``-derep_fulllength -sizeout`` followed by ``-sortbysize``.
+
+Unique sequences are counted in memory. Once the table takes up more
+than ``max_memory`` bytes, it's set aside on disk in one of several
+bucket files picked by sequence, so each sequence's counts end up in
+the same bucket. The buckets are summed one at a time, and the uniques
+from each are merged back together in order of abundance.
+
+"""
+
+import os
+import re
+import heapq
+import shutil
+import zlib
+import tempfile
+
+from . import records
+
+# bytes of unique sequences counted in memory before they're set aside
+MAX_MEMORY = 1024 * 1024 * 1024
+# files to set unique sequences aside in
+N_BUCKETS = 64
+
+size_annotation = re.compile(r';?size=\d+;?')
+
+
+def _bucket_of(seq, n_buckets):
+    return (zlib.crc32(seq) & 0xffffffff) % n_buckets
+
+
+def _order(item):
+    # most abundant first, then in the order first seen
+    seq, size, idx, label = item
+    return -size, idx
+
+
+class Dereplicator(object):
+    """Count identical sequences, remembering the label of the first
+    record with each sequence. Sequences are compared ignoring case.
+
+    :keyword max_memory: Int; bytes of unique sequences held in memory
+    :keyword n_buckets: Int; number of files to set sequences aside in
+    :keyword temp_dir: String; where to put those files. Defaults to
+      the system temp directory
+
+    """
+
+    def __init__(self, max_memory=MAX_MEMORY, n_buckets=N_BUCKETS,
+                 temp_dir=None):
+        self.max_memory = max_memory
+        self.n_buckets = n_buckets
+        self.temp_dir = temp_dir
+        self.table = dict()
+        self.n = 0
+        self.set_aside = 0
+        self._held = 0
+        self._buckets = None
+        self._workdir = None
+
+    def add(self, label, seq):
+        seq = seq.upper()
+        entry = self.table.get(seq)
+        if entry is None:
+            self.table[seq] = [1, self.n, label]
+            self._held += records.RECORD_OVERHEAD + len(seq) + len(label)
+            if self._held >= self.max_memory:
+                self._spill()
+        else:
+            entry[0] += 1
+        self.n += 1
+
+    def _spill(self):
+        if self._buckets is None:
+            self._workdir = tempfile.mkdtemp(prefix="sequence_derep",
+                                             dir=self.temp_dir)
+            self._buckets = records.Buckets(
+                [ os.path.join(self._workdir, str(i))
+                  for i in range(self.n_buckets) ])
+        for seq, (size, idx, label) in self.table.iteritems():
+            self._buckets.add(_bucket_of(seq, self.n_buckets),
+                              (seq, size, idx, label))
+            self.set_aside += 1
+        self.table.clear()
+        self._held = 0
+
+    def _sum_bucket(self, fname, minsize, maxsize):
+        """Sum the counts of each sequence in a bucket, returning the
+        uniques with enough copies in order of abundance"""
+        table = dict()
+        for seq, size, idx, label in records.load_bucket(fname):
+            entry = table.get(seq)
+            if entry is None:
+                table[seq] = [size, idx, label]
+            else:
+                entry[0] += size
+                if idx < entry[1]:
+                    entry[1:] = idx, label
+        uniques = [ (seq, size, idx, label)
+                    for seq, (size, idx, label) in table.iteritems()
+                    if minsize <= size and (not maxsize or size <= maxsize) ]
+        uniques.sort(key=_order)
+        return uniques
+
+    def uniques(self, minsize=1, maxsize=None):
+        """Yield tuples of sequence, count, index of the first record
+        and label of each unique sequence seen at least ``minsize``
+        times, and at most ``maxsize`` times if given. The most
+        abundant sequences come first; ties are in the order first
+        seen."""
+        if self._buckets is None:
+            uniques = [ (seq, size, idx, label)
+                        for seq, (size, idx, label) in self.table.iteritems()
+                        if minsize <= size
+                        and (not maxsize or size <= maxsize) ]
+            self.table.clear()
+            uniques.sort(key=_order)
+            for item in uniques:
+                yield item
+            return
+
+        self._spill()
+        self._buckets.close()
+        runs = list()
+        for fname in self._buckets.fnames:
+            run = records.Buckets([fname+".sorted"])
+            for item in self._sum_bucket(fname, minsize, maxsize):
+                run.add(0, item)
+            run.close()
+            os.remove(fname)
+            runs.append(fname+".sorted")
+        merged = heapq.merge(*[
+            ( (_order(item), item) for item in records.load_bucket(fname) )
+            for fname in runs ])
+        for _, item in merged:
+            yield item
+
+    def close(self):
+        if self._workdir is not None:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+            self._workdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def dereplicate(fasta_in, fasta_out, minsize=1, maxsize=None,
+                max_memory=MAX_MEMORY, n_buckets=N_BUCKETS, temp_dir=None):
+    """Write each unique sequence in ``fasta_in`` once to
+    ``fasta_out``, labelled with the first record's title and a
+    ``;size=N;`` annotation, most abundant first. Any size annotation
+    already in a title is replaced.
+
+    :param fasta_in: String; input fasta file name
+    :param fasta_out: String; output fasta file name
+    :keyword minsize: Int; drop sequences seen fewer times than this
+    :keyword maxsize: Int; drop sequences seen more times than this
+    :keyword max_memory: Int; bytes of unique sequences held in memory
+    :keyword n_buckets: Int; number of files to set sequences aside in
+    :keyword temp_dir: String; where to put those files
+
+    Returns a tuple of the number of input records, the number of
+    unique sequences written, and the number of times a unique
+    sequence was set aside on disk.
+
+    """
+    with Dereplicator(max_memory, n_buckets, temp_dir) as derep:
+        with records.open_file(fasta_in) as f:
+            for rec in records.parse(f, "fasta"):
+                derep.add(rec.title(), rec.seq)
+        written = 0
+        with open(fasta_out, 'w') as f, records.Writer(f, "fasta") as w:
+            for seq, size, _, label in derep.uniques(minsize, maxsize):
+                label = size_annotation.sub("", label)
+                w.write(records.Record(label+";size=%d;"%(size), seq))
+                written += 1
+    return derep.n, written, derep.set_aside
@@ -0,0 +1,216 @@
+"""Guess whether 16S reads run the same way as a set of reference
+sequences or are reverse complemented, from a sample of the reads.
+
+Each sampled read votes for the orientation that shares more k-mers
+with the reference. With numpy, the reference's k-mers are kept in a
+bitmap with a bit for every possible k-mer; without it, the
+reference is scanned for only the k-mers found in the sampled reads.
+
+Barcode reads are checked the same way against the barcodes in a
+mapping file, as they are and reverse complemented.
+
+"""
+
+import os
+import json
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import records
+
+# length of the k-mers compared
+K = 12
+# reads sampled from the front of the input
+SAMPLE_SIZE = 2000
+# fewer reads than this voting either way can't decide the orientation
+MIN_VOTES = 20
+# bases of reference sequence turned into k-mers at once
+CHUNK_SIZE = 16 * 1024 * 1024
+
+FORWARD, REVERSE = "forward", "reverse"
+
+_indexes = dict()
+
+
+def _file_key(fname):
+    stat = os.stat(fname)
+    return dict(path=os.path.abspath(fname), size=stat.st_size,
+                mtime=stat.st_mtime)
+
+
+def sample(fname, n=SAMPLE_SIZE):
+    """Get the sequences of the first ``n`` records in fasta file
+    ``fname``"""
+    with records.open_file(fname) as f:
+        return [ rec.seq for rec in islice(records.parse(f, "fasta"), n) ]
+
+
+def _reference_chunks(ref_fname, chunk_size=CHUNK_SIZE):
+    """Join reference sequences into strings of about ``chunk_size``
+    bases, separated by N's so no k-mer spans two sequences"""
+    chunk, size = list(), 0
+    with records.open_file(ref_fname) as f:
+        for rec in records.parse(f, "fasta"):
+            chunk.append(rec.seq)
+            size += len(rec.seq)
+            if size >= chunk_size:
+                yield "N".join(chunk)
+                chunk, size = list(), 0
+    if chunk:
+        yield "N".join(chunk)
+
+
+if np is not None:
+    _codes = np.empty(256, dtype=np.uint8)
+    _codes.fill(4)
+    for i, bases in enumerate(("Aa", "Cc", "Gg", "TtUu")):
+        for base in bases:
+            _codes[ord(base)] = i
+
+
+def kmer_codes(seq, k=K):
+    """Number each k-mer of ``seq`` from 0 to 4**k-1, skipping k-mers
+    with anything but A, C, G, T or U. Returns a numpy array."""
+    n = len(seq) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64)
+    bases = _codes[np.frombuffer(seq, dtype=np.uint8)]
+    codes = np.zeros(n, dtype=np.int64)
+    bad = np.zeros(n, dtype=bool)
+    for j in xrange(k):
+        window = bases[j:j+n]
+        codes <<= 2
+        codes |= window & 3
+        bad |= window > 3
+    return codes[~bad]
+
+
+def kmer_index(ref_fname, k=K):
+    """Build a bitmap of the k-mers in fasta file ``ref_fname`` as a
+    numpy array of 4**k booleans. Indexes are kept for the life of
+    the process, until ``ref_fname`` changes."""
+    key = (k,) + tuple(sorted(_file_key(ref_fname).items()))
+    index = _indexes.get(key)
+    if index is None:
+        index = np.zeros(4**k, dtype=bool)
+        for chunk in _reference_chunks(ref_fname):
+            index[kmer_codes(chunk, k)] = True
+        _indexes.clear()
+        _indexes[key] = index
+    return index
+
+
+def _kmers(seq, k):
+    seq = seq.upper().replace("U", "T")
+    return set( seq[i:i+k] for i in xrange(len(seq)-k+1)
+                if not seq[i:i+k].strip("ACGT") )
+
+
+def _hits_without_numpy(seqs, ref_fname, k):
+    """Count reference k-mers in each read and its reverse complement
+    by scanning the reference for the reads' k-mers"""
+    kmers = [ (_kmers(s, k), _kmers(records.reverse_complement(s), k))
+              for s in seqs ]
+    wanted = set()
+    for fwd, rev in kmers:
+        wanted.update(fwd)
+        wanted.update(rev)
+    found = set()
+    for chunk in _reference_chunks(ref_fname):
+        chunk = chunk.upper().replace("U", "T")
+        for i in xrange(len(chunk)-k+1):
+            if chunk[i:i+k] in wanted:
+                found.add(chunk[i:i+k])
+    return [ (len(fwd & found), len(rev & found)) for fwd, rev in kmers ]
+
+
+def _hits(seqs, ref_fname, k):
+    index = kmer_index(ref_fname, k)
+    return [ (int(index[kmer_codes(s, k)].sum()),
+              int(index[kmer_codes(records.reverse_complement(s), k)].sum()))
+             for s in seqs ]
+
+
+def vote(seqs, ref_fname, k=K):
+    """Count how many of ``seqs`` share more k-mers with the reference
+    sequences in ``ref_fname`` as they are and how many do when
+    reverse complemented. Returns a tuple of the two counts."""
+    if np is not None:
+        hits = _hits(seqs, ref_fname, k)
+    else:
+        hits = _hits_without_numpy(seqs, ref_fname, k)
+    forward = sum( 1 for fwd, rev in hits if fwd > rev )
+    reverse = sum( 1 for fwd, rev in hits if rev > fwd )
+    return forward, reverse
+
+
+def orientation(fasta_fname, ref_fname, k=K, n=SAMPLE_SIZE,
+                min_votes=MIN_VOTES):
+    """Guess which way the reads in ``fasta_fname`` run compared to
+    the reference sequences in ``ref_fname``, from the first ``n``
+    reads.
+
+    Returns ``"forward"``, ``"reverse"``, or None if fewer than
+    ``min_votes`` reads voted either way. The guess is kept in an
+    ``.orientation.json`` file next to ``fasta_fname``, and reused
+    until either file changes.
+
+    """
+    cache_fname = fasta_fname+".orientation.json"
+    key = dict(input=_file_key(fasta_fname), reference=_file_key(ref_fname),
+               k=k, n=n)
+    try:
+        with open(cache_fname) as f:
+            cache = json.load(f)
+        if cache["key"] == key:
+            forward, reverse = cache["votes"]
+            return decide(forward, reverse, min_votes)
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    forward, reverse = vote(sample(fasta_fname, n), ref_fname, k)
+    try:
+        with open(cache_fname, 'w') as f:
+            json.dump(dict(key=key, votes=[forward, reverse]), f)
+    except IOError:
+        pass
+    return decide(forward, reverse, min_votes)
+
+
+def decide(forward, reverse, min_votes=MIN_VOTES):
+    """Pick an orientation from the number of ``forward`` and
+    ``reverse`` votes, or None if there are too few votes or a tie"""
+    if forward + reverse < min_votes or forward == reverse:
+        return None
+    return REVERSE if reverse > forward else FORWARD
+
+
+def barcode_matches(barcode_fnames, barcodes, n=SAMPLE_SIZE):
+    """Match the start of the first ``n`` reads in fastq files
+    ``barcode_fnames`` exactly against ``barcodes``, as they are and
+    reverse complemented. Returns a tuple of the number of reads
+    read, the number matching forward, and the number matching
+    reverse complemented."""
+    forward = set( b.upper() for b in barcodes )
+    reverse = set( records.reverse_complement(b) for b in forward )
+    lengths = sorted(set( len(b) for b in forward ))
+
+    def _matches(seq, barcode_set):
+        return any( seq[:l] in barcode_set for l in lengths )
+
+    def _seqs():
+        for fname in barcode_fnames:
+            with records.open_file(fname) as f:
+                for rec in records.parse(f, "fastq"):
+                    yield rec.seq.upper()
+
+    total = n_forward = n_reverse = 0
+    for seq in islice(_seqs(), n):
+        total += 1
+        n_forward += _matches(seq, forward)
+        n_reverse += _matches(seq, reverse)
+    return total, n_forward, n_reverse
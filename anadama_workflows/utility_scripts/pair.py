@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 
+import os
 import re
+import zlib
+import shutil
+import struct
+import hashlib
 import logging
 import optparse
+import tempfile
 from pprint import pformat
 from itertools import izip_longest, ifilter, count, izip
 
 from Bio import SeqIO
 from Bio import BiopythonParserWarning
 
+from . import records
+from .sort import parse_size
+
 DEBUG = False
 
 HELP="""%prog [options] -f <format> <read_1_file> <read_2_file>
@@ -60,6 +69,21 @@ opts_list = [
                          default=True, dest="mangle",
                          help="Output sequence labels with just the ID in "
                          "it. Defaults to true"),
+    optparse.make_option('-b', '--buckets', action="store", type="int",
+                         dest="buckets", default=0,
+                         help="Split both files into this many buckets on "
+                         "disk by comparison key, then pair each bucket. "
+                         "Use this when the reads are badly out of order "
+                         "and the unpaired reads don't fit in memory"),
+    optparse.make_option('-M', '--max_memory', action="store",
+                         type="string", dest="max_memory", default="1G",
+                         help="With --buckets, use about this much memory, "
+                         "e.g. 512M or 4G. Buckets that won't fit are split "
+                         "again. Defaults to 1G"),
+    optparse.make_option('-T', '--temp_dir', action="store", type="string",
+                         dest="temp_dir", default=None,
+                         help="With --buckets, write buckets here. Defaults "
+                         "to the system temp directory"),
 ]
 
 def handle_cli():
@@ -79,37 +103,49 @@ def generate_fnames(opts, r1_fname, r2_fname):
         yield out
             
 
-read_cache1 = dict()
-read_cache2 = dict()
-def _pair_reads(keys, reads):
-    global read_cache1, read_cache2
+def new_stats():
+    """Counts kept while pairing: pairs written, reads dropped from
+    each side for lack of a mate, and reads skipped because their
+    comparison key couldn't be found"""
+    return {"paired": 0, "orphans_1": 0, "orphans_2": 0, "skipped": 0}
+
+
+def _pair_reads(keys, reads, read_cache1, read_cache2, stats):
     r1, r2 = reads
     k1, k2 = keys
     # time optimization; if they already equal eachother, return them
     # immediately
     if k1 == k2:
         yield r1, r2
+        return
 
     if k1 in read_cache2:
         yield r1, read_cache2.pop(k1)
     else:
         if r1 and k1:
+            if k1 in read_cache1:
+                stats["orphans_1"] += 1
             read_cache1[k1] = r1
 
     if k2 in read_cache1:
         yield read_cache1.pop(k2), r2
     else:
         if r2 and k2:
+            if k2 in read_cache2:
+                stats["orphans_2"] += 1
             read_cache2[k2] = r2
 
 
-def _pair_reads_cached(seqs, regex):
+def _pair_reads_cached(seqs, regex, stats):
+    read_cache1, read_cache2 = dict(), dict()
     for i, reads in enumerate(seqs):
         try:
             keys = extract_compare_key(reads, regex)
-            maybe_matched = _pair_reads(keys, reads)
+            maybe_matched = _pair_reads(keys, reads, read_cache1,
+                                        read_cache2, stats)
             for mated_pair in ifilter(None, maybe_matched):
                 # now we know they're mated pairs, so return them
+                stats["paired"] += 1
                 yield mated_pair
         except BiopythonParserWarning as e:
             logging.warning(e)
@@ -117,15 +153,111 @@ def _pair_reads_cached(seqs, regex):
         except ValueError as e:
             logging.warning('Exception on record %i', i)
             logging.exception(e)
+            stats["skipped"] += len(filter(None, reads))
             continue
 
+    stats["orphans_1"] += len(read_cache1)
+    stats["orphans_2"] += len(read_cache2)
     if DEBUG:
-        global read_cache1, read_cache2
         logging.debug("Dropped %i orphaned reads:", 
                       len(read_cache1)+len(read_cache2))
         logging.debug(read_cache1.keys()+read_cache2.keys())
 
 
+def _bucket_of(key, n_buckets, level):
+    if not level:
+        return (zlib.crc32(key) & 0xffffffff) % n_buckets
+    # crc is affine in its start value and in any salt of the same
+    # length, so keys that share a crc bucket would share one again;
+    # split again with hash bits that don't depend on the crc
+    digest = hashlib.md5("%d:%s"%(level, key)).digest()
+    return struct.unpack("<I", digest[:4])[0] % n_buckets
+
+
+def _partition(recs, prefix, n_buckets, level, bufsize):
+    buckets = records.Buckets([ "%s.%d"%(prefix, i)
+                                for i in range(n_buckets) ], bufsize)
+    try:
+        for rec in recs:
+            buckets.add(_bucket_of(rec[0], n_buckets, level), rec)
+    finally:
+        buckets.close()
+    return buckets
+
+
+def _keyed(reads, regex, stats):
+    for i, read in enumerate(reads):
+        match = regex.match(read.id)
+        if not match or not match.groups():
+            logging.warning("Provided regex has no matches or gives no "
+                            "groups against string %s on line %i", 
+                            read.id, i)
+            stats["skipped"] += 1
+            continue
+        yield (match.group(1), read.id, read.seq, read.qual,
+               read.description)
+
+
+# give up splitting buckets that are still too big after this many
+# rounds; they're likely full of reads with the same key
+MAX_SPLITS = 3
+
+def _pair_bucket(fname1, fname2, size1, n_buckets, level, max_memory,
+                 stats):
+    if size1 > max_memory and level < MAX_SPLITS:
+        bufsize = max_memory // 4
+        b1 = _partition(records.load_bucket(fname1), fname1, n_buckets, level+1,
+                        bufsize)
+        b2 = _partition(records.load_bucket(fname2), fname2, n_buckets, level+1,
+                        bufsize)
+        os.remove(fname1)
+        os.remove(fname2)
+        for args in izip(b1.fnames, b2.fnames, b1.sizes):
+            for pair in _pair_bucket(*args, n_buckets=n_buckets,
+                                     level=level+1, max_memory=max_memory,
+                                     stats=stats):
+                yield pair
+        return
+
+    cache = dict()
+    for rec in records.load_bucket(fname1):
+        if rec[0] in cache:
+            stats["orphans_1"] += 1
+        else:
+            cache[rec[0]] = rec
+    for rec in records.load_bucket(fname2):
+        mate = cache.pop(rec[0], None)
+        if mate is None:
+            stats["orphans_2"] += 1
+            continue
+        stats["paired"] += 1
+        yield records.Record(*mate[1:]), records.Record(*rec[1:])
+    stats["orphans_1"] += len(cache)
+    os.remove(fname1)
+    os.remove(fname2)
+
+
+def _pair_reads_bucketed(forward_reads, reverse_reads, regex, stats,
+                         n_buckets, max_memory, temp_dir=None):
+    """Pair reads in any order using about ``max_memory`` bytes. Both
+    sets of reads are split into ``n_buckets`` files by a hash of the
+    comparison key, then each bucket's reads are paired in memory.
+    Buckets too big to pair in memory are split again."""
+    workdir = tempfile.mkdtemp(prefix="sequence_pair", dir=temp_dir)
+    try:
+        bufsize = max_memory // 4
+        b1 = _partition(_keyed(forward_reads, regex, stats),
+                        os.path.join(workdir, "r1"), n_buckets, 0, bufsize)
+        b2 = _partition(_keyed(reverse_reads, regex, stats),
+                        os.path.join(workdir, "r2"), n_buckets, 0, bufsize)
+        for fname1, fname2, size1 in izip(b1.fnames, b2.fnames, b1.sizes):
+            for pair in _pair_bucket(fname1, fname2, size1, n_buckets, 0,
+                                     max_memory, stats):
+                yield pair
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
 def _pair_reads_sorted(join_direction="left"):
     """Assume the sequences come pre-sorted and perform a right or left
     inner join, depending on the ``join_direction`` keyword argument."""
@@ -172,30 +304,63 @@ def extract_compare_key(reads, regex, track=0):
             yield match.group(1)
         
 
-def pair_reads(in1, in2, id_match_pattern, parse_format, join_direction=None):
+def pair_reads(in1, in2, id_match_pattern, parse_format, join_direction=None,
+               buckets=None, max_memory=1024**3, temp_dir=None, stats=None):
+    """Pair the reads from ``in1`` and ``in2``. Returns an iterator of
+    ``(read_1, read_2)`` :py:class:`records.Record` pairs.
+
+    :param in1: File name or open file; the first set of reads
+    :param in2: File name or open file; the second set of reads
+    :param id_match_pattern: String; regex whose first group is the key
+                             used to match reads to their mates
+    :param parse_format: String; the format of ``in1`` and ``in2``
+    :keyword join_direction: String; 'left' or 'right' to do an inner
+                             join of sorted reads
+    :keyword buckets: Int; pair out of order reads by splitting them into
+                      this many buckets on disk, using about
+                      ``max_memory`` bytes
+    :keyword max_memory: Int; memory budget in bytes for ``buckets``
+    :keyword temp_dir: String; where to put the buckets
+    :keyword stats: Dict; if given, counts of paired, orphaned and
+                    skipped reads are kept here as the pairs are
+                    consumed. See :py:func:`new_stats`.
+
+    """
     regex = re.compile(id_match_pattern)
+    if stats is None:
+        stats = new_stats()
+    else:
+        stats.update(new_stats())
     if join_direction:
         pairer = _pair_reads_sorted(join_direction=join_direction)
-        return pairer(forward_reads = SeqIO.parse(in1, parse_format),
-                      reverse_reads = SeqIO.parse(in2, parse_format),
+        return pairer(forward_reads = records.parse(in1, parse_format),
+                      reverse_reads = records.parse(in2, parse_format),
                       cmp_regex     = regex)
+    elif buckets:
+        return _pair_reads_bucketed(records.parse(in1, parse_format),
+                                    records.parse(in2, parse_format),
+                                    regex, stats, n_buckets=buckets,
+                                    max_memory=max_memory,
+                                    temp_dir=temp_dir)
     else:
-        seqs = izip_longest(SeqIO.parse(in1, parse_format),
-                            SeqIO.parse(in2, parse_format))
-        return _pair_reads_cached(seqs, regex)
+        seqs = izip_longest(records.parse(in1, parse_format),
+                            records.parse(in2, parse_format))
+        return _pair_reads_cached(seqs, regex, stats)
 
 
 def _output(read_pairs, output_pair, output_format, only_id=True):
     out1, out2 = output_pair
-    for i, (r1, r2) in enumerate(read_pairs):
-        if only_id:
-            r1.description = r1.id + " 1"
-            r2.description = r2.id + " 2"
-        SeqIO.write(r1, out1, output_format)
-        SeqIO.write(r2, out2, output_format)
-        if DEBUG:
-            if i % 100 == 0 and i != 0:
-                logging.debug("Wrote %d records", i)
+    with records.Writer(out1, output_format) as w1, \
+         records.Writer(out2, output_format) as w2:
+        for i, (r1, r2) in enumerate(read_pairs):
+            if only_id:
+                r1.description = r1.id + " 1"
+                r2.description = r2.id + " 2"
+            w1.write(r1)
+            w2.write(r2)
+            if DEBUG:
+                if i % 100 == 0 and i != 0:
+                    logging.debug("Wrote %d records", i)
 
 
 def main():
@@ -211,15 +376,27 @@ def main():
 
     with   open(r1out_fname, 'w') as r1out, \
            open(r2out_fname, 'w') as r2out, \
-           open(r1_fname,    'r') as r1in,  \
-           open(r2_fname,    'r') as r2in:
+           records.open_file(r1_fname) as r1in,  \
+           records.open_file(r2_fname) as r2in:
+        stats = new_stats()
         paired = pair_reads(in1=r1in, in2=r2in,
                             id_match_pattern=opts.compare_regex,
                             parse_format=opts.to_format,
-                            join_direction=opts.inner_join)
+                            join_direction=opts.inner_join,
+                            buckets=opts.buckets,
+                            max_memory=parse_size(opts.max_memory),
+                            temp_dir=opts.temp_dir,
+                            stats=stats)
         _output(paired, (r1out, r2out),
                 output_format=opts.to_format, only_id=opts.mangle)
 
+    if not opts.inner_join:
+        logging.info("Paired %i reads. Dropped %i orphaned reads from %s "
+                     "and %i from %s. Skipped %i reads without a "
+                     "comparison key.", stats["paired"],
+                     stats["orphans_1"], r1_fname, stats["orphans_2"],
+                     r2_fname, stats["skipped"])
+
 
     
 
@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
 import sys
+import time
+import marshal
+import logging
 import optparse
+import tempfile
 from pprint import pformat
 from itertools import chain, repeat
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from Bio import SeqIO
 
+from . import records
+
 HELP="""%prog [options] -f <format> [-t <format>] -b barcode.fa <file1.fa> <file2.fa> [...]
 
 Available formats:
@@ -23,6 +29,22 @@ opts_list = [
     optparse.make_option('-b', '--barcode', action="store", 
                          dest="barcode_file", type="string", 
                          help="Barcode file to match headers"),
+    optparse.make_option('-w', '--window', action="store", type="int",
+                         dest="window", default=0,
+                         help="Look up reads by ID, holding up to this many"
+                         " reads across all files. Reads further out of"
+                         " order are set aside on disk, and barcodes whose"
+                         " read isn't found within twice this many more"
+                         " reads are skipped. By default, reads must be in"
+                         " the same order as the barcodes."),
+    optparse.make_option('-T', '--temp_dir', action="store", type="string",
+                         dest="temp_dir", default=None,
+                         help="With --window, set reads aside here. Defaults"
+                         " to the system temp directory"),
+    optparse.make_option('-l', '--logging', action="store", type="string",
+                         dest="logging", default="INFO",
+                         help="Logging verbosity, options are debug, info, "+
+                         "warning, and critical"),
 ]
 
 formats = SeqIO._FormatToWriter.keys()
@@ -32,7 +54,8 @@ nullobject = namedtuple("null", "id")(id=None)
 
 class Cache(object):
     def __init__(self, filename, format):
-        self.seqs = chain(SeqIO.parse(filename, format), repeat(nullobject))
+        self.seqs = chain(records.parse(filename, format),
+                          repeat(nullobject))
         self.peek = self.seqs.next()
 
     def next(self):
@@ -53,6 +76,109 @@ class Matcher(object):
         raise Exception("Unable to find header %s in reads" %sequence.id)
 
 
+class IndexedMatcher(object):
+    """Match barcodes to reads by ID, regardless of order.
+
+    Reads are read ahead from all files in turn and held in a window
+    of at most ``window`` reads keyed by ID. When the window is full,
+    the reads that have waited the longest are written to a temporary
+    file and looked up there by offset. Looking for a barcode reads at
+    most ``2 * window`` more reads; barcodes with no read by then are
+    counted and skipped. Reads with the same ID as one still held or
+    set aside are counted and dropped.
+
+    :param seq_file_list: List of strings; the read files
+    :param format: String; the format of the read files
+    :param window: Int; how many reads to hold in memory
+    :keyword temp_dir: String; where to put set aside reads
+
+    """
+
+    def __init__(self, seq_file_list, format, window, temp_dir=None):
+        self.window = window
+        self.files = [ records.parse(f, format) for f in seq_file_list ]
+        self.turn = 0
+        self.held = OrderedDict()
+        self.spilled = dict()
+        self.spill_file = tempfile.TemporaryFile(dir=temp_dir)
+        self.stats = {"matched": 0, "from_window": 0, "from_disk": 0,
+                      "read": 0, "spilled": 0, "missing": 0,
+                      "duplicate": 0}
+        self.start = time.time()
+
+    def _read_ahead(self):
+        """Read one more read, trying each file in turn. Returns None
+        once every file is used up."""
+        while self.files:
+            self.turn %= len(self.files)
+            read = next(self.files[self.turn], None)
+            if read is None:
+                del self.files[self.turn]
+                continue
+            self.turn += 1
+            self.stats["read"] += 1
+            return read
+        return None
+
+    def _spill(self):
+        id_, read = self.held.popitem(last=False)
+        self.spill_file.seek(0, 2)
+        self.spilled[id_] = self.spill_file.tell()
+        marshal.dump((read.id, read.seq, read.qual, read.description),
+                     self.spill_file)
+        self.stats["spilled"] += 1
+
+    def _unspill(self, id_):
+        self.spill_file.seek(self.spilled.pop(id_))
+        return records.Record(*marshal.load(self.spill_file))
+
+    def _hold(self, read):
+        if read.id in self.held or read.id in self.spilled:
+            self.stats["duplicate"] += 1
+            logging.warning("Dropping read with duplicate ID %s", read.id)
+            return
+        self.held[read.id] = read
+        if len(self.held) > self.window:
+            self._spill()
+
+    def _found(self, read, where):
+        self.stats["matched"] += 1
+        if where:
+            self.stats[where] += 1
+        return read
+
+    def match(self, sequence):
+        id_ = sequence.id
+        if id_ in self.held:
+            return self._found(self.held.pop(id_), "from_window")
+        if id_ in self.spilled:
+            return self._found(self._unspill(id_), "from_disk")
+        for _ in range(2 * self.window):
+            read = self._read_ahead()
+            if read is None:
+                break
+            if read.id == id_:
+                return self._found(read, None)
+            self._hold(read)
+        self.stats["missing"] += 1
+        logging.warning("Unable to find header %s in reads", id_)
+        return None
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        logging.info("Matched %(matched)i reads, %(from_window)i from the"
+                     " look-ahead window and %(from_disk)i set aside on"
+                     " disk. Read %(read)i reads and set aside"
+                     " %(spilled)i. %(missing)i barcodes had no read."
+                     " Dropped %(duplicate)i reads with duplicate IDs.",
+                     self.stats)
+        logging.info("%.0f reads matched per second",
+                     self.stats["matched"] / elapsed)
+
+    def close(self):
+        self.spill_file.close()
+
+
 
 def main():
     parser = optparse.OptionParser(option_list=opts_list, 
@@ -63,10 +189,24 @@ def main():
         parser.print_usage()
         sys.exit(1)
 
-    m = Matcher(sequences, opts.from_format)
-    with open(opts.barcode_file) as bc_f:
-        for sequence in SeqIO.parse(bc_f, opts.from_format):
-            SeqIO.write(m.match(sequence), sys.stdout, opts.to_format)
+    logging.getLogger().setLevel(getattr(logging, opts.logging.upper()))
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s")
+
+    if opts.window > 0:
+        m = IndexedMatcher(sequences, opts.from_format, opts.window,
+                           temp_dir=opts.temp_dir)
+    else:
+        m = Matcher(sequences, opts.from_format)
+    with records.open_file(opts.barcode_file) as bc_f, \
+         records.Writer(sys.stdout, opts.to_format) as writer:
+        for sequence in records.parse(bc_f, opts.from_format):
+            read = m.match(sequence)
+            if read is not None:
+                writer.write(read)
+
+    if opts.window > 0:
+        m.report()
+        m.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,503 @@
+"""Lightweight sequence record I/O shared by the utility scripts.
+
+Building a Biopython ``SeqRecord`` and calling ``SeqIO.write`` once
+per record is too slow for the read counts we routinely push through
+these scripts. This module provides a compact record type, FASTA and
+FASTQ parsers that work on large buffered reads, and a batched
+writer. Output is formatted the same way Biopython formats it, so the
+scripts produce the same files as before.
+
+Formats other than fasta, fastq and qual are handed off to Biopython
+and converted to and from :py:class:`Record` at the edges.
+
+"""
+
+import sys
+import bz2
+import gzip
+import Queue
+import string
+import marshal
+import threading
+from itertools import imap, izip
+
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqIO.QualityIO import _get_sanger_quality_str
+
+BUFSIZE = 4 * 1024 * 1024
+# rough size of the python objects holding one record in memory
+RECORD_OVERHEAD = 256
+
+_dna_complement = string.maketrans("ACGTMRWSYKVHDBXNacgtmrwsykvhdbxn",
+                                   "TGCAKYWSRMBDHVXNtgcakywsrmbdhvxn")
+_rna_complement = string.maketrans("ACGUMRWSYKVHDBXNacgumrwsykvhdbxn",
+                                   "UGCAKYWSRMBDHVXNugcakywsrmbdhvxn")
+# phred score for each phred+33 quality letter, as it's written in qual
+# files
+_phred_strs = dict( (chr(i), str(i-33)) for i in range(256) )
+
+
+def reverse_complement(seq):
+    """Reverse complement a sequence string. Like Biopython, treat the
+    sequence as RNA if it has U's and no T's."""
+    if ("U" in seq or "u" in seq) and not ("T" in seq or "t" in seq):
+        return seq.translate(_rna_complement)[::-1]
+    return seq.translate(_dna_complement)[::-1]
+
+
+def first_word(title):
+    return title.split(None, 1)[0] if title else ""
+
+
+def make_title(id_, desc):
+    """Build a title line from an ID and description the same way
+    Biopython's writers do."""
+    if desc and desc.split(None, 1)[0] == id_:
+        return desc
+    elif desc:
+        return id_+" "+desc
+    else:
+        return id_
+
+
+class Record(object):
+    """A single sequence record.
+
+    :param id: String; the sequence ID
+    :param seq: String; the sequence letters
+    :keyword qual: String; phred+33 (sanger) encoded qualities, or
+                   None if the record has no qualities
+    :keyword description: String; the full title line, as Biopython
+                          would set ``SeqRecord.description``
+
+    """
+
+    __slots__ = ("id", "description", "seq", "qual")
+
+    def __init__(self, id, seq, qual=None, description=""):
+        self.id = id
+        self.seq = seq
+        self.qual = qual
+        self.description = description
+
+    @classmethod
+    def from_title(cls, title, seq, qual=None):
+        return cls(first_word(title), seq, qual, title)
+
+    @classmethod
+    def from_seqrecord(cls, rec):
+        desc = rec.description
+        if desc == "<unknown description>":
+            desc = ""
+        qual = None
+        annots = rec.letter_annotations
+        if "phred_quality" in annots or "solexa_quality" in annots:
+            qual = _get_sanger_quality_str(rec)
+        return cls(rec.id, str(rec.seq), qual, desc)
+
+    def to_seqrecord(self):
+        annots = dict()
+        if self.qual is not None:
+            annots["phred_quality"] = [ ord(c)-33 for c in self.qual ]
+        return SeqRecord(Seq(self.seq), id=self.id, name=self.id,
+                         description=self.description,
+                         letter_annotations=annots)
+
+    def title(self):
+        return make_title(self.id, self.description)
+
+    def reverse_complement(self):
+        qual = self.qual[::-1] if self.qual is not None else None
+        return Record(self.id, reverse_complement(self.seq), qual,
+                      self.description)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __nonzero__(self):
+        # records are always true, like SeqRecord, even with no sequence
+        return True
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("Records can only be sliced")
+        qual = self.qual[index] if self.qual is not None else None
+        return Record(self.id, self.seq[index], qual, self.description)
+
+    def __repr__(self):
+        return "Record(id=%r, seq=%r, qual=%r, description=%r)" %(
+            self.id, self.seq, self.qual, self.description)
+
+
+class Stream(object):
+    """Wrap a file that can only be read front to back, like a pipe.
+    Without a ``tell`` method, Biopython parsers that need file
+    offsets (e.g. sff) count the bytes read themselves rather than
+    failing."""
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def read(self, size=-1):
+        return self.handle.read(size)
+
+    def readline(self, size=-1):
+        return self.handle.readline(size)
+
+    def __iter__(self):
+        return iter(self.handle)
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_file(fname, mode='rb'):
+    """Open ``fname``, decompressing on the fly if it ends in .gz or
+    .bz2. A ``fname`` of ``-`` opens stdin as a :py:class:`Stream`."""
+    if fname == '-':
+        return Stream(sys.stdin)
+    elif fname.endswith(".bz2"):
+        return bz2.BZ2File(fname, mode)
+    elif fname.endswith(".gz") or fname.endswith(".gzip"):
+        return gzip.GzipFile(fname, mode)
+    else:
+        return open(fname, mode)
+
+
+def lines(handle, bufsize=BUFSIZE):
+    """Yield lines from ``handle`` without the trailing newline, reading
+    ``bufsize`` bytes at a time."""
+    remainder = ""
+    while True:
+        chunk = handle.read(bufsize)
+        if not chunk:
+            break
+        chunk_lines = (remainder+chunk).split("\n")
+        remainder = chunk_lines.pop()
+        for line in chunk_lines:
+            yield line
+    if remainder:
+        yield remainder
+
+
+def parse_fasta(handle, bufsize=BUFSIZE):
+    it = lines(handle, bufsize)
+    for line in it:
+        if line.startswith(">"):
+            title = line[1:].rstrip()
+            break
+    else:
+        return
+
+    seq_lines = []
+    for line in it:
+        if line.startswith(">"):
+            seq = "".join(seq_lines).replace(" ", "").replace("\r", "")
+            yield Record.from_title(title, seq)
+            seq_lines = []
+            title = line[1:].rstrip()
+            continue
+        seq_lines.append(line.rstrip())
+
+    seq = "".join(seq_lines).replace(" ", "").replace("\r", "")
+    yield Record.from_title(title, seq)
+
+
+def parse_fastq(handle, bufsize=BUFSIZE):
+    it = lines(handle, bufsize)
+    for line in it:
+        if line.startswith("@"):
+            break
+        elif line.strip():
+            raise ValueError("Records in Fastq files should start"
+                             " with '@' character")
+    else:
+        return
+
+    while True:
+        title = line[1:].rstrip()
+        seq_lines = []
+        for line in it:
+            if line.startswith("+"):
+                break
+            seq_lines.append(line.rstrip())
+        else:
+            raise ValueError("End of file without quality information.")
+        if len(line) > 1 and line[1:].rstrip() != title:
+            raise ValueError("Sequence and quality captions differ.")
+        seq = "".join(seq_lines).replace(" ", "")
+
+        qual_lines, qual_len = [], 0
+        while qual_len < len(seq):
+            try:
+                line = next(it).rstrip()
+            except StopIteration:
+                raise ValueError("End of file without quality information.")
+            qual_lines.append(line)
+            qual_len += len(line)
+        qual = "".join(qual_lines)
+        if len(qual) != len(seq):
+            raise ValueError("Lengths of sequence and quality values"
+                             " differs for %s (%i and %i)."%(
+                                 title, len(seq), len(qual)))
+        yield Record.from_title(title, seq, qual)
+
+        for line in it:
+            if line.startswith("@"):
+                break
+            elif line.strip():
+                raise ValueError("Records in Fastq files should start"
+                                 " with '@' character")
+        else:
+            return
+
+
+def format_fasta(record, wrap=60):
+    seq = record.seq
+    chunks = [">", record.title(), "\n"]
+    for i in xrange(0, len(seq), wrap):
+        chunks.append(seq[i:i+wrap])
+        chunks.append("\n")
+    return "".join(chunks)
+
+
+def format_fastq(record):
+    if record.qual is None:
+        raise ValueError("No suitable quality scores found in "
+                         "letter_annotations of SeqRecord (id=%s)."%(
+                             record.id))
+    if len(record.qual) != len(record.seq):
+        raise ValueError("Record %s has sequence length %i but %i quality"
+                         " scores"%(record.id, len(record.seq),
+                                    len(record.qual)))
+    return "@%s\n%s\n+\n%s\n" %(record.title(), record.seq, record.qual)
+
+
+def format_qual(record, wrap=60):
+    if record.qual is None:
+        raise ValueError("No suitable quality scores found in "
+                         "letter_annotations of SeqRecord (id=%s)."%(
+                             record.id))
+    chunks = [">", record.title(), "\n"]
+    data = " ".join(map(_phred_strs.__getitem__, record.qual))
+    while len(data) > wrap:
+        i = data.rfind(" ", 0, wrap)
+        chunks.append(data[:i])
+        chunks.append("\n")
+        data = data[i+1:]
+    chunks.append(data)
+    chunks.append("\n")
+    return "".join(chunks)
+
+
+parsers = {
+    "fasta":        parse_fasta,
+    "fastq":        parse_fastq,
+    "fastq-sanger": parse_fastq,
+}
+
+formatters = {
+    "fasta":        format_fasta,
+    "fastq":        format_fastq,
+    "fastq-sanger": format_fastq,
+    "qual":         format_qual,
+}
+
+
+def parse(handle, format, bufsize=BUFSIZE):
+    """Iterate over the :py:class:`Record` objects in ``handle``, which
+    can be a file name or an open file. File names are opened with
+    :py:func:`open_file`. Formats without a native parser are read by
+    Biopython.
+
+    """
+    if isinstance(handle, basestring):
+        handle = open_file(handle)
+    if format in parsers:
+        return parsers[format](handle, bufsize)
+    else:
+        return imap(Record.from_seqrecord, SeqIO.parse(handle, format))
+
+
+class Writer(object):
+    """Collects formatted records and writes them to ``handle`` in
+    chunks of about ``bufsize`` bytes. Call :py:meth:`flush` or use
+    the writer as a context manager to write out what's left over.
+
+    """
+
+    def __init__(self, handle, format, bufsize=BUFSIZE):
+        self.handle = handle
+        self.format = format
+        self.bufsize = bufsize
+        self.formatter = formatters.get(format)
+        self._buf = []
+        self._size = 0
+
+    def write(self, record):
+        if self.formatter is None:
+            SeqIO.write(record.to_seqrecord(), self.handle, self.format)
+            return
+        s = self.formatter(record)
+        self._buf.append(s)
+        self._size += len(s)
+        if self._size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if self._buf:
+            self.handle.write("".join(self._buf))
+            self._buf = []
+            self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+class ThreadedWriter(object):
+    """A :py:class:`Writer` that formats and writes records on its own
+    thread, so writing overlaps with reading and with other writers.
+    Records are handed to the thread in lists of ``batch_size``; at
+    most ``max_batches`` lists wait in line. Call :py:meth:`close` or
+    use the writer as a context manager to finish writing. Errors on
+    the writing thread are raised on the next :py:meth:`write` or
+    :py:meth:`close`.
+
+    """
+
+    def __init__(self, handle, format, bufsize=BUFSIZE, batch_size=1000,
+                 max_batches=16):
+        self.writer = Writer(handle, format, bufsize)
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(max_batches)
+        self._batch = []
+        self._error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                for record in batch:
+                    self.writer.write(record)
+            except Exception:
+                self._error = sys.exc_info()
+        if self._error is None:
+            try:
+                self.writer.flush()
+            except Exception:
+                self._error = sys.exc_info()
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def write(self, record):
+        self._batch.append(record)
+        if len(self._batch) >= self.batch_size:
+            self._raise()
+            self.queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        if self._batch:
+            self.queue.put(self._batch)
+            self._batch = []
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._error = self._error or (exc_type, exc_value, traceback)
+            self.queue.put(None)
+            self.thread.join()
+
+
+def write(records, handle, format, bufsize=BUFSIZE):
+    """Write all ``records`` to ``handle``. Returns the number of
+    records written.
+
+    """
+    n = 0
+    with Writer(handle, format, bufsize) as writer:
+        for n, record in enumerate(records, 1):
+            writer.write(record)
+    return n
+
+
+class Buckets(object):
+    """Spill tuples of record fields into one of several files. Each
+    file holds marshalled lists of tuples; read them back with
+    :py:func:`load_bucket`. About ``bufsize`` bytes are held in
+    memory before writing, and ``sizes`` tracks about how much memory
+    each bucket takes up once read back in.
+
+    :param fnames: List of strings; a file name for each bucket
+    :keyword bufsize: Int; bytes to hold before writing
+
+    """
+
+    def __init__(self, fnames, bufsize=BUFSIZE):
+        self.fnames = fnames
+        self.bufsize = bufsize
+        self.handles = [ open(f, 'wb') for f in fnames ]
+        self.bufs = [ list() for _ in fnames ]
+        self.sizes = [ 0 for _ in fnames ]
+        self._held = 0
+
+    def add(self, bucket, fields):
+        size = RECORD_OVERHEAD + sum( len(f) for f in fields
+                                      if isinstance(f, basestring) )
+        self.bufs[bucket].append(fields)
+        self.sizes[bucket] += size
+        self._held += size
+        if self._held >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        for buf, handle in izip(self.bufs, self.handles):
+            if buf:
+                marshal.dump(buf, handle)
+                del buf[:]
+        self._held = 0
+
+    def close(self):
+        self.flush()
+        for handle in self.handles:
+            handle.close()
+
+
+def load_bucket(fname):
+    """Iterate over the tuples written to a :py:class:`Buckets` file"""
+    with open(fname, 'rb') as f:
+        while True:
+            try:
+                block = marshal.load(f)
+            except EOFError:
+                return
+            for fields in block:
+                yield fields
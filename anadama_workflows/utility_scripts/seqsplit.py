@@ -2,12 +2,17 @@
 import sys
 import logging
 import optparse
-import tempfile
 from pprint import pformat
 from contextlib import nested
 
 from Bio import SeqIO
 from Bio import BiopythonParserWarning
+
+from . import records
+
+# bytes of output buffered before each write to disk
+BUFSIZE = 8 * 1024 * 1024
+
 HELP="""%prog [options] -F <format> --fasta-out <file> [--qual_out <file>]
 
 %prog - Read in a sequence file from stdin, splitting sequence records
@@ -54,58 +59,57 @@ def main():
         parser.print_usage()
         sys.exit(1)
 
-    if not args:
-        logging.debug("Writing input to temporary file")
-        tmp_fp = tempfile.TemporaryFile()
-        map(tmp_fp.write, sys.stdin)
-        tmp_fp.seek(0)
-        args = [tmp_fp]
-    else:
-        args = [ open(f) for f in args ]
-        
-            
-    with nested(*args), open(opts.fasta_outfile, 'w') as fa_file:
+    # stdin is parsed as it arrives, so output starts right away
+    args = [ records.open_file(f) for f in (args or ["-"]) ]
 
+    with nested(*args), \
+         open(opts.fasta_outfile, 'w', BUFSIZE) as fa_file:
+
+        # the fasta and qual files are each formatted and written on
+        # their own thread while the main thread parses
+        fa_writer = records.ThreadedWriter(fa_file, "fasta")
         if opts.qual_outfile:
             # opening the qual_file here pains me
-            qual_file = open(opts.qual_outfile, 'w')
+            qual_file = open(opts.qual_outfile, 'w', BUFSIZE)
+            qual_writer = records.ThreadedWriter(qual_file, "qual")
             def _output(record):
-                SeqIO.write(record, fa_file, "fasta")
-                SeqIO.write(record, qual_file, "qual")
+                fa_writer.write(record)
+                qual_writer.write(record)
         else:
+            qual_writer = None
             def _output(record):
-                SeqIO.write(record, fa_file, "fasta")
+                fa_writer.write(record)
 
         if opts.reverse_compliment:
             def output(record):
-                record =  SeqIO.SeqRecord(
-                    record.reverse_complement().seq,
-                    letter_annotations=record.letter_annotations,
-                    id=record.id, 
-                    name=record.name, 
-                    description=record.description
+                record = records.Record(
+                    record.id,
+                    records.reverse_complement(record.seq),
+                    record.qual,
+                    record.description
                 )
                 return _output(record)
         else:
             output=_output
 
-        for fp in args:
-            for i, record in enumerate(SeqIO.parse(fp, opts.from_format)):
-                if opts.trim:
-                    tmp = record.letter_annotations.pop('phred_quality')
-                    record.seq = record.seq[opts.trim:]
-                    record.letter_annotations['phred_quality'] = tmp[opts.trim:]
-                if len(record.seq) <= 0:
-                    continue
-                try:
-                    output(record)
-                except BiopythonParserWarning as e:
-                    print >> sys.stderr, e
-                if logging.getLogger().isEnabledFor(logging.DEBUG):
-                    if i % 250 == 0 and i != 0:
-                        logging.debug("Converted %d records", i)
-            
-                
+        writers = [ w for w in (fa_writer, qual_writer) if w ]
+        with nested(*writers):
+            for fp in args:
+                for i, record in enumerate(records.parse(fp, opts.from_format)):
+                    if opts.trim:
+                        record = record[opts.trim:]
+                    if len(record.seq) <= 0:
+                        continue
+                    try:
+                        output(record)
+                    except BiopythonParserWarning as e:
+                        print >> sys.stderr, e
+                    if logging.getLogger().isEnabledFor(logging.DEBUG):
+                        if i % 250 == 0 and i != 0:
+                            logging.debug("Converted %d records", i)
+        if qual_writer:
+            qual_file.close()
+
 
 if __name__ == '__main__':
     main()
@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 
+import os
+import re
 import sys
+import heapq
+import shutil
+import marshal
 import optparse
+import tempfile
 import errno
+import multiprocessing
+from collections import deque
 from functools import partial
+from itertools import izip, chain, count
 from pprint import pformat
-from operator import attrgetter
+from operator import attrgetter, itemgetter
 
 from Bio import SeqIO
 
+from . import records
+
 HELP="""%prog [options] -f <format> [-t <format>] [<file> [<file> [ ...]]]
 
 %prog - Sort sequence files according to the sequence ID 
@@ -24,6 +35,19 @@ opts_list = [
     optparse.make_option('-t', '--to', action="store", 
                          dest="to_format", type="string", default="fasta",
                          help="The file format to convert to. Default fasta."),
+    optparse.make_option('-m', '--max-memory', action="store",
+                         dest="max_memory", type="string", default=None,
+                         help="Sort in sorted runs on disk, using about this"
+                         " much memory, e.g. 512M or 4G. By default, whole"
+                         " files are sorted in memory."),
+    optparse.make_option('-j', '--jobs', action="store", type="int",
+                         dest="jobs", default=1,
+                         help="With --max-memory, sort runs in parallel using"
+                         " this many processes. Default 1"),
+    optparse.make_option('-T', '--temp-dir', action="store", type="string",
+                         dest="temp_dir", default=None,
+                         help="Write sorted runs here. Defaults to the"
+                         " system temp directory"),
 ]
 
 id_ = attrgetter('id')
@@ -31,6 +55,155 @@ id_ = attrgetter('id')
 formats = SeqIO._FormatToWriter.keys()
 HELP += pformat(formats)
 
+# records are written to runs in marshalled blocks of about this size
+BLOCK_SIZE = 64 * 1024
+# most runs merged at once; more runs are merged in several passes
+MAX_FANIN = 64
+
+_units = { '': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4 }
+
+
+def parse_size(size_str):
+    """Convert a size like ``512M`` or ``4G`` into a number of bytes"""
+    match = re.match(r'^(\d+)([KMGT]?)B?$', size_str.strip().upper())
+    if not match:
+        raise ValueError("Unrecognized memory size `%s';"
+                         " try something like 4G."%(size_str))
+    return int(match.group(1)) * _units[match.group(2)]
+
+
+def _size(rec):
+    return (records.RECORD_OVERHEAD + len(rec[0]) + len(rec[1])
+            + len(rec[3]) + (len(rec[2]) if rec[2] is not None else 0))
+
+
+def _runs(seqs, run_size):
+    """Cut ``seqs`` into lists of record tuples taking up about
+    ``run_size`` bytes each"""
+    run, size = list(), 0
+    for rec in seqs:
+        rec = (rec.id, rec.seq, rec.qual, rec.description)
+        run.append(rec)
+        size += _size(rec)
+        if size >= run_size:
+            yield run
+            run, size = list(), 0
+    if run:
+        yield run
+
+
+def _dump_run(run, fname):
+    with open(fname, 'wb') as f:
+        block, size = list(), 0
+        for rec in run:
+            block.append(rec)
+            size += _size(rec)
+            if size >= BLOCK_SIZE:
+                marshal.dump(block, f)
+                block, size = list(), 0
+        if block:
+            marshal.dump(block, f)
+    return fname
+
+
+def _sort_run(args):
+    run, fname = args
+    run.sort(key=itemgetter(0))
+    return _dump_run(run, fname)
+
+
+def _load_run(fname, run_idx):
+    """Yield records from a run file as tuples that sort by ID, then by
+    where the record came from in the input"""
+    with open(fname, 'rb') as f:
+        n = 0
+        while True:
+            try:
+                block = marshal.load(f)
+            except EOFError:
+                return
+            for rec in block:
+                yield rec[0], run_idx, n, rec
+                n += 1
+
+
+def _merge(fnames):
+    merged = heapq.merge(*[ _load_run(fname, i)
+                            for i, fname in enumerate(fnames) ])
+    return ( item[3] for item in merged )
+
+
+def _sort_runs(runs, fnames, jobs):
+    """Sort each run and write it to the next of ``fnames``. Returns
+    the list of run files."""
+    args = izip(runs, fnames)
+    if jobs <= 1:
+        return map(_sort_run, args)
+
+    pool = multiprocessing.Pool(jobs)
+    pending = deque()
+    fnames = list()
+    try:
+        for arg in args:
+            pending.append(pool.apply_async(_sort_run, (arg,)))
+            if len(pending) >= jobs:
+                fnames.append(pending.popleft().get())
+        while pending:
+            fnames.append(pending.popleft().get())
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return fnames
+
+
+def external_sort(seqs, max_memory, jobs=1, temp_dir=None):
+    """Sort ``seqs`` by ID using about ``max_memory`` bytes. Sorted
+    runs of records are written to temporary files, ``jobs`` runs at
+    a time, then merged. Records with the same ID keep their input
+    order, same as ``sorted``.
+
+    :param seqs: Iterable of :py:class:`records.Record`
+    :param max_memory: Int; memory budget in bytes
+    :keyword jobs: Int; number of processes sorting runs
+    :keyword temp_dir: String; where to put the run files
+
+    Returns a list of sorted records if they all fit in memory,
+    otherwise a generator that removes the run files when it's done.
+
+    """
+    # a run is held in the parent while each worker sorts one
+    run_size = max_memory // (jobs+1) if jobs > 1 else max_memory
+    seqs = iter(seqs)
+    first = next(_runs(seqs, run_size), [])
+    peek = next(seqs, None)
+    if peek is None:
+        return [ records.Record(*rec)
+                 for rec in sorted(first, key=itemgetter(0)) ]
+
+    def _sorted():
+        workdir = tempfile.mkdtemp(prefix="sequence_sort", dir=temp_dir)
+        new_fnames = ( os.path.join(workdir, "run%d"%(i)) for i in count() )
+        try:
+            runs = chain([first], _runs(chain([peek], seqs), run_size))
+            fnames = _sort_runs(runs, new_fnames, jobs)
+            while len(fnames) > MAX_FANIN:
+                merged = list()
+                for i in xrange(0, len(fnames), MAX_FANIN):
+                    group = fnames[i:i+MAX_FANIN]
+                    merged.append(_dump_run(_merge(group), next(new_fnames)))
+                    map(os.remove, group)
+                fnames = merged
+            for rec in _merge(fnames):
+                yield records.Record(*rec)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return _sorted()
+
+
 def main():
     parser = optparse.OptionParser(option_list=opts_list, 
                                    usage=HELP)
@@ -40,18 +213,28 @@ def main():
         parser.print_usage()
         sys.exit(1)
 
+    if opts.max_memory:
+        max_memory = parse_size(opts.max_memory)
+        sort = partial(external_sort, max_memory=max_memory,
+                       jobs=opts.jobs, temp_dir=opts.temp_dir)
+    else:
+        sort = partial(sorted, key=id_)
+
     for file_ in sequences:
-        with open(file_, 'r') as f_in:
-            seqs = SeqIO.parse(f_in, opts.from_format)
+        with records.open_file(file_) as f_in:
+            seqs = records.parse(f_in, opts.from_format)
+            sorted_seqs = sort(seqs)
             try:
-                SeqIO.write(sorted(seqs, key=id_), sys.stdout, opts.to_format)
+                records.write(sorted_seqs, sys.stdout, opts.to_format)
             except IOError as e:
                 if e.errno == errno.EPIPE:
                     sys.exit(0)
+            finally:
+                if hasattr(sorted_seqs, "close"):
+                    sorted_seqs.close()
             
             del seqs
 
 
 if __name__ == '__main__':
     main()
-
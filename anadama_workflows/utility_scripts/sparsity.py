@@ -0,0 +1,116 @@
+"""Drop rare features from a PCL table before it goes to MaAsLin.
+
+A feature is kept if it has at least ``min_abundance`` in at least
+``min_prevalence`` of the samples. With numpy, the table is read in
+blocks of rows that are compared as arrays; rows of a block that
+don't all have the same number of samples are checked one at a time.
+The kept rows are written as they always were, each value formatted
+with ``str(float(value))``.
+
+"""
+
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# features at or above this abundance in a sample are present in it
+MIN_ABUNDANCE = 0.001
+# keep features present in this fraction of samples
+MIN_PREVALENCE = 0.1
+# rows of the table compared at once
+CHUNK_SIZE = 10000
+
+
+def _min_samples(n_samples, min_prevalence):
+    # int() rounds down like integer division did with the default
+    # of a tenth of the samples
+    return int(n_samples * min_prevalence)
+
+
+def _format(key, values):
+    return "\t".join([key] + map(str, values)) + "\n"
+
+
+def _filter_rows(lines, min_abundance, min_prevalence):
+    """Yield the lines of kept features, one row at a time"""
+    for line in lines:
+        fields = line.strip().split('\t')
+        key, values = fields[0], map(float, fields[1:])
+        present = sum( 1 for val in values if val >= min_abundance )
+        if present >= _min_samples(len(values), min_prevalence):
+            yield _format(key, values)
+
+
+def _block_values(split):
+    """Read the values of a block of rows into a numpy matrix, or
+    return None if the rows don't all have the same number of samples
+    or any value can't be read"""
+    if any( len(s) < 2 for s in split ):
+        return None
+    n_samples = split[0][1].count('\t') + 1
+    if any( rest.count('\t') + 1 != n_samples for _, rest in split ):
+        return None
+    # fromstring stops quietly at anything it can't read, so check the
+    # count; the trailing 0 makes sure a bad last value shortens it
+    text = "\t".join( rest for _, rest in split ) + "\t0"
+    values = np.fromstring(text, dtype=np.float64, sep='\t')
+    if len(values) != len(split) * n_samples + 1:
+        return None
+    return values[:-1].reshape(len(split), n_samples)
+
+
+def _filter_block(lines, min_abundance, min_prevalence):
+    """Yield the lines of kept features, comparing a block of rows at
+    once. Blocks that can't be read as a matrix go row by row, which
+    also raises the same errors for values that aren't numbers."""
+    split = [ line.strip().split('\t', 1) for line in lines ]
+    values = _block_values(split)
+    if values is None:
+        for out in _filter_rows(lines, min_abundance, min_prevalence):
+            yield out
+        return
+    # NaN is never present, as in the row by row comparison
+    with np.errstate(invalid='ignore'):
+        present = (values >= min_abundance).sum(axis=1)
+    keep = present >= _min_samples(values.shape[1], min_prevalence)
+    for i in np.flatnonzero(keep).tolist():
+        yield _format(split[i][0], values[i].tolist())
+
+
+def filter_pcl(in_fname, out_fname, min_abundance=MIN_ABUNDANCE,
+               min_prevalence=MIN_PREVALENCE, chunk_size=CHUNK_SIZE):
+    """Write the features of PCL file ``in_fname`` that have at least
+    ``min_abundance`` in at least ``min_prevalence`` of the samples to
+    ``out_fname``. The first line of ``in_fname`` is copied as it is.
+
+    :param in_fname: String; input PCL file name
+    :param out_fname: String; output PCL file name
+    :keyword min_abundance: Float; abundance at which a feature is
+                            present in a sample
+    :keyword min_prevalence: Float; fraction of samples a feature must
+                             be present in to be kept
+    :keyword chunk_size: Int; rows compared at once
+
+    Returns a tuple of the number of features read and the number
+    kept.
+
+    """
+    n = kept = 0
+    with open(in_fname) as in_f, open(out_fname, 'w') as out_f:
+        out_f.write( in_f.readline() ) # bump off metadata line
+        while True:
+            lines = list(islice(in_f, chunk_size))
+            if not lines:
+                break
+            n += len(lines)
+            if np is not None:
+                rows = _filter_block(lines, min_abundance, min_prevalence)
+            else:
+                rows = _filter_rows(lines, min_abundance, min_prevalence)
+            for row in rows:
+                out_f.write(row)
+                kept += 1
+    return n, kept
@@ -1,22 +1,133 @@
 import re
 import os
 import sys
+import json
+import time
+import errno
+import hashlib
+import heapq
+import Queue
+import resource
+import threading
+import datetime
 import subprocess
 import tempfile
 import optparse
+from array import array
 from operator import add
 from itertools import ifilterfalse
 from itertools import count
-from collections import defaultdict
+from itertools import izip
+from collections import Counter
 from collections import namedtuple
 from os.path import join
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from ..usearch import util
 from ..usearch import usearch_dict_flags as dict_flags
+from . import derep
+from . import biomtable
+
+# usearch options the in-process dereplicator can stand in for; with
+# any others, usearch8 dereplicates and sorts
+derep_flags = set(["sizeout", "minuniquesize"])
+sort_flags = set(["minsize", "maxsize"])
+
+
+class OTUCounts(object):
+    """Counts of hits per OTU and sample, kept as a sparse matrix.
+    OTU and sample IDs are numbered in the order they're first seen.
+    Hits are collected ``chunk_size`` at a time, then summed into
+    sorted arrays of (OTU, sample) codes and counts.
+
+    """
+
+    def __init__(self, chunk_size=1000000):
+        self.otu_ids, self.sample_ids = list(), list()
+        self._otu_codes, self._sample_codes = dict(), dict()
+        self.chunk_size = chunk_size
+        self._otus, self._samples = array('i'), array('i')
+        if np is not None:
+            self._keys = np.zeros(0, dtype=np.int64)
+            self._counts = np.zeros(0, dtype=np.int64)
+        else:
+            self._counter = Counter()
+
+    @staticmethod
+    def _intern(codes, ids, id_):
+        code = codes.get(id_)
+        if code is None:
+            code = codes[id_] = len(ids)
+            ids.append(id_)
+        return code
+
+    def add(self, otu_id, sample_id):
+        otu = self._intern(self._otu_codes, self.otu_ids, otu_id)
+        sample = self._intern(self._sample_codes, self.sample_ids, sample_id)
+        self._otus.append(otu)
+        self._samples.append(sample)
+        if len(self._otus) >= self.chunk_size:
+            self._reduce()
+
+    def _reduce(self):
+        if not self._otus:
+            return
+        if np is not None:
+            otus = np.array(self._otus, dtype=np.int64)
+            keys = (otus << 32) | np.array(self._samples, dtype=np.int64)
+            keys, inverse = np.unique(np.concatenate((self._keys, keys)),
+                                      return_inverse=True)
+            counts = np.concatenate((self._counts,
+                                     np.ones(len(otus), np.int64)))
+            self._keys = keys
+            self._counts = np.bincount(inverse, weights=counts,
+                                       minlength=len(keys)).astype(np.int64)
+        else:
+            self._counter.update(izip(self._otus, self._samples))
+        self._otus, self._samples = array('i'), array('i')
+
+    def csr(self):
+        """Get the table as compressed sparse rows, one row per OTU.
+        Returns a tuple of lists or numpy arrays: the counts, the sample
+        code of each count, and where each OTU's counts start."""
+        self._reduce()
+        if np is not None:
+            otus = self._keys >> 32
+            samples = self._keys & 0xffffffff
+            indptr = np.searchsorted(otus, np.arange(len(self.otu_ids)+1))
+            return self._counts, samples, indptr
+        keys = sorted(self._counter)
+        counts = [ self._counter[key] for key in keys ]
+        samples = [ sample for _, sample in keys ]
+        indptr = [0]*(len(self.otu_ids)+1)
+        for otu, _ in keys:
+            indptr[otu+1] += 1
+        return counts, samples, list(util.cumsum(indptr))
+
+    def rows(self, zero=0, convert=None):
+        """Yield each OTU ID and its list of counts per sample. Samples
+        without hits get ``zero``; counts are passed through
+        ``convert``, if given."""
+        data, indices, indptr = self.csr()
+        if np is not None:
+            indices, data = indices.tolist(), data.tolist()
+        for i, otu_id in enumerate(self.otu_ids):
+            start, end = indptr[i], indptr[i+1]
+            row = [zero]*len(self.sample_ids)
+            cnts = data[start:end]
+            if convert:
+                cnts = map(convert, cnts)
+            for sample, cnt in izip(indices[start:end], cnts):
+                row[sample] = cnt
+            yield otu_id, row
 
 
 class parse_otutable(object):
-    """Goes from a usearch mapping results file to an OTU table, 
+    """Goes from usearch mapping results files to an OTU table, 
     -> samples \/ OTUs 
 
     Assumes that search query sequences are from qiime-formatted
@@ -32,42 +143,120 @@ class parse_otutable(object):
 
     @staticmethod
     def fields(uc_fname):
+        targets = dict()
         with open(uc_fname) as f:
             for line in f:
                 if line.startswith("H"):
                     fields = line.split('\t')
                     query, target = fields[8], fields[9]
                     sample_id = query.split("_", 1)[0]
-                    otu_id = parse_otutable.parsetarget(target)
+                    otu_id = targets.get(target)
+                    if otu_id is None:
+                        otu_id = targets[target] = \
+                                 parse_otutable.parsetarget(target)
                     yield sample_id, otu_id
 
     @staticmethod
-    def get(d, items, default=0):
-        return [d.get(item, default) for item in items]
+    def count(uc_fnames):
+        """Count hits from each of ``uc_fnames`` into one
+        :py:class:`OTUCounts`"""
+        table = OTUCounts()
+        for uc_fname in uc_fnames:
+            for sample_id, otu_id in parse_otutable.fields(uc_fname):
+                table.add(otu_id, sample_id)
+        return table
 
     @staticmethod
-    def output(d, sample_ids):
-        sample_ids = list(sample_ids)
-        print "\t".join(["OTUId"]+list(sample_ids))
-        for otu_id, hits_dict in d.iteritems():
-            hits = parse_otutable.get(hits_dict, sample_ids, default=0)
-            print "\t".join([otu_id]+map(str, hits))
+    def output(table, out_f=sys.stdout):
+        out_f.write("\t".join(["OTUId"]+table.sample_ids)+"\n")
+        for otu_id, row in table.rows(zero="0", convert=str):
+            out_f.write("\t".join([otu_id]+row)+"\n")
 
+    @staticmethod
+    def output_biom(table, out_f=sys.stdout):
+        """Write ``table`` as a sparse biom 1.0 (json) file"""
+        data, indices, indptr = table.csr()
+        biomtable.write(out_f, table.otu_ids, table.sample_ids,
+                        data, indices, indptr,
+                        generated_by="uclust_otutable")
 
     @staticmethod
-    def main(uc_fname=None):
-        if not uc_fname:
-            uc_fname = sys.argv[1]
-        table_dict = defaultdict(lambda:defaultdict(int))
-        sample_ids = set()
-        for sample_id, otu_id in parse_otutable.fields(uc_fname):
-            sample_ids.add(sample_id)
-            table_dict[otu_id][sample_id] += 1
+    def output_hdf5(table, out_fname):
+        """Write ``table`` as a biom 2.1 (hdf5) file"""
+        import h5py
+        data, indices, indptr = table.csr()
+        data, indices = np.asarray(data), np.asarray(indices)
+        indptr = np.asarray(indptr)
+        # the same counts, ordered by sample for the sample matrix
+        otus = np.repeat(np.arange(len(table.otu_ids)), np.diff(indptr))
+        by_sample = np.lexsort((otus, indices))
+        sample_indptr = np.searchsorted(indices[by_sample],
+                                        np.arange(len(table.sample_ids)+1))
+        with h5py.File(out_fname, 'w') as f:
+            f.attrs['id'] = "No Table ID"
+            f.attrs['type'] = "OTU table"
+            f.attrs['format-url'] = "http://biom-format.org"
+            f.attrs['format-version'] = (2, 1)
+            f.attrs['generated-by'] = "uclust_otutable"
+            f.attrs['creation-date'] = datetime.datetime.now().isoformat()
+            f.attrs['shape'] = (len(table.otu_ids), len(table.sample_ids))
+            f.attrs['nnz'] = len(data)
+            axes = [
+                ("observation", table.otu_ids, data, indices, indptr),
+                ("sample", table.sample_ids, data[by_sample],
+                 otus[by_sample], sample_indptr),
+            ]
+            for axis, ids, axis_data, axis_indices, axis_indptr in axes:
+                grp = f.create_group(axis)
+                grp.create_dataset("ids", data=np.array(ids, dtype=object),
+                                   dtype=h5py.special_dtype(vlen=str))
+                grp.create_group("metadata")
+                grp.create_group("group-metadata")
+                mat = grp.create_group("matrix")
+                mat.create_dataset("data", data=axis_data.astype(np.float64))
+                mat.create_dataset("indices", data=axis_indices.astype(np.int32))
+                mat.create_dataset("indptr", data=axis_indptr.astype(np.int32))
 
-        parse_otutable.output(table_dict, sample_ids)
+    @staticmethod
+    def main(*uc_fnames, **kwargs):
+        """Tabulate hits from ``uc_fnames``. Write ``kwargs['format']``
+        (tsv, biom or hdf5) to ``kwargs['output']``, or stdout."""
+        if not uc_fnames:
+            uc_fnames = sys.argv[1:2]
+        format = kwargs.get("format", "tsv")
+        output = kwargs.get("output")
+        table = parse_otutable.count(uc_fnames)
+        if format == "hdf5":
+            return parse_otutable.output_hdf5(table, output)
+        write = parse_otutable.output_biom if format == "biom" \
+                else parse_otutable.output
+        if not output:
+            return write(table, sys.stdout)
+        with open(output, 'w') as out_f:
+            write(table, out_f)
 
 def parse_otu_table():
-    ret = parse_otutable.main(*sys.argv[1:])
+    HELP = ("%prog [options] <mapping_results.uc> [<more.uc> ...]\n\n"
+            "%prog - Tabulate OTU hits per sample from one or more usearch"
+            " mapping results files")
+    parser = optparse.OptionParser(usage=HELP, option_list=[
+        optparse.make_option('-f', '--format', type="choice",
+                             choices=["tsv", "biom", "hdf5"], default="tsv",
+                             help="Output format: tsv, biom (sparse json) or"
+                             " hdf5 (biom 2.1). Default tsv"),
+        optparse.make_option('-o', '--output', default=None,
+                             help="Write the table here instead of stdout."
+                             " Required for hdf5"),
+    ])
+    opts, uc_fnames = parser.parse_args()
+    if not uc_fnames or (opts.format == "hdf5" and not opts.output):
+        parser.print_usage()
+        sys.exit(1)
+    if opts.format != "tsv" and np is None:
+        print >> sys.stderr, "biom output needs numpy"
+        sys.exit(1)
+    ret = parse_otutable.main(*uc_fnames, format=opts.format,
+                              output=opts.output)
     sys.exit(ret)
 
 class ShellException(IOError):
@@ -83,85 +272,381 @@ def sh(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
             cmd, ret[0], ret[1]))
     return ret
 
+def sh_rusage(cmd, stdout, stderr, shell=True, **kwargs):
+    """Like :py:func:`sh`, but for output to files. Returns the
+    ``resource.struct_rusage`` of the command and the processes it
+    waited for."""
+    proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr,
+                            shell=shell,**kwargs)
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    if proc.returncode:
+        raise ShellException("Command `{}' failed. \nOut: {}\nErr: {}".format(
+            cmd, None, None))
+    return rusage
+
+def _sizes(fnames):
+    return sum(os.path.getsize(f) for f in fnames if os.path.exists(f))
+
+# bytes read from each end of a file to fingerprint it
+FINGERPRINT_BYTES = 1024 * 1024
+
+def fingerprint(fname, mtime=True):
+    """Describe a file by its size, optionally its mtime, and a hash of
+    its first and last ``FINGERPRINT_BYTES``"""
+    if os.path.isdir(fname):
+        return dict(dir=True)
+    stat = os.stat(fname)
+    digest = hashlib.md5()
+    with open(fname, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, stat.st_size-FINGERPRINT_BYTES))
+            digest.update(f.read())
+    fp = dict(size=stat.st_size, hash=digest.hexdigest())
+    if mtime:
+        fp['mtime'] = stat.st_mtime
+    return fp
+
+def _partial_fname(fname):
+    head, tail = os.path.split(fname)
+    return os.path.join(head, ".partial."+tail)
+
+def _redirect(cmd, fname, to_fname):
+    """Replace the file name ``fname`` in shell command ``cmd`` where
+    it's a word of its own"""
+    pat = (r'(?:^|(?<=[\s=<>\'"]))' + re.escape(fname)
+           + r'(?=$|[\s;|&<>\'"])')
+    return re.sub(pat, lambda _: to_fname, cmd)
+
 
 Step = namedtuple("Step", "idx cmd targets needs note")
 class ExecutionPlan(object):
+    """Steps to run, each a shell command string or a function, with
+    the files it needs and the files it makes. Steps run in order, or,
+    with ``jobs`` > 1, up to ``jobs`` at a time: a step starts once the
+    earlier steps that make, read, or remove its files are done. A
+    step without targets is taken to remove its needs, and one without
+    targets or needs waits for every earlier step and holds up every
+    later one. The plan stops at the first failed step.
+
+    Each step's wall time, CPU time, peak memory, and input and output
+    sizes are kept in ``telemetry``, and are written as json to
+    ``report_fname`` when the plan finishes. Shell commands are
+    measured by their own resource usage. Function steps run in this
+    process, so theirs can't be told apart from the rest of it: they
+    get ``process_cpu_user``, ``process_cpu_system`` and
+    ``process_max_rss_kb`` instead, the CPU time this whole process
+    used while the step ran, including other steps running with
+    ``jobs`` > 1, and its peak memory so far.
+
+    Shell commands write their targets under temporary names, which
+    are renamed into place once the command succeeds. Each finished
+    step leaves a manifest next to its first target with the command
+    and fingerprints of its needs and targets. With ``resume``, a step
+    is skipped only if its manifest matches the command and files as
+    they are now.
+
+    """
+
     def __init__(self, resume=False, quiet=False,
                  cmd_stdout=sys.stderr, cmd_stderr=sys.stderr,
                  report_cmd=False,
-                 report_f = lambda s: sys.stderr.write(s)):
+                 report_f = lambda s: sys.stderr.write(s), jobs=1,
+                 report_fname=None):
         self.resume = resume
         self.stdout = cmd_stdout
         self.stderr = cmd_stderr
         self.quiet = quiet
+        self.jobs = jobs
         self._report = report_f
         self._report_cmd = report_cmd
         self.steps = list()
         self._cntr = count(0)
+        self.report_fname = report_fname
+        self.telemetry = list()
+        self._done = 0
+        self._error = None
 
     def step(self, cmd, targets, needs, note=""):
         self.steps.append(Step(next(self._cntr), cmd, targets, needs, note))
 
     def _pct(self, step):
-        return (float(step.idx)/len(self.steps))*100
+        return (float(self._done)/len(self.steps))*100
 
-    def _msg(self, step, msg):
+    def _msg(self, step, msg, report=True):
         msg =  "[step #{i:02d} - {pct:.2f}% ] {msg} -- {note}.".format(
             i=step.idx+1, pct=self._pct(step), msg=msg, note=step.note
         )
         if self._report_cmd:
             msg += " "+step.cmd if type(step.cmd) is str else str(step.cmd)
-        self._report(msg+"\n")
+        if report:
+            self._report(msg+"\n")
         return msg
 
     def _skip(self, step):
+        self._record(step, "skipped")
         if not self.quiet:
             self._msg(step, "Skipped")
 
+    def _record(self, step, status, usage=None):
+        """Keep a step's telemetry. Steps that ran bring the size of
+        their needs from before they ran in ``usage``; for the rest
+        it's measured now."""
+        record = dict(step=step.idx+1, note=step.note, status=status,
+                      cmd=step.cmd if type(step.cmd) is str else str(step.cmd),
+                      output_bytes=_sizes(step.targets))
+        record.update(usage or {})
+        if 'input_bytes' not in record:
+            record['input_bytes'] = _sizes(step.needs)
+        self.telemetry.append(record)
+
     def _quit(self, step, override=False):
-        if not self.quiet and not override:
-            return self._msg(step, "Error! Quitting.")
+        return self._msg(step, "Error! Quitting.",
+                         report=not self.quiet and not override)
 
     def _runfunc(self, step):
+        before = resource.getrusage(resource.RUSAGE_SELF)
         try:
             step.cmd()
         except Exception as e:
-            self._quit(step._replace(note=e.message), override=True)
-            return False
+            error = step._replace(note=str(e))
         else:
-            return True
+            error = None
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        return error, dict(
+            process_cpu_user=after.ru_utime - before.ru_utime,
+            process_cpu_system=after.ru_stime - before.ru_stime,
+            process_max_rss_kb=after.ru_maxrss)
         
     def _runsh(self, step):
         try:
             if self.quiet:
                 with open(os.devnull, 'w') as null_f:
-                    sh(step.cmd, stdout=null_f, stderr=null_f)
+                    rusage = sh_rusage(step.cmd, stdout=null_f,
+                                       stderr=null_f)
             else:
-                sh(step.cmd, stdout=self.stdout, stderr=self.stderr)
+                rusage = sh_rusage(step.cmd, stdout=self.stdout,
+                                   stderr=self.stderr)
         except ShellException as e:
-            self._quit(step._replace(note=e.message), override=True)
-            return False
+            return step._replace(note=e.message), None
+        return None, dict(cpu_user=rusage.ru_utime,
+                          cpu_system=rusage.ru_stime,
+                          max_rss_kb=rusage.ru_maxrss)
+
+    def _execute(self, step):
+        """Run a step. Returns the step noted with the error if it
+        failed, or None, and a dict of the resources it used."""
+        start = time.time()
+        input_bytes = _sizes(step.needs)
+        if step.targets and os.path.exists(self._manifest_fname(step)):
+            os.remove(self._manifest_fname(step))
+        partials = dict()
+        if type(step.cmd) is str:
+            cmd = step.cmd
+            for target in step.targets:
+                redirected = _redirect(cmd, target, _partial_fname(target))
+                if redirected != cmd:
+                    partials[target] = _partial_fname(target)
+                    cmd = redirected
+            error, usage = self._runsh(step._replace(cmd=cmd))
         else:
-            return True
+            error, usage = self._runfunc(step)
+
+        if error is None:
+            for target, partial in partials.iteritems():
+                if os.path.exists(partial):
+                    os.rename(partial, target)
+            if step.targets:
+                self._write_manifest(step)
+        else:
+            written = partials.values()
+            if type(step.cmd) is not str:
+                written = step.targets
+            for fname in written:
+                if os.path.isfile(fname):
+                    os.remove(fname)
+        usage = usage or dict()
+        usage['wall'] = time.time() - start
+        usage['input_bytes'] = input_bytes
+        return error, usage
+
+    def _finished(self, step, error, usage):
+        self._record(step, "failed" if error else "ran", usage)
+        if error is not None:
+            self._fail(error)
 
     def run(self, step):
         if not self.quiet:
             self._msg(step, "Running")
+        self._error, usage = self._execute(step)
+        self._record(step, "failed" if self._error else "ran", usage)
+        return self._error is None
+
+    def graph(self):
+        """Get the set of earlier steps' indexes each step waits for"""
+        def _writes(step):
+            return set(step.targets) if step.targets else set(step.needs)
+        barrier = lambda step: not step.targets and not step.needs
+        deps = list()
+        for b in self.steps:
+            b_reads, b_writes = set(b.needs), _writes(b)
+            deps.append(set(
+                a.idx for a in self.steps[:b.idx]
+                if barrier(a) or barrier(b)
+                or _writes(a) & (b_reads | b_writes)
+                or set(a.needs) & b_writes
+            ))
+        return deps
+
+    def _ready(self, step):
+        """Check a step's needs before running it. Returns False if the
+        step can be skipped."""
+        missing = list(ifilterfalse(os.path.exists, step.needs))
+        if missing:
+            self._record(step, "missing")
+            raise IOError(self._quit(step))
+        elif self.resume and self._up_to_date(step):
+            self._skip(step)
+            return False
+        return True
+
+    @staticmethod
+    def _manifest_fname(step):
+        head, tail = os.path.split(step.targets[0])
+        return os.path.join(head, "."+tail+".manifest.json")
+
+    @staticmethod
+    def _manifest(step):
         if type(step.cmd) is str:
-            return self._runsh(step)
+            cmd = step.cmd
         else:
-            return self._runfunc(step)
+            cmd = "%s: %s"%(getattr(step.cmd, "__name__", ""), step.note)
+        return dict(
+            cmd=cmd,
+            needs=dict( (f, fingerprint(f)) for f in step.needs ),
+            targets=dict( (f, fingerprint(f, mtime=False))
+                          for f in step.targets ),
+        )
+
+    def _up_to_date(self, step):
+        if not step.targets:
+            return True
+        try:
+            with open(self._manifest_fname(step)) as f:
+                manifest = json.load(f)
+            return manifest == self._manifest(step)
+        except (IOError, OSError, ValueError):
+            return False
+
+    def _write_manifest(self, step):
+        fname = self._manifest_fname(step)
+        with open(_partial_fname(fname), 'w') as f:
+            json.dump(self._manifest(step), f)
+        os.rename(_partial_fname(fname), fname)
+
+    def _fail(self, error):
+        raise ShellException(self._quit(error))
 
     def go(self):
-        for step in self.steps:
-            missing = list(ifilterfalse(os.path.exists, step.needs))
-            if missing:
-                msg = self._quit(step)
-                raise IOError(msg)
-            elif all(os.path.exists(t) for t in step.targets) and self.resume:
-                self._skip(step)
-                continue
-            self.run(step)
+        try:
+            if self.jobs <= 1:
+                for step in self.steps:
+                    if self._ready(step) and not self.run(step):
+                        self._fail(self._error)
+                    self._done += 1
+            else:
+                self._go_parallel()
+        finally:
+            if self.report_fname:
+                self.write_report(self.report_fname)
+
+    def write_report(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(dict(jobs=self.jobs, steps=self.telemetry), f,
+                      indent=2, sort_keys=True)
+
+    def summary(self):
+        """Format ``telemetry`` as a table. CPU time and peak memory
+        of the whole process, for function steps, are marked with *"""
+        rows = [("step", "status", "wall_s", "cpu_s", "max_rss_mb",
+                 "in_mb", "out_mb", "note")]
+        process_wide = False
+        for rec in sorted(self.telemetry, key=lambda r: r['step']):
+            prefix, mark = "", ""
+            if 'process_max_rss_kb' in rec:
+                prefix, mark, process_wide = "process_", "*", True
+            cpu = (rec.get(prefix+'cpu_user', 0)
+                   + rec.get(prefix+'cpu_system', 0))
+            rows.append((
+                "%02d"%(rec['step']), rec['status'],
+                "%.1f"%(rec.get('wall', 0)), "%.1f%s"%(cpu, mark),
+                "%.1f%s"%(rec.get(prefix+'max_rss_kb', 0)/1024., mark),
+                "%.1f"%(rec['input_bytes']/1024./1024),
+                "%.1f"%(rec['output_bytes']/1024./1024), rec['note'],
+            ))
+        widths = [ max(len(row[i]) for row in rows)
+                   for i in range(len(rows[0])-1) ]
+        lines = [ "  ".join([ col.rjust(w) for col, w in zip(row, widths) ]
+                            + [row[-1]])
+                  for row in rows ]
+        if process_wide:
+            lines.append("* whole process, not just this step")
+        return "\n".join(lines)
+
+    def _go_parallel(self):
+        waiting = dict( (i, d) for i, d in enumerate(self.graph()) )
+        ready = [ i for i, d in waiting.iteritems() if not d ]
+        heapq.heapify(ready)
+        finished = Queue.Queue()
+        running = 0
+
+        def _run(step):
+            finished.put( (step,) + self._execute(step) )
+
+        def _finish(step):
+            self._done += 1
+            del waiting[step.idx]
+            for i, d in waiting.iteritems():
+                if step.idx in d:
+                    d.discard(step.idx)
+                    if not d:
+                        heapq.heappush(ready, i)
+
+        try:
+            while waiting:
+                while ready and running < self.jobs:
+                    step = self.steps[heapq.heappop(ready)]
+                    if not self._ready(step):
+                        _finish(step)
+                        continue
+                    if not self.quiet:
+                        self._msg(step, "Running")
+                    thread = threading.Thread(target=_run, args=(step,))
+                    thread.daemon = True
+                    thread.start()
+                    running += 1
+                if not running:
+                    break
+                step, error, usage = finished.get()
+                running -= 1
+                self._finished(step, error, usage)
+                _finish(step)
+        finally:
+            # let steps already started finish
+            while running:
+                step, error, usage = finished.get()
+                self._record(step, "failed" if error else "ran", usage)
+                running -= 1
             
 
 
@@ -188,27 +673,39 @@ def pick_denovo_otus(execution_plan, fasta_in, otutab_out,
     plan.step(cmd, [trunc_out], [fasta_in],
               note="Truncating to uniform length")
 
-    # dereplicate
+    # dereplicate and sort
     default_derep_opts = dict([
         ("sizeout", ""),
     ]+list(derep_opts.items()))
-    
-    derep_out = join(tmp_folder, "derep.fa")
-    derep_cmd = ("usearch8 -derep_fulllength "+trunc_out+
-                 " -fastaout "+derep_out+
-                 " "+dict_flags(default_derep_opts))
-    plan.step(derep_cmd, [derep_out], [trunc_out],
-              note="Dereplicating reads")
-
-    # sort
     default_sort_opts = dict([
         ("minsize","2"),
     ]+list(sort_opts.items()))
 
+    derep_out = join(tmp_folder, "derep.fa")
     sort_out = join(tmp_folder, "sorted.fa")
-    sort_cmd = ("usearch8 -sortbysize "+derep_out+" -fastaout "+sort_out+
-                " "+dict_flags(default_sort_opts))
-    plan.step(sort_cmd, [sort_out], [derep_out], note="Sorting reads")
+    if set(default_derep_opts) <= derep_flags \
+       and set(default_sort_opts) <= sort_flags:
+        minsize = max(int(default_derep_opts.get("minuniquesize", 1)),
+                      int(default_sort_opts["minsize"]))
+        maxsize = int(default_sort_opts.get("maxsize", 0)) or None
+        derep_f = lambda: derep.dereplicate(trunc_out, sort_out,
+                                            minsize=minsize,
+                                            maxsize=maxsize,
+                                            temp_dir=tmp_folder)
+        plan.step(derep_f, [sort_out], [trunc_out],
+                  note="Dereplicating and sorting reads")
+        intermediates = [sort_out]
+    else:
+        derep_cmd = ("usearch8 -derep_fulllength "+trunc_out+
+                     " -fastaout "+derep_out+
+                     " "+dict_flags(default_derep_opts))
+        plan.step(derep_cmd, [derep_out], [trunc_out],
+                  note="Dereplicating reads")
+        sort_cmd = ("usearch8 -sortbysize "+derep_out+
+                    " -fastaout "+sort_out+
+                    " "+dict_flags(default_sort_opts))
+        plan.step(sort_cmd, [sort_out], [derep_out], note="Sorting reads")
+        intermediates = [derep_out, sort_out]
 
     # cluster
     default_cluster_opts = dict([
@@ -258,7 +755,7 @@ def pick_denovo_otus(execution_plan, fasta_in, otutab_out,
     plan.step(otu_cmd, [otutab_out], [map_out], note="Tabulate OTU counts")
 
     if remove_tempfiles:
-        to_rm = [derep_out, sort_out, cluster_otus_out, map_out]
+        to_rm = intermediates + [cluster_otus_out, map_out]
         cleanup_cmd = "rm " + " ".join(to_rm)
         plan.step(cleanup_cmd, [], to_rm, "Remove temporary files")
         
@@ -266,40 +763,88 @@ def pick_denovo_otus(execution_plan, fasta_in, otutab_out,
 
 
 
+def _closed_hits(closed_out):
+    """Yield the query and target of each line of a .uc file"""
+    with open(closed_out) as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) > 1:
+                yield fields[-2], fields[-1]
+
+
+def _load_taxonomy(taxonomy_fname, targets):
+    """Read the names of only the reference sequences in ``targets``"""
+    idx = dict()
+    with open(taxonomy_fname) as f:
+        for line in f:
+            ref_id, _, taxy = line.strip().partition('\t')
+            if ref_id in targets:
+                idx[ref_id] = taxy
+    return idx
+
+
+def _load_otu_table(otutab_fname):
+    """Read an OTU table like uclust_otutable writes. Returns the
+    header fields, the OTU IDs, and the counts as a numpy matrix with
+    one row per OTU, or a list of lists without numpy."""
+    with open(otutab_fname) as f:
+        header = f.readline().strip().split('\t')
+        otu_ids, counts = list(), list()
+        for line in f:
+            otu_id, _, rest = line.strip().partition('\t')
+            if otu_id:
+                otu_ids.append(otu_id)
+                counts.append(rest)
+    if np is None:
+        return header, otu_ids, [ map(int, c.split('\t')) for c in counts ]
+    matrix = np.fromstring("\t".join(counts), dtype=np.int64, sep=" ")
+    return header, otu_ids, matrix.reshape(len(otu_ids), len(header)-1)
+
+
 def format_otu_table(taxonomy_fname, denovo_otutab, closed_out, out_tsv):
-    def fields(fname, get_idxs=None):
-        get = lambda item: item
-        if get_idxs:
-            get = lambda item: [item[idx] for idx in get_idxs]
-        with open(fname) as f:
-            for line in f:
-                line = line.strip().split('\t')
-                if line:
-                    yield get(line)
-
-    idx = dict(fields(taxonomy_fname))
-    otu_rows = fields(denovo_otutab)
-    otu_header = next(otu_rows)
-    otu_idx = dict([ (row[0], row) for row in otu_rows ])
-
-    default = lambda: [0 for _ in otu_header[1:]]
-    output_dict = defaultdict(default)
-    for query, target in fields(closed_out, get_idxs=(-2, -1)):
-        otu_id = re.search("OTU_(\d+)", query).group(1)
-        if otu_id not in otu_idx:
-            continue
-        abd = map(int, otu_idx[otu_id][1:])
+    """Name the OTUs in ``denovo_otutab`` by the reference sequence hit
+    for each in ``closed_out``, summing together the counts of OTUs
+    that hit the same reference. OTUs that hit a reference without a
+    name in ``taxonomy_fname`` are summed into OTU 0, Unclassified."""
+    header, otu_ids, matrix = _load_otu_table(denovo_otutab)
+    otu_row = dict( (otu_id, i) for i, otu_id in enumerate(otu_ids) )
+
+    rows, targets = list(), list()
+    for query, target in _closed_hits(closed_out):
+        row = otu_row.get(re.search("OTU_(\d+)", query).group(1))
+        if row is not None:
+            rows.append(row)
+            targets.append(target)
+    idx = _load_taxonomy(taxonomy_fname, set(targets))
+
+    # number each (reference, taxonomy) group, then sum rows by group
+    group_codes, groups, group_of = dict(), list(), list()
+    for target in targets:
         taxy = idx.get(target, "Unclassified")
-        if taxy == "Unclassified":
-            otu_id = "0"
-        else:
-            otu_id = target
-        current = output_dict[(otu_id, taxy)]
-        output_dict[(otu_id, taxy)] = map(add, current, abd)
+        key = ("0", taxy) if taxy == "Unclassified" else (target, taxy)
+        code = group_codes.get(key)
+        if code is None:
+            code = group_codes[key] = len(groups)
+            groups.append(key)
+        group_of.append(code)
+
+    if np is None:
+        sums = [ [0]*(len(header)-1) for _ in groups ]
+        for row, code in izip(rows, group_of):
+            sums[code] = map(add, sums[code], matrix[row])
+    elif groups:
+        group_of = np.array(group_of, dtype=np.int64)
+        order = np.argsort(group_of, kind="mergesort")
+        starts = np.searchsorted(group_of[order], np.arange(len(groups)))
+        sums = np.add.reduceat(matrix[np.array(rows)[order]], starts, axis=0)
+    else:
+        sums = np.zeros((0, matrix.shape[1]), dtype=np.int64)
 
     with open(out_tsv, 'w') as out_f:
-        print >> out_f, "\t".join(list(otu_header)+["taxonomy"])
-        for (otu_id, taxy), abd in output_dict.iteritems():
+        print >> out_f, "\t".join(list(header)+["taxonomy"])
+        if np is not None:
+            sums = sums.tolist()
+        for (otu_id, taxy), abd in izip(groups, sums):
             abd = map(str, abd)
             print >> out_f, "\t".join([otu_id]+abd+[taxy])
     
@@ -367,11 +912,19 @@ global_opts = [
                          action="store_false", help="Removes the tmp_dir"),
     optparse.make_option("--resume", default=False, action="store_true",
                          help="Resume from intermediate files"),
+    optparse.make_option('-j', "--jobs", default=1, type="int",
+                         help=("Run up to this many independent steps at"
+                               " once. Default 1")),
     optparse.make_option('-q', "--quiet", default=False, action="store_true",
                          help="Shush!"),
     optparse.make_option('--print_cmd', action="store_true", default=False,
                          help="Print what commands I run"),
-    optparse.make_option('-l', '--log_file', help="Write logs to this file"),
+    optparse.make_option('-l', '--log_file', help=("Write logs to this file,"
+                         " and how long each step took and the resources it"
+                         " used to <log_file>.json")),
+    optparse.make_option('--summary', action="store_true", default=False,
+                         help=("Print how long each step took and the"
+                               " resources it used at the end")),
     optparse.make_option("-c", '--chimera_standard', action="store",
                          type="string", 
                          help=("Fasta DNA sequence file that contains "
@@ -435,10 +988,11 @@ def denovo_cli():
         plan = ExecutionPlan(resume=opts.resume, quiet=False,
                              cmd_stdout=log_f, cmd_stderr=log_f,
                              report_cmd=opts.print_cmd, report_f=lambda s:
-                             log_f.write(s+"\n") )
+                             log_f.write(s+"\n"), jobs=opts.jobs,
+                             report_fname=opts.log_file+".json" )
     else:
         plan = ExecutionPlan(resume=opts.resume, quiet=opts.quiet,
-                             report_cmd=opts.print_cmd)
+                             report_cmd=opts.print_cmd, jobs=opts.jobs)
 
     plan = pick_denovo_otus(plan, opts.input, opts.output,
                             opts.chimera_standard,
@@ -450,6 +1004,9 @@ def denovo_cli():
     except (ShellException, IOError) as e:
         print >> sys.stderr, str(e)
         sys.exit(1)
+    finally:
+        if opts.summary:
+            print >> sys.stderr, plan.summary()
 
 
 def closed_cli():
@@ -499,10 +1056,11 @@ def closed_cli():
         plan = ExecutionPlan(resume=opts.resume, quiet=False,
                              cmd_stdout=log_f, cmd_stderr=log_f,
                              report_cmd=opts.print_cmd, report_f=lambda s:
-                             log_f.write(s+"\n") )
+                             log_f.write(s+"\n"), jobs=opts.jobs,
+                             report_fname=opts.log_file+".json" )
     else:
         plan = ExecutionPlan(resume=opts.resume, quiet=opts.quiet,
-                             report_cmd=opts.print_cmd)
+                             report_cmd=opts.print_cmd, jobs=opts.jobs)
 
     plan = pick_otus_closed_ref(plan, opts.input, opts.output,
                                 opts.taxonomy, opts.reference,
@@ -516,4 +1074,7 @@ def closed_cli():
     except (ShellException, IOError) as e:
         print >> sys.stderr, str(e)
         sys.exit(1)
+    finally:
+        if opts.summary:
+            print >> sys.stderr, plan.summary()
 
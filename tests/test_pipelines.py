@@ -175,6 +175,22 @@ def test__to_merged_fullpath():
     b = base+"foobaz_stitched.fastq"
     assert a == b 
  
+def test_usearch_util_hist_cached():
+    """ Test fasta length histograms match a count of parsed sequences """
+    from collections import Counter
+    from anadama_workflows.usearch import util
+    temp_directory=tempfile.mkdtemp(prefix="anadama_workflows_test_hist")
+    fname=os.path.join(temp_directory,"47.fasta")
+    shutil.copy(os.path.join(data_folder(),"16S_demultiplexed","47.fasta"),
+                fname)
+    with open(fname) as f:
+        cnts=Counter(len(seq) for _, seq in util.fasta_sequences(f))
+    expected=sorted(cnts.items(), reverse=True)
+    yield eq, util.hist(fname), expected
+    yield eq, os.path.exists(fname+".lengths.json"), True
+    yield eq, util.hist(fname), expected
+    remove_temp_folder(temp_directory)
+
 def test_demultiplexed_usearch64_16S():
     """ Test the usearch64 bit 16S pipeline on a set of demultiplexed samples
     that are qiime fasta formatted """
@@ -0,0 +1,761 @@
+import os
+import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from Bio import SeqIO
+from nose.plugins.skip import SkipTest
+from nose.tools import with_setup
+
+from anadama_workflows.utility_scripts import (
+    records, convert, sort, pair, re_pair, bam_pe_split, demux, uclust,
+    derep, orient, biomtable, copynumber, sparsity
+)
+try:
+    from anadama_workflows.utility_scripts import batch
+except ImportError:
+    batch = None
+
+
+FASTQ = ("@read_1 extra words\n"
+         "ACGTNacgtRYKM\n"
+         "+\n"
+         "IIIII#####AB@\n"
+         "@read_2\n"
+         "GGGC\n"
+         "TTA\n"
+         "+read_2\n"
+         "@@@@\n"
+         "@@@\n")
+
+
+FOUR_LINE_FASTQ = ("@read_3 more words\n"
+                   "ACGUUAGGCUA\n"
+                   "+\n"
+                   "ABCDEFGHIJK\n"
+                   "@read_4\n"
+                   "GATTACAGATTACA\n"
+                   "+read_4\n"
+                   "IIIIIIII######\n"
+                   "@read_5\n"
+                   "\n"
+                   "+\n"
+                   "\n")
+
+
+def data_folder():
+    """ Get the full path to the tests data folder """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+
+tmpdir = None
+
+def make_tmpdir():
+    """ Make a fresh temporary directory for a test """
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def remove_tmpdir():
+    shutil.rmtree(tmpdir)
+
+def tmp_file(name):
+    """ Get the full path to a file in the test's temporary directory """
+    return os.path.join(tmpdir, name)
+
+def biopython_output(handle, from_format, to_format, func=None):
+    out = StringIO()
+    seqs = SeqIO.parse(handle, from_format)
+    if func:
+        seqs = map(func, seqs)
+    SeqIO.write(seqs, out, to_format)
+    return out.getvalue()
+
+def records_output(handle, from_format, to_format, func=None):
+    out = StringIO()
+    seqs = records.parse(handle, from_format, bufsize=7)
+    if func:
+        seqs = map(func, seqs)
+    records.write(seqs, out, to_format)
+    return out.getvalue()
+
+def test_records_fastq_matches_biopython():
+    """ Test that fastq records are written just like biopython """
+    for to_format in ("fastq", "fasta", "qual"):
+        expected = biopython_output(StringIO(FASTQ), "fastq", to_format)
+        result = records_output(StringIO(FASTQ), "fastq", to_format)
+        assert expected == result
+
+def test_records_fasta_matches_biopython():
+    """ Test that wrapped fasta files are rewrapped like biopython """
+    fname = os.path.join(data_folder(), "16S_demultiplexed", "47.fasta")
+    with open(fname) as f:
+        expected = biopython_output(f, "fasta", "fasta")
+    with open(fname) as f:
+        result = records_output(f, "fasta", "fasta")
+    assert expected == result
+
+def test_records_reverse_complement_matches_biopython():
+    """ Test reverse complement and slicing of records """
+    bio = lambda r: r.reverse_complement(id=True, description=True)[2:9]
+    expected = biopython_output(StringIO(FASTQ), "fastq", "fastq", bio)
+    rec = lambda r: r.reverse_complement()[2:9]
+    result = records_output(StringIO(FASTQ), "fastq", "fastq", rec)
+    assert expected == result
+
+def test_records_biopython_fallback():
+    """ Test formats without a native writer go through biopython """
+    expected = biopython_output(StringIO(FASTQ), "fastq", "fastq-illumina")
+    result = records_output(StringIO(FASTQ), "fastq", "fastq-illumina")
+    assert expected == result
+
+def test_records_threaded_writer():
+    """ Test the threaded writer writes records like the plain writer """
+    for to_format in ("fasta", "qual"):
+        out = StringIO()
+        with records.ThreadedWriter(out, to_format, batch_size=7) as writer:
+            for rec in records.parse(records.Stream(StringIO(FASTQ*500)),
+                                     "fastq"):
+                writer.write(rec)
+        assert records_output(StringIO(FASTQ*500), "fastq", to_format) \
+            == out.getvalue()
+
+def test_convert_parallel_matches_serial():
+    """ Test parallel sequence conversion keeps order and mangled names """
+    fname = os.path.join(data_folder(), "16S_demultiplexed", "47.fasta")
+    opts = dict(format="fasta", to="fasta", revcomp=True, filters=[">100"],
+                slicer="5:80", mangler_base="foo", chunk_size=7)
+    outputs = []
+    for jobs in (1, 3):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            convert.convert(fname, fname, jobs=jobs, **opts)
+            outputs.append(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+    assert outputs[0] == outputs[1]
+
+def test_batch_matches_records():
+    """ Test vectorized filtering, slicing and reverse complement """
+    if batch is None:
+        raise SkipTest("numpy isn't installed")
+    rec = lambda r: r.reverse_complement()[-12:9]
+    for text in (FOUR_LINE_FASTQ, FOUR_LINE_FASTQ+FASTQ):
+        for to_format in ("fastq", "fasta"):
+            seqs = [ rec(r) for r in records.parse(StringIO(text), "fastq")
+                     if len(r) < 13 ]
+            out = StringIO()
+            records.write(seqs, out, to_format)
+            result = list()
+            for b in batch.parse(StringIO(text), "fastq", bufsize=7):
+                b = b.select(b.lengths < 13)
+                b = b.reverse_complement().slice(-12, 9)
+                result.append(batch.formatters[to_format](b))
+            assert out.getvalue() == "".join(result)
+
+def test_external_sort_matches_sorted():
+    """ Test sorting in runs on disk keeps records with equal IDs in order """
+    seqs = [ records.Record("id%d"%(i % 7), "ACGT"*(i % 5), description=str(i))
+             for i in range(300) ]
+    expected = sorted(seqs, key=sort.id_)
+    sort.MAX_FANIN, fanin = 3, sort.MAX_FANIN
+    try:
+        for jobs in (1, 2):
+            result = list(sort.external_sort(seqs, 4000, jobs=jobs))
+            assert ([ (r.id, r.description) for r in expected ]
+                    == [ (r.id, r.description) for r in result ])
+    finally:
+        sort.MAX_FANIN = fanin
+
+def test_pair_buckets_match_cache():
+    """ Test pairing in buckets on disk finds the same pairs and orphans """
+    fastq = lambda ids: "".join("@%s\nAC\n+\nII\n"%(i) for i in ids)
+    r1 = fastq([ "r%d"%(i) for i in range(0, 90) ])
+    r2 = fastq([ "r%d"%(i) for i in range(120, 0, -2) ])
+    results = list()
+    for kwargs in (dict(), dict(buckets=3), dict(buckets=3, max_memory=500)):
+        stats = pair.new_stats()
+        pairs = pair.pair_reads(StringIO(r1), StringIO(r2), r'^(\S+)\s?.*$',
+                                "fastq", stats=stats, **kwargs)
+        results.append(sorted( (a.id, b.id) for a, b in pairs ))
+        assert stats == {"paired": 44, "orphans_1": 46, "orphans_2": 16,
+                         "skipped": 0}
+    assert all( a == b for a, b in results[0] )
+    assert results[0] == results[1] == results[2]
+
+def test_pair_buckets_split_again():
+    """ Test keys sharing a bucket are spread out when it's split again """
+    keys = [ "r%d"%(i) for i in range(20000) ]
+    for n_buckets in (10, 16):
+        same = [ k for k in keys if pair._bucket_of(k, n_buckets, 0) == 3 ]
+        for level in (1, 2):
+            sub = set( pair._bucket_of(k, n_buckets, level) for k in same )
+            assert sub == set(range(n_buckets))
+
+def test_pair_empty_reads():
+    """ Test reads trimmed to nothing are still paired """
+    assert records.Record("r1", "", "", "")
+    fastq = "@r1\n\n+\n\n@r2\nAC\n+\nII\n"
+    for kwargs in (dict(), dict(buckets=2)):
+        stats = pair.new_stats()
+        pairs = pair.pair_reads(StringIO(fastq), StringIO(fastq),
+                                r'^(\S+)\s?.*$', "fastq", stats=stats,
+                                **kwargs)
+        assert sorted( (a.id, b.seq) for a, b in pairs ) == [
+            ("r1", ""), ("r2", "AC")]
+        assert stats["paired"] == 2
+
+def test_indexed_matcher_out_of_order():
+    """ Test matching barcodes to reads out of order, setting reads aside """
+    fastq = lambda ids: StringIO("".join("@%s\nAC\n+\nII\n"%(i)
+                                         for i in ids))
+    ids = [ "r%d"%(i) for i in range(40) ]
+    # each block of 8 reads is matched backwards
+    barcodes = [ i for b in range(0, 40, 8) for i in reversed(ids[b:b+8]) ]
+    m = re_pair.IndexedMatcher([fastq(ids[::2]), fastq(ids[1::2])],
+                               "fastq", window=5)
+    matched = [ m.match(records.Record(i, ""))
+                for i in ["missing"] + barcodes + ["missing"] ]
+    m.close()
+    assert [ r.id for r in matched[1:-1] ] == barcodes
+    assert matched[0] is None and matched[-1] is None
+    assert m.stats["missing"] == 2
+    assert m.stats["from_disk"] > 0
+
+    # reads too far ahead are given up on, without reading everything
+    # and the second read with the same ID is dropped
+    m = re_pair.IndexedMatcher([fastq(["r0"] + ids)], "fastq", window=5)
+    assert m.match(records.Record("r39", "")) is None
+    assert m.stats["read"] == 10 and m.stats["spilled"] == 4
+    assert m.stats["duplicate"] == 1
+    assert [ m.match(records.Record(i, "")).id for i in ids[:39] ] == \
+        ids[:39]
+    m.close()
+
+class FakeRead(object):
+    def __init__(self, qname, flag, seq="ACGTT", qual="ABCDE"):
+        self.qname, self.flag, self.seq, self.qual = qname, flag, seq, qual
+        self.is_paired = bool(flag & 0x1)
+        self.is_reverse = bool(flag & 0x10)
+        self.is_read1 = bool(flag & 0x40)
+        self.is_secondary = bool(flag & 0x100)
+
+def test_bam_pe_split_collate():
+    """ Test collating mates from coordinate sorted reads """
+    reads = list()
+    for i in range(30):
+        reads.append(FakeRead("p%d"%(i), 0x1|0x40|(0x10 if i%3 else 0)))
+        reads.append(FakeRead("s%d"%(i), 0x0))
+        reads.append(FakeRead("p%d"%(i), 0x1|0x40|0x100))
+    reads.extend(FakeRead("p%d"%(i), 0x1|0x80) for i in range(29, 0, -1))
+    outs = [ StringIO() for _ in range(3) ]
+    counts = bam_pe_split.collate(reads, *outs, buffer_size=4, n_buckets=3)
+    r1, r2, se = [ list(records.parse(StringIO(o.getvalue()), "fastq"))
+                   for o in outs ]
+    assert [ r.id for r in r1 ] == [ r.id for r in r2 ]
+    assert len(r1) == counts["pairs"] == 29
+    assert len(se) == counts["single"] + counts["orphans"] == 31
+    assert counts["skipped"] == 30
+    assert r1[0].seq in ("ACGTT", "AACGT") and r2[0].seq == "ACGTT"
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_demultiplex_matches_biopython():
+    """ Test parallel demultiplexing with few open files matches biopython """
+    import random
+    rand = random.Random(3)
+    samples = [ "sample_%d"%(i) for i in range(7) ]
+    fnames = [ tmp_file("in%d.fa"%(i)) for i in range(2) ]
+    for fname in fnames:
+        with open(fname, 'w') as f:
+            for i in range(300):
+                seq = "".join(rand.choice("ACGT")
+                              for _ in range(rand.randint(1, 150)))
+                f.write(">%s_%d_ACGT orig_bc=ACGT\n%s\n"%(
+                    rand.choice(samples + ["stray"]), i, seq))
+    expected = dict( (s, StringIO()) for s in samples )
+    for fname in fnames:
+        for rec in SeqIO.parse(fname, "fasta"):
+            s_id = demux.sample_id(rec.id)
+            if s_id in expected:
+                SeqIO.write(rec, expected[s_id], "fasta")
+
+    outs = dict( (s, tmp_file(s+".fa")) for s in samples )
+    for jobs in (1, 2):
+        counts, unknown = demux.demultiplex(
+            fnames, outs, jobs=jobs, max_open=2, buffer_size=1000,
+            chunk_size=777)
+        assert unknown > 0
+        for s in samples:
+            with open(outs[s]) as f:
+                assert f.read() == expected[s].getvalue()
+            assert counts[s] == expected[s].getvalue().count(">")
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_otu_counts_sparse_shards():
+    """ Test OTU tables from several .uc files match counting by hand """
+    from collections import Counter
+    hits = [ ("S%d"%(i%7), "%d"%(i*i%11)) for i in range(500) ]
+    fnames = list()
+    for shard in range(3):
+        fnames.append(tmp_file("%d.uc"%(shard)))
+        with open(fnames[-1], 'w') as f:
+            for i, (sample, otu) in enumerate(hits[shard::3]):
+                f.write("N\t*\t*\t*\t*\t*\t*\t*\t%s_x\t*\n"%(sample))
+                f.write("H\t0\t250\t99.0\t+\t0\t0\t250M\t%s_%d"
+                        " orig_bc=ACGT\tOTU_%s;size=2;\n"%(sample, i, otu))
+    table = uclust.parse_otutable.count(fnames)
+    out = StringIO()
+    uclust.parse_otutable.output(table, out)
+    lines = out.getvalue().splitlines()
+    samples = lines[0].split("\t")[1:]
+    result = Counter()
+    for line in lines[1:]:
+        row = line.split("\t")
+        for sample, cnt in zip(samples, map(int, row[1:])):
+            if cnt:
+                result[(sample, row[0])] = cnt
+    assert result == Counter(hits)
+    assert sorted(table.otu_ids) == sorted(set(o for _, o in hits))
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_format_otu_table_sums_by_reference():
+    """ Test OTUs hitting the same named reference are summed together """
+    with open(tmp_file("tax.txt"), 'w') as f:
+        f.write("refA\tk__A\nrefB\tk__B\nrefC\tk__C\n")
+    with open(tmp_file("otus.txt"), 'w') as f:
+        f.write("OTUId\tS1\tS2\n1\t1\t2\n2\t3\t4\n3\t5\t0\n"
+                "4\t0\t7\n5\t9\t9\n")
+    with open(tmp_file("closed.uc"), 'w') as f:
+        for otu, ref in [(1, "refA"), (2, "refB"), (3, "refA"),
+                         (4, "refX"), (5, "*"), (6, "refC")]:
+            f.write("H\t0\t250\t99\t+\t0\t0\t250M"
+                    "\tOTU_%d;size=2;\t%s\n"%(otu, ref))
+    uclust.format_otu_table(tmp_file("tax.txt"), tmp_file("otus.txt"),
+                            tmp_file("closed.uc"), tmp_file("out.tsv"))
+    with open(tmp_file("out.tsv")) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "OTUId\tS1\tS2\ttaxonomy"
+    assert sorted(lines[1:]) == ["0\t9\t16\tUnclassified",
+                                 "refA\t6\t2\tk__A",
+                                 "refB\t3\t4\tk__B"]
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_execution_plan_parallel():
+    """ Test plans run steps after their inputs and stop at a failure """
+    for jobs in (1, 3):
+        for f in os.listdir(tmpdir):
+            os.remove(tmp_file(f))
+        plan = uclust.ExecutionPlan(quiet=True, jobs=jobs)
+        plan.step("sleep 0.2; echo a > "+tmp_file("a"), [tmp_file("a")], [])
+        plan.step("echo b > "+tmp_file("b"), [tmp_file("b")], [])
+        plan.step("cat %s %s > %s"%(tmp_file("a"), tmp_file("b"),
+                                    tmp_file("c")),
+                  [tmp_file("c")], [tmp_file("a"), tmp_file("b")])
+        plan.step("rm "+tmp_file("b"), [], [tmp_file("b")])
+        plan.step("false", [], [])
+        plan.step("echo e > "+tmp_file("e"), [tmp_file("e")], [])
+        assert plan.graph() == [set(), set(), set([0, 1]), set([1, 2]),
+                                set([0, 1, 2, 3]), set([4])]
+        try:
+            plan.go()
+        except uclust.ShellException:
+            pass
+        else:
+            assert False, "plan should have stopped at `false'"
+        with open(tmp_file("c")) as f:
+            assert f.read() == "a\nb\n"
+        assert not os.path.exists(tmp_file("b"))
+        assert not os.path.exists(tmp_file("e"))
+        steps = dict( (r['step'], r) for r in plan.telemetry )
+        assert steps[3]['status'] == "ran"
+        # the cleanup step's input is measured before it's removed
+        assert steps[4]['input_bytes'] == 2
+        assert steps[5]['status'] == "failed"
+        assert steps[1]['wall'] >= 0.2
+
+    # function steps can only be measured along with the whole process
+    plan = uclust.ExecutionPlan(quiet=True)
+    plan.step("echo a > "+tmp_file("a"), [tmp_file("a")], [])
+    plan.step(lambda: open(tmp_file("f"), 'w').close(), [tmp_file("f")],
+              [tmp_file("a")])
+    plan.go()
+    assert "max_rss_kb" in plan.telemetry[0]
+    assert "process_max_rss_kb" in plan.telemetry[1]
+    assert "max_rss_kb" not in plan.telemetry[1]
+    lines = plan.summary().splitlines()
+    assert "*" not in lines[1] and lines[2].count("*") == 2
+    assert lines[-1] == "* whole process, not just this step"
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_execution_plan_resume_fingerprints():
+    """ Test resume reruns steps with changed files and writes atomically """
+    def plan_run(last_cmd="cat %s > %s"):
+        plan = uclust.ExecutionPlan(quiet=True, resume=True)
+        plan.step("echo a > "+tmp_file("a"), [tmp_file("a")], [])
+        plan.step(last_cmd%(tmp_file("a"), tmp_file("b")), [tmp_file("b")],
+                  [tmp_file("a")])
+        plan.go()
+        return [ r['status'] for r in plan.telemetry ]
+    assert plan_run() == ["ran", "ran"]
+    assert plan_run() == ["skipped", "skipped"]
+    # a truncated output is made again
+    open(tmp_file("b"), 'w').close()
+    assert plan_run() == ["skipped", "ran"]
+    # so is everything after a changed input
+    with open(tmp_file("a"), 'w') as f:
+        f.write("changed\n")
+    assert plan_run() == ["ran", "ran"]
+    # a failed step leaves the last good output in place
+    try:
+        plan_run("(cat %s; echo x) > %s; false")
+    except uclust.ShellException:
+        pass
+    with open(tmp_file("b")) as f:
+        assert f.read() == "a\n"
+    assert sorted(os.listdir(tmpdir)) == [".a.manifest.json", "a", "b"]
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_dereplicate():
+    """ Test dereplicating gives the same uniques in memory or on disk """
+    seqs = ["ACGT", "GGCC", "acgt", "TTAA", "GGCC", "ACGT", "CCCC", "TTAA"]
+    with open(tmp_file("in.fa"), 'w') as f:
+        for i, seq in enumerate(seqs):
+            f.write(">r%d;size=9; x\n%s\n"%(i, seq))
+    assert derep.dereplicate(tmp_file("in.fa"), tmp_file("mem.fa"),
+                             minsize=2) == (8, 3, 0)
+    n, written, set_aside = derep.dereplicate(
+        tmp_file("in.fa"), tmp_file("disk.fa"), minsize=2,
+        max_memory=1, n_buckets=3, temp_dir=tmpdir)
+    assert (n, written) == (8, 3) and set_aside == 8
+    with open(tmp_file("mem.fa")) as f:
+        mem = f.read()
+    with open(tmp_file("disk.fa")) as f:
+        assert f.read() == mem
+    assert mem == (">r0 x;size=3;\nACGT\n>r1 x;size=2;\nGGCC\n"
+                   ">r3 x;size=2;\nTTAA\n")
+    assert sorted(os.listdir(tmpdir)) == ["disk.fa", "in.fa", "mem.fa"]
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_orientation():
+    """ Test guessing read orientation against a reference, with a cache """
+    import random
+    rand = random.Random(42)
+    refs = [ "".join(rand.choice("ACGT") for _ in range(300))
+             for _ in range(5) ]
+    with open(tmp_file("ref.fa"), 'w') as f:
+        for i, ref in enumerate(refs):
+            f.write(">ref%d\n%s\n"%(i, ref))
+    def write_reads(name, rc):
+        with open(tmp_file(name), 'w') as f:
+            for i in range(50):
+                start = rand.randint(0, 200)
+                seq = refs[i % 5][start:start+100]
+                if rc:
+                    seq = records.reverse_complement(seq)
+                f.write(">read%d\n%s\n"%(i, seq))
+    write_reads("fwd.fa", False)
+    write_reads("rev.fa", True)
+    np = orient.np
+    try:
+        for with_numpy in (True, False):
+            orient.np = np if with_numpy else None
+            # start each pass without the cache the last one wrote
+            for name in ("fwd.fa", "rev.fa"):
+                cache = tmp_file(name+".orientation.json")
+                if os.path.exists(cache):
+                    os.remove(cache)
+            assert orient.vote(orient.sample(tmp_file("rev.fa")),
+                               tmp_file("ref.fa")) == (0, 50)
+            assert orient.orientation(tmp_file("fwd.fa"),
+                                      tmp_file("ref.fa")) == "forward"
+            assert orient.orientation(tmp_file("rev.fa"), tmp_file("ref.fa"),
+                                      n=10, min_votes=20) is None
+        # the votes are cached
+        with open(tmp_file("rev.fa.orientation.json")) as f:
+            assert '"votes": [0, 10]' in f.read()
+        assert orient.orientation(tmp_file("rev.fa"), tmp_file("ref.fa"),
+                                  n=10, min_votes=5) == "reverse"
+    finally:
+        orient.np = np
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_barcode_matches():
+    """ Test matching barcode reads to map barcodes both ways round """
+    barcodes = ["AAACCCGGGTTA", "GGGGAAAACCCC"]
+    reads = ["AAACCCGGGTTA", "GGGGTTTTCCCC", "ggggttttcccc",
+             "AAACCCGGGTTAC", "NNNNNNNNNNNN"]
+    with open(tmp_file("bc.fastq"), 'w') as f:
+        for i, seq in enumerate(reads):
+            f.write("@bc%d\n%s\n+\n%s\n"%(i, seq, "I"*len(seq)))
+    assert orient.barcode_matches([tmp_file("bc.fastq")],
+                                  barcodes) == (5, 2, 2)
+    assert orient.barcode_matches([tmp_file("bc.fastq")]*2,
+                                  barcodes, n=7) == (7, 3, 3)
+    assert orient.decide(3, 40) == "reverse"
+    assert orient.decide(3, 2) is None
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_demultiplex_illumina():
+    """ Test splitting Illumina reads like split_libraries_fastq.py """
+    reads = [ ("AAAAAAAAAAAA", "ACGTACGT", "IIIIIIII"),
+              ("AAAAAAAAAAAT", "ACGTACGT", "IIIIIIII"),
+              ("AAAAAAAAAACC", "ACGTACGT", "IIIIIIII"),
+              ("CCCCCCCCCCCC", "ACGTACGT", "IIIII###"),
+              ("CCCCCCCCCCCC", "ACGTACGT", "IIII####"),
+              ("CCCCCCCCCCCC", "ACGTNCGT", "IIIIIIII") ]
+    with open(tmp_file("seq.fq"), 'w') as seq_f, \
+         open(tmp_file("bc.fq"), 'w') as bc_f:
+        for i, (bc, seq, qual) in enumerate(reads):
+            seq_f.write("@r%d 1:N\n%s\n+\n%s\n"%(i, seq, qual))
+            bc_f.write("@r%d 2:N\n%s\n+\n%s\n"%(i, bc, "I"*len(bc)))
+    barcodes = {"AAAAAAAAAAAA": "S1", "CCCCCCCCCCCC": "S2"}
+    lanes = [(tmp_file("seq.fq"), tmp_file("bc.fq"))]*2
+    for jobs in (1, 2):
+        outputs = {"S1": tmp_file("S1.fa"), "S2": tmp_file("S2.fa")}
+        counts = demux.demultiplex_illumina(
+            lanes, [barcodes]*2, outputs, jobs=jobs, chunk_size=2)
+        assert counts == dict(reads=12, no_barcode=2, low_quality=4,
+                              unknown=0, written={"S1": 4, "S2": 2})
+        with open(tmp_file("S1.fa")) as f:
+            s1 = f.read().splitlines()
+        assert s1[:4] == [
+            ">S1_0 r0 1:N orig_bc=AAAAAAAAAAAA new_bc=AAAAAAAAAAAA"
+            " bc_diffs=0", "ACGTACGT",
+            ">S1_1 r1 1:N orig_bc=AAAAAAAAAAAT new_bc=AAAAAAAAAAAA"
+            " bc_diffs=0", "ACGTACGT"]
+        assert s1[4].startswith(">S1_3 r0 ")
+        with open(tmp_file("S2.fa")) as f:
+            assert f.read().startswith(">S2_2 r3 1:N")
+    barcodes = {"ACGTAC": "a", "ACGTAG": "b"}
+    matcher = demux.BarcodeMatcher(barcodes, "6")
+    assert matcher.match("ACGTACGG") == ("a", "ACGTAC", 0)
+    assert matcher.match("TCGTACGG") is None
+    matcher = demux.BarcodeMatcher(barcodes, "6", max_errors=1,
+                                   correct_non_golay=True)
+    assert matcher.match("TCGTACGG") == ("a", "ACGTAC", 1)
+    assert matcher.match("ACGTAA") is None
+
+    # 151 * 0.75 rounds to 113, so 113 good bases are enough
+    keep = demux.QualityFilter()
+    seq = "A" * 151
+    assert keep(seq, "I"*113 + "#"*38) == "A"*113
+    assert keep(seq, "I"*112 + "#"*39) is None
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_biomtable_merge():
+    """ Test merging biom tables sparsely sums counts and keeps taxonomy """
+    import json
+    def write_table(name, otus, samples, data, matrix_type="sparse"):
+        taxonomy = lambda o: {"taxonomy": ["k__"+o, "p__"+o]}
+        doc = dict(id=None, format="Biological Observation Matrix 1.0.0",
+                   matrix_type=matrix_type, shape=[len(otus), len(samples)],
+                   rows=[ dict(id=o, metadata=taxonomy(o)) for o in otus ],
+                   columns=[ dict(id=s, metadata=None) for s in samples ],
+                   data=data)
+        with open(tmp_file(name), 'w') as f:
+            json.dump(doc, f)
+    write_table("a.biom", ["o1", "o2"], ["S1"], [[0, 0, 5], [1, 0, 2]])
+    write_table("b.biom", ["o3", "o1"], ["S2", "S1"], [[3, 0], [0, 1]],
+                matrix_type="dense")
+    write_table("c.biom", ["o2"], ["S3"], [[0, 0, 7]])
+    open(tmp_file("empty.biom"), 'w').close()
+    fnames = [ tmp_file(f) for f in ("a.biom", "empty.biom", "b.biom",
+                                     "missing.biom", "c.biom") ]
+    expected = { ("o1", "S1"): 6, ("o2", "S1"): 2, ("o3", "S2"): 3,
+                 ("o2", "S3"): 7 }
+    for jobs in (1, 2):
+        assert biomtable.merge_files(fnames, tmp_file("merged.biom"),
+                                     jobs=jobs, batch_size=2) == (3, 3, 4)
+        merged = biomtable.read(tmp_file("merged.biom"))
+        assert merged.otu_ids == ["o1", "o2", "o3"]
+        assert merged.sample_ids == ["S1", "S2", "S3"]
+        got = dict( ((merged.otu_ids[r], merged.sample_ids[c]), v)
+                    for r, c, v in zip(merged.rows, merged.cols,
+                                       merged.values) )
+        assert got == expected
+        assert merged.otu_metadata[2] == {"taxonomy": ["k__o3", "p__o3"]}
+    with open(tmp_file("merged.biom")) as f:
+        assert json.load(f)["matrix_element_type"] == "int"
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_copynumber_drop_unknown():
+    """ Test dropping OTUs without a copy number reuses the OTU ID index """
+    import gzip
+    import json
+    copy_fname = tmp_file("copy_number.tab.gz")
+    with gzip.open(copy_fname, 'w') as f:
+        f.write("#OTU_IDs\t16S_rRNA_Count\n101\t2.0\n103\t1.0\n104\t3.0\n")
+    with open(tmp_file("otus.tsv"), 'w') as f:
+        f.write("# Constructed from biom file\n"
+                "#OTU ID\tS1\tS2\ttaxonomy\n"
+                "101\t4.0\t0.0\tk__Bacteria; p__Firmicutes\n"
+                "102\t1.0\t1.0\tk__Bacteria\n"
+                "103\t0.0\t2.0\tk__Bacteria; p__Proteobacteria\n")
+    assert copynumber.drop_unknown(tmp_file("otus.tsv"), copy_fname,
+                                   tmp_file("known.biom")) == (2, 3)
+    assert os.path.exists(copy_fname+".ids")
+    known = biomtable.read(tmp_file("known.biom"))
+    assert known.otu_ids == ["101", "103"]
+    assert known.sample_ids == ["S1", "S2"]
+    assert list(zip(known.rows, known.cols, known.values)) == [
+        (0, 0, 4), (1, 1, 2)]
+    assert known.otu_metadata[1] == {
+        "taxonomy": ["k__Bacteria", "p__Proteobacteria"]}
+
+    # the index is read back instead of the copy number file
+    copynumber._indexes.clear()
+    read_ids, copynumber.read_ids = copynumber.read_ids, None
+    try:
+        assert copynumber.otu_ids(copy_fname) == frozenset(
+            ["101", "103", "104"])
+    finally:
+        copynumber.read_ids = read_ids
+
+    with open(tmp_file("known.biom")) as f:
+        doc = json.load(f)
+    doc["rows"][0]["id"] = "105"
+    with open(tmp_file("renamed.biom"), 'w') as f:
+        json.dump(doc, f)
+    assert copynumber.drop_unknown(tmp_file("renamed.biom"), copy_fname,
+                                   tmp_file("known2.biom")) == (1, 2)
+
+    # empty tables stay empty
+    open(tmp_file("empty.tsv"), 'w').close()
+    assert copynumber.drop_unknown(tmp_file("empty.tsv"), copy_fname,
+                                   tmp_file("empty.biom")) == (0, 0)
+    assert os.stat(tmp_file("empty.biom")).st_size == 0
+
+
+def test_biomtable_subset_and_classic():
+    """ Test splitting a merged table back apart and tabulating it """
+    tables = [
+        biomtable.Table(["o1", "o2"], ["S1"], [0, 1], [0, 0], [5, 2],
+                        [{"taxonomy": ["k__a", "p__b"]}, None], [None]),
+        biomtable.Table(["o2", "o3"], ["S1", "S2"], [0, 1, 1], [1, 0, 1],
+                        [1, 3, 0.25], [None, {"taxonomy": ["k__c"]}],
+                        [None, None]),
+    ]
+    merger = biomtable.Merger()
+    for i, table in enumerate(tables):
+        merger.add(table._replace(
+            sample_ids=[ "%d_%s"%(i, s) for s in table.sample_ids ]))
+    merged = merger.table()
+    assert merged.sample_ids == ["0_S1", "1_S1", "1_S2"]
+    part = biomtable.subset(merged, [2, 1], [2, 1])
+    assert part.otu_ids == ["o3", "o2"]
+    assert part.sample_ids == ["1_S2", "1_S1"]
+    assert list(zip(part.rows, part.cols, part.values)) == [
+        (0, 0, 0.25), (0, 1, 3), (1, 0, 1)]
+    out = StringIO()
+    biomtable.write_classic(part._replace(sample_ids=["S2", "S1"]), out,
+                            "taxonomy", "Consensus Lineage")
+    assert out.getvalue() == ("# Constructed from biom file\n"
+                              "#OTU ID\tS2\tS1\tConsensus Lineage\n"
+                              "o3\t0.25\t3.0\tk__c\n"
+                              "o2\t1.0\t0.0\t")
+    keep = biomtable.filter_otus(merged, set(["o1", "o3"]))
+    assert keep.otu_ids == ["o1", "o3"]
+    assert keep.otu_metadata[0] == {"taxonomy": ["k__a", "p__b"]}
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_biomtable_tsv_conversion():
+    """ Test converting tsv OTU tables to biom and back keeps taxonomy """
+    with open(tmp_file("otus.tsv"), 'w') as f:
+        f.write("OTUId\tS1\tS2\ttaxonomy\n"
+                "101\t3\t0\tk__Bacteria; p__Firmicutes\n"
+                "102\t0\t1\tk__Bacteria\n")
+    with open(tmp_file("map.txt"), 'w') as f:
+        f.write("#SampleID\tBarcodeSequence\tDescription\n"
+                "S1\tACGT\tfirst\n"
+                "S2\tTGCA\tsecond\n")
+    open(tmp_file("empty.biom"), 'w').close()
+    biomtable.from_tsv(tmp_file("otus.tsv"), tmp_file("otus.biom"),
+                       tmp_file("map.txt"))
+    table = biomtable.read(tmp_file("otus.biom"))
+    assert table.otu_metadata[0] == {
+        "taxonomy": ["k__Bacteria", "p__Firmicutes"]}
+    assert table.sample_metadata[1] == {"BarcodeSequence": "TGCA",
+                                        "Description": "second"}
+    for jobs in (1, 2):
+        biomtable.convert_files(
+            biomtable.to_tsv, [tmp_file("otus.biom"), tmp_file("empty.biom")],
+            [tmp_file("otus.biom.tsv"), tmp_file("empty.biom.tsv")], jobs=jobs)
+        with open(tmp_file("otus.biom.tsv")) as f:
+            assert f.read() == (
+                "# Constructed from biom file\n"
+                "#OTU ID\tS1\tS2\tConsensus Lineage\n"
+                "101\t3.0\t0.0\tk__Bacteria; p__Firmicutes\n"
+                "102\t0.0\t1.0\tk__Bacteria")
+        assert os.stat(tmp_file("empty.biom.tsv")).st_size == 0
+
+    # without any taxonomy, the column's named but rows leave it off
+    with open(tmp_file("plain.tsv"), 'w') as f:
+        f.write("OTUId\tS1\n101\t3\n")
+    biomtable.from_tsv(tmp_file("plain.tsv"), tmp_file("plain.biom"))
+    biomtable.to_tsv(tmp_file("plain.biom"), tmp_file("plain.biom.tsv"))
+    with open(tmp_file("plain.biom.tsv")) as f:
+        assert f.read() == ("# Constructed from biom file\n"
+                            "#OTU ID\tS1\tConsensus Lineage\n"
+                            "101\t3.0")
+    biomtable.from_tsv(tmp_file("otus.tsv"), tmp_file("otus.biom"),
+                       process_taxonomy=False)
+    assert biomtable.read(tmp_file("otus.biom")).otu_metadata[1] == {
+        "taxonomy": "k__Bacteria"}
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_sparsity_filter_matches_rowwise():
+    """ Test the block sparsity filter writes what the row filter did """
+    import random
+    random.seed(4)
+    with open(tmp_file("in.pcl"), 'w') as f:
+        f.write("ID\t" + "\t".join( "S%d"%i for i in range(12) ) + "\n")
+        for i in range(300):
+            values = [ random.choice(["0", "0", "0.0005", "0.001", "0.25",
+                                      "1e-2", "0.1234567890123", "nan"])
+                       for _ in range(12) ]
+            f.write("g%d\t%s\n"%(i, "\t".join(values)))
+            if i == 150:
+                f.write("short\t0.5\t0.01\n\n")
+
+    def rowwise(min_abundance, min_prevalence):
+        out = list()
+        with open(tmp_file("in.pcl")) as f:
+            out.append(f.readline())
+            for line in f:
+                fields = line.strip().split('\t')
+                key, values = fields[0], map(float, fields[1:])
+                present = sum([ val >= min_abundance for val in values ])
+                if present >= int(len(values)*min_prevalence):
+                    out.append("\t".join([key] + map(str, values)) + "\n")
+        return "".join(out)
+
+    import warnings
+    np = sparsity.np
+    try:
+        for use_numpy in (True, False):
+            sparsity.np = np if use_numpy else None
+            for thresholds in ((0.001, 0.1), (0.01, 0.25)):
+                with warnings.catch_warnings():
+                    warnings.simplefilter("error", RuntimeWarning)
+                    n, kept = sparsity.filter_pcl(
+                        tmp_file("in.pcl"), tmp_file("out.pcl"), *thresholds,
+                        chunk_size=64)
+                expected = rowwise(*thresholds)
+                assert n == 302
+                assert kept == expected.count("\n") - 1
+                with open(tmp_file("out.pcl")) as f:
+                    assert f.read() == expected
+    finally:
+        sparsity.np = np